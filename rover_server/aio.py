@@ -0,0 +1,170 @@
+"""
+asyncio backend
+
+runs the same ServerProtocol and ProtocolConnections on asyncio event loop
+(trollius on Python 2) or uvloop instead of twisted reactor, asyncio
+transport of every connection is adapted to the part of twisted transport
+interface used by the server, so wire protocol and registry semantics
+do not depend on the backend
+
+uvloop requires Python 3, trollius provides asyncio interface on Python 2
+
+not supported by this backend: worker processes, metrics endpoint and
+federation (see main of rover_server.server)
+"""
+
+import socket
+
+try:
+    import asyncio
+except ImportError:
+    try:
+        import trollius as asyncio
+    except ImportError:
+        asyncio = None
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+from twisted.internet.error import ConnectionDone
+from twisted.internet.error import ConnectionLost
+from twisted.python.failure import Failure
+
+
+class AsyncioClock(object):
+    """
+    twisted clock (IReactorTime subset used by connections registry,
+    idle reaper and LoopingCall) on top of asyncio event loop
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+
+    def seconds(self):
+        return self.loop.time()
+
+    def callLater(self, delay, f, *args, **kwargs):
+        if kwargs:
+            return self.loop.call_later(delay, lambda: f(*args, **kwargs))
+        return self.loop.call_later(delay, f, *args)
+
+
+class TransportAdapter(object):
+    """
+    twisted transport interface over asyncio transport
+    """
+
+    __slots__ = ('transport', 'producer', 'streaming', 'disconnecting')
+
+    def __init__(self, transport):
+        self.transport = transport
+        self.producer = None
+        self.streaming = False
+        self.disconnecting = False
+
+    def write(self, data):
+        self.transport.write(data)
+
+    def writeSequence(self, data):
+        self.transport.writelines(data)
+
+    def loseConnection(self):
+        self.disconnecting = True
+        self.transport.close()
+
+    def abortConnection(self):
+        self.disconnecting = True
+        self.transport.abort()
+
+    def pauseProducing(self):
+        self.transport.pause_reading()
+
+    def resumeProducing(self):
+        self.transport.resume_reading()
+
+    def registerProducer(self, producer, streaming):
+        #twisted pauses streaming producers once write buffer is full and
+        #resumes producers once it is drained, pull producers are resumed
+        #on every drain, so they are told about any buffered data
+        self.producer = producer
+        self.streaming = streaming
+        if not streaming:
+            self.transport.set_write_buffer_limits(high=0, low=0)
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def get_write_buffer_size(self):
+        return self.transport.get_write_buffer_size()
+
+    def setTcpNoDelay(self, enabled):
+        sock = self.transport.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, enabled)
+
+    def getPeer(self):
+        return self.transport.get_extra_info('peername')
+
+    def getHost(self):
+        return self.transport.get_extra_info('sockname')
+
+
+class AsyncioConnection(asyncio.Protocol if asyncio else object):
+    """
+    asyncio protocol feeding protocol built by twisted factory
+    """
+
+    def __init__(self, factory):
+        self.protocol = factory.buildProtocol(None)
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = TransportAdapter(transport)
+        self.protocol.makeConnection(self.transport)
+
+    def data_received(self, data):
+        self.protocol.dataReceived(data)
+
+    def connection_lost(self, exc):
+        if exc is None:
+            reason = Failure(ConnectionDone())
+        else:
+            reason = Failure(ConnectionLost(str(exc)))
+        self.protocol.connectionLost(reason)
+
+    def pause_writing(self):
+        if self.transport.producer is not None and self.transport.streaming:
+            self.transport.producer.pauseProducing()
+
+    def resume_writing(self):
+        if self.transport.producer is not None:
+            self.transport.producer.resumeProducing()
+
+
+def get_event_loop(use_uvloop=False):
+    if use_uvloop:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return asyncio.get_event_loop()
+
+
+def listen_asyncio(loop, port, factory, interface=None):
+    return loop.run_until_complete(loop.create_server(
+        lambda: AsyncioConnection(factory), interface, port,
+        reuse_address=True
+    ))
+
+
+def run_asyncio(loop, factories):
+    servers = [listen_asyncio(loop, port, factory)
+               for port, factory in factories]
+
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for server in servers:
+            server.close()
+        loop.close()
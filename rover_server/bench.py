@@ -0,0 +1,337 @@
+import sys
+import json
+import time
+import resource
+import argparse
+
+from twisted.internet import defer
+from twisted.internet import reactor
+from twisted.internet import task
+from twisted.internet.protocol import ClientFactory
+from twisted.protocols.basic import LineReceiver
+
+from rover_server.server import ProtocolConnections
+from rover_server.server import ServerFactory
+from rover_server.logger import logger
+from rover_server.logger import ERROR
+
+
+class BenchDevice(LineReceiver):
+    """
+    simulated device, echoes every RE communicate back to its controller
+    """
+
+    def connectionMade(self):
+        self.sendLine('DC:' + self.factory.next_name())
+
+    def lineReceived(self, line):
+        if line[:3] == 'RE:':
+            self.sendLine(line)
+
+
+class BenchController(LineReceiver):
+    """
+    simulated controller, connects to its device and keeps window of
+    RE communicates in flight measuring round trip of each of them
+
+    communicate format:
+    RE:<sent-timestamp>:<payload>
+    """
+
+    device_name = None
+    sent = 0
+    received = 0
+
+    def connectionMade(self):
+        self.bench = self.factory.bench
+        self.sendLine('CC:' + self.factory.next_name())
+
+    def lineReceived(self, line):
+        command = line[:2]
+
+        if command == 'RE':
+            self.received += 1
+            sent_time = float(line[3:].split(':', 1)[0])
+            self.bench.round_trips.append(time.time() - sent_time)
+            if self.sent < self.bench.messages:
+                self.send_request()
+            elif self.received == self.bench.messages:
+                self.bench.controller_done()
+
+        elif command == 'CD':
+            self.bench.controller_paired()
+
+    def connect_device(self, device_name):
+        self.device_name = device_name
+        self.sendLine('CD:' + device_name)
+
+    def start_relay(self):
+        for _ in range(min(self.bench.window, self.bench.messages)):
+            self.send_request()
+
+    def send_request(self):
+        self.sent += 1
+        self.sendLine('RE:{:.6f}:{}'.format(time.time(), self.bench.payload))
+
+
+class BenchClientFactory(ClientFactory):
+
+    def __init__(self, bench, protocol, prefix):
+        self.bench = bench
+        self.protocol = protocol
+        self.prefix = prefix
+        self.names_count = 0
+        self.protocols = []
+
+    def next_name(self):
+        name = '{}{}'.format(self.prefix, self.names_count)
+        self.names_count += 1
+        return name
+
+    def buildProtocol(self, addr):
+        protocol = ClientFactory.buildProtocol(self, addr)
+        self.protocols.append(protocol)
+        return protocol
+
+
+class Benchmark(object):
+    """
+    runs server and simulated clients on loopback within one reactor
+
+    measured:
+    connect_storm_time - time needed to register all devices
+    memory_per_connection - growth of max RSS in bytes divided by number
+        of connection endpoints (client and server sides live in this process)
+    relay_throughput - RE lines relayed by server per second
+    round trip latency percentiles of controller -> device -> controller
+    """
+
+    def __init__(self, devices, controllers, messages, window, payload_size,
+                 splice_relay=False, batch_writes=False, tcp_nodelay=False):
+        self.devices = devices
+        self.controllers = controllers
+        self.messages = messages
+        self.window = window
+        self.payload = 'x' * payload_size
+        self.connections = ProtocolConnections(
+            splice_relay=splice_relay,
+            batch_writes=batch_writes,
+            tcp_nodelay=tcp_nodelay,
+        )
+
+        self.round_trips = []
+        self.paired_count = 0
+        self.done_count = 0
+        self.paired = defer.Deferred()
+        self.done = defer.Deferred()
+
+        self.device_factory = BenchClientFactory(
+            self, BenchDevice, 'bench_d'
+        )
+        self.controller_factory = BenchClientFactory(
+            self, BenchController, 'bench_c'
+        )
+
+    def controller_paired(self):
+        self.paired_count += 1
+        if self.paired_count == self.controllers:
+            self.paired.callback(None)
+
+    def controller_done(self):
+        self.done_count += 1
+        if self.done_count == self.controllers:
+            self.done.callback(None)
+
+    def connect_clients(self, factory, count):
+        for _ in range(count):
+            reactor.connectTCP(self.host, self.port, factory)
+
+    def wait_for(self, condition, interval=0.01):
+        waiting = defer.Deferred()
+
+        def check():
+            if condition():
+                loop.stop()
+                waiting.callback(None)
+
+        loop = task.LoopingCall(check)
+        loop.start(interval)
+        return waiting
+
+    @defer.inlineCallbacks
+    def run(self):
+        listening_port = reactor.listenTCP(
+            0, ServerFactory(self.connections), backlog=1024,
+            interface='127.0.0.1'
+        )
+        address = listening_port.getHost()
+        self.host, self.port = address.host, address.port
+
+        results = {
+            'devices': self.devices,
+            'controllers': self.controllers,
+            'messages': self.messages,
+            'window': self.window,
+            'payload_size': len(self.payload),
+            'splice_relay': self.connections.splice_relay,
+            'batch_writes': self.connections.batch_writes,
+            'tcp_nodelay': self.connections.tcp_nodelay,
+        }
+
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.time()
+        self.connect_clients(self.device_factory, self.devices)
+        yield self.wait_for(
+            lambda: len(self.connections.devices) == self.devices
+        )
+        results['connect_storm_time'] = time.time() - start
+
+        self.connect_clients(self.controller_factory, self.controllers)
+        yield self.wait_for(
+            lambda: len(self.connections.controllers) == self.controllers
+        )
+        rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        connections = 2 * (self.devices + self.controllers)
+        results['memory_per_connection'] = \
+            1024.0 * (rss_after - rss_before) / connections
+
+        controllers = self.controller_factory.protocols
+        for i, controller in enumerate(controllers):
+            controller.connect_device('bench_d{}'.format(i))
+        yield self.paired
+
+        start = time.time()
+        for controller in controllers:
+            controller.start_relay()
+        yield self.done
+        relay_time = time.time() - start
+
+        relayed = 2 * self.messages * self.controllers
+        results['relay_time'] = relay_time
+        results['relay_throughput'] = relayed / relay_time
+        results.update(self.get_latency_percentiles())
+
+        for factory in (self.device_factory, self.controller_factory):
+            for protocol in factory.protocols:
+                protocol.transport.loseConnection()
+        yield self.wait_for(lambda: not self.connections.protocols)
+        yield listening_port.stopListening()
+
+        defer.returnValue(results)
+
+    def get_latency_percentiles(self):
+        round_trips = sorted(self.round_trips)
+        last = len(round_trips) - 1
+
+        return {
+            'latency_p50': round_trips[int(last * 0.50)],
+            'latency_p99': round_trips[int(last * 0.99)],
+            'latency_max': round_trips[last],
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="rover server relay benchmark, prints JSON results"
+    )
+    parser.add_argument(
+        "-d", "--devices",
+        help="number of simulated devices",
+        type=int,
+        default=100,
+    )
+    parser.add_argument(
+        "-c", "--controllers",
+        help="number of simulated controllers, each paired with a device",
+        type=int,
+        default=100,
+    )
+    parser.add_argument(
+        "-m", "--messages",
+        help="number of RE round trips made by every controller",
+        type=int,
+        default=1000,
+    )
+    parser.add_argument(
+        "-w", "--window",
+        help="number of RE communicates in flight per controller",
+        type=int,
+        default=10,
+    )
+    parser.add_argument(
+        "--payload-size",
+        help="size of RE communicate payload in bytes",
+        type=int,
+        default=32,
+    )
+    parser.add_argument(
+        "--splice",
+        help="enable splice relay on the benchmarked server",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--batch-writes",
+        help="enable write batching on the benchmarked server",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--tcp-nodelay",
+        help="disable Nagle's algorithm on the benchmarked server",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-o", "--output",
+        help="file to write JSON results to, stdout by default",
+        required=False,
+    )
+
+    args = parser.parse_args()
+
+    for name in ('devices', 'controllers', 'messages', 'window'):
+        if getattr(args, name) <= 0:
+            parser.error("--{} has to be positive".format(name))
+
+    if args.controllers > args.devices:
+        parser.error("number of controllers exceeds number of devices")
+
+    logger.level = ERROR
+
+    bench = Benchmark(
+        args.devices,
+        args.controllers,
+        args.messages,
+        args.window,
+        args.payload_size,
+        args.splice,
+        args.batch_writes,
+        args.tcp_nodelay,
+    )
+
+    results = {}
+
+    def finished(bench_results):
+        results.update(bench_results)
+        reactor.stop()
+
+    def failed(failure):
+        failure.printTraceback()
+        reactor.stop()
+
+    reactor.callWhenRunning(
+        lambda: bench.run().addCallbacks(finished, failed)
+    )
+    reactor.run()
+
+    if not results:
+        sys.exit(1)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,560 @@
+import os
+import sys
+import socket
+import shutil
+import tempfile
+
+from twisted.internet import reactor
+from twisted.internet.protocol import Factory
+from twisted.internet.protocol import ClientFactory
+from twisted.internet.protocol import ProcessProtocol
+
+from rover_server.framing import FrameReceiver
+from rover_server.framing import TEXT_DELIMITER
+from rover_server.logger import logger
+
+
+#delay before worker process which ended is spawned again, doubled with
+#every consecutive failure up to MAX_RESPAWN_DELAY
+RESPAWN_DELAY = 1.0
+MAX_RESPAWN_DELAY = 30.0
+#consecutive failures of worker after which the coordinator stops
+MAX_RESPAWNS = 10
+#worker running at least this long is not failing, its failures reset
+STABLE_WORKER_TIME = 60.0
+
+
+class Coordinator(object):
+    """
+    registry shared by worker processes
+
+    keeps names of all clients connected to any of the workers together
+    with ids of their workers, set of available devices and routes
+    forwarded lines between workers
+
+    worker request structure (sent in frames, see rover_server.framing):
+    <command>:<request-body>
+
+    worker commands:
+    HI:<worker-id> - worker is connecting
+    RN:<name> - worker claims name for its client
+    RL:<name> - worker releases name of disconnected client
+    DA:<name> - device of the worker became available
+    DR:<name> - device of the worker is no longer available
+    FW:<target-name>:<op>:<data> - forward to worker owning target-name
+
+    coordinator commands to workers:
+    RN:OK:<name> - name claimed
+    RN:E_11:<name> - name is already used
+    DA:<worker-id>:<name> - device of other worker became available
+    DR:<worker-id>:<name> - device of other worker is no longer available
+    FW:<source-worker-id>:<target-name>:<op>:<data> - forwarded line
+    WL:<worker-id> - worker was lost
+    """
+
+    def __init__(self):
+        self.workers = {}
+        self.names = {}
+        self.available_devices = {}
+
+    def add_worker(self, worker_id, protocol):
+        self.workers[worker_id] = protocol
+        logger.info('worker {} joined', worker_id)
+
+        for device_name, device_worker in self.available_devices.items():
+            protocol.sendLine('DA:{}:{}'.format(device_worker, device_name))
+
+    def remove_worker(self, worker_id):
+        self.workers.pop(worker_id, None)
+        logger.info('worker {} lost', worker_id)
+
+        for name, name_worker in list(self.names.items()):
+            if name_worker == worker_id:
+                del self.names[name]
+                self.available_devices.pop(name, None)
+
+        self.broadcast(worker_id, 'WL:' + worker_id)
+
+    def broadcast(self, source_worker, line):
+        for worker_id, protocol in self.workers.items():
+            if worker_id != source_worker:
+                protocol.sendLine(line)
+
+    def claim_name(self, worker_id, name):
+        if name in self.names:
+            return 'E_11'
+
+        self.names[name] = worker_id
+        return 'OK'
+
+    def release_name(self, worker_id, name):
+        if self.names.get(name) == worker_id:
+            del self.names[name]
+            if self.available_devices.pop(name, None) is not None:
+                self.broadcast(worker_id, 'DR:{}:{}'.format(worker_id, name))
+
+    def device_available(self, worker_id, name):
+        self.available_devices[name] = worker_id
+        self.broadcast(worker_id, 'DA:{}:{}'.format(worker_id, name))
+
+    def device_unavailable(self, worker_id, name):
+        if self.available_devices.pop(name, None) is not None:
+            self.broadcast(worker_id, 'DR:{}:{}'.format(worker_id, name))
+
+    def forward(self, worker_id, target_name, op, data):
+        target_worker = self.workers.get(self.names.get(target_name))
+        if target_worker is not None:
+            target_worker.sendLine(
+                'FW:{}:{}:{}:{}'.format(worker_id, target_name, op, data)
+            )
+
+        #pairing with device which is gone, answer to the controller
+        elif op == 'CD':
+            source_worker = self.workers.get(worker_id)
+            if source_worker is not None:
+                source_worker.sendLine(
+                    'FW:{}:{}:CE:{}'.format(worker_id, data, target_name)
+                )
+
+
+class CoordinatorProtocol(FrameReceiver):
+
+    worker_id = None
+
+    def invalidFrameReceived(self):
+        logger.error('ERROR - invalid frame from worker {}', self.worker_id)
+        self.transport.loseConnection()
+
+    def connectionLost(self, reason):
+        if self.worker_id is not None:
+            self.factory.coordinator.remove_worker(self.worker_id)
+
+    def lineReceived(self, line):
+        coordinator = self.factory.coordinator
+        command = line[:2]
+        body = line[3:]
+
+        if command == 'HI':
+            self.worker_id = body
+            coordinator.add_worker(body, self)
+
+        elif command == 'RN':
+            result = coordinator.claim_name(self.worker_id, body)
+            self.sendLine('RN:{}:{}'.format(result, body))
+
+        elif command == 'RL':
+            coordinator.release_name(self.worker_id, body)
+
+        elif command == 'DA':
+            coordinator.device_available(self.worker_id, body)
+
+        elif command == 'DR':
+            coordinator.device_unavailable(self.worker_id, body)
+
+        elif command == 'FW':
+            target_name, op, data = body.split(':', 2)
+            coordinator.forward(self.worker_id, target_name, op, data)
+
+        else:
+            logger.error('ERROR - invalid worker command {}', line)
+
+
+class CoordinatorFactory(Factory):
+
+    protocol = CoordinatorProtocol
+
+    def __init__(self):
+        self.coordinator = Coordinator()
+
+
+class RemoteProtocol(object):
+    """
+    stands in connections registry for a client connected to another
+    worker, lines sent to it are forwarded through the coordinator
+    """
+
+    __slots__ = ('worker', 'name', 'worker_id', 'endpoint')
+
+    remote = True
+    delta_updates = False
+    splice_peer = None
+
+    def __init__(self, worker, name, worker_id):
+        self.worker = worker
+        self.name = intern(name)
+        self.worker_id = worker_id
+        self.endpoint = None
+
+    def sendLine(self, line):
+        self.worker.forward(self.name, 'SL', line)
+
+    def send_coalesced(self, line, key):
+        self.sendLine(line)
+
+    def reset(self):
+        self.endpoint = None
+
+    def connect_endpoint(self, protocol):
+        self.endpoint = protocol
+
+    def disconnect_endpoint(self):
+        #local endpoint went away, unpair the remote client
+        if self.endpoint is not None:
+            self.worker.forward(self.name, 'UP', self.endpoint.name)
+        self.endpoint = None
+        self.worker.drop_remote_protocol(self)
+
+    def start_splice(self, peer_protocol):
+        pass
+
+    def get_endpoint(self):
+        return self.endpoint
+
+
+class WorkerProtocol(FrameReceiver):
+    """
+    connection of a worker process to the coordinator
+
+    installed as cluster of the worker's connections registry, it claims
+    names, announces availability of local devices and pairs or relays
+    to clients connected to other workers
+
+    forwarded ops:
+    SL - send data line to the target client
+    UP - remote endpoint of the target client went away
+    CD - controller named in data pairs with the target device
+    CO - pairing of the target controller with device in data succeeded
+    CE - pairing of the target controller with device in data failed
+    """
+
+    def __init__(self, connections, worker_id):
+        self.connections = connections
+        self.worker_id = worker_id
+        self.pending_claims = {}
+        self.remote_devices = {}
+
+    def connectionMade(self):
+        self.sendLine('HI:' + self.worker_id)
+        self.factory.connected(self)
+
+    def connectionLost(self, reason):
+        logger.error('ERROR - connection to coordinator lost: {}', reason)
+        self.factory.disconnected(self)
+
+    def lineReceived(self, line):
+        command = line[:2]
+        body = line[3:]
+
+        if command == 'RN':
+            result, name = body.split(':', 1)
+            self.name_claimed(name, 0 if result == 'OK' else result)
+
+        elif command == 'DA':
+            worker_id, name = body.split(':', 1)
+            self.remote_device_available(worker_id, name)
+
+        elif command == 'DR':
+            worker_id, name = body.split(':', 1)
+            self.remote_device_unavailable(name)
+
+        elif command == 'FW':
+            worker_id, target_name, op, data = body.split(':', 3)
+            self.forwarded(worker_id, target_name, op, data)
+
+        elif command == 'WL':
+            self.worker_lost(body)
+
+        else:
+            logger.error('ERROR - invalid coordinator command {}', line)
+
+    def claim_name(self, name, callback):
+        self.pending_claims.setdefault(name, []).append(callback)
+        self.sendLine('RN:' + name)
+
+    def name_claimed(self, name, result):
+        callbacks = self.pending_claims.get(name)
+        if not callbacks:
+            return
+
+        callback = callbacks.pop(0)
+        if not callbacks:
+            del self.pending_claims[name]
+        callback(result)
+
+    def release_name(self, name):
+        self.sendLine('RL:' + name)
+
+    def device_available(self, name):
+        self.sendLine('DA:' + name)
+
+    def device_unavailable(self, name):
+        self.sendLine('DR:' + name)
+
+    def forward(self, target_name, op, data):
+        self.sendLine('FW:{}:{}:{}'.format(target_name, op, data))
+
+    def is_remote_device(self, name):
+        return name in self.remote_devices
+
+    def connect_remote_device(self, controller_protocol, device_name):
+        self.forward(device_name, 'CD', controller_protocol.name)
+
+    def drop_remote_protocol(self, remote_protocol):
+        protocols = self.connections.protocols
+        if protocols.get(remote_protocol.name) is remote_protocol:
+            del protocols[remote_protocol.name]
+
+    def is_local_name(self, name):
+        protocol = self.connections.protocols.get(name)
+        return protocol is not None and not protocol.remote
+
+    def remote_device_available(self, worker_id, name):
+        if self.is_local_name(name):
+            logger.error('ERROR - remote device {} is local client', name)
+            return
+
+        self.remote_devices[name] = worker_id
+        if self.connections.set_device_available(name):
+            self.connections.notify_all_about_available_devices()
+
+    def remote_device_unavailable(self, name):
+        if name not in self.remote_devices:
+            return
+
+        del self.remote_devices[name]
+        if self.connections.set_device_unavailable(name):
+            self.connections.notify_all_about_available_devices()
+
+    def forwarded(self, worker_id, target_name, op, data):
+        connections = self.connections
+        protocol = connections.protocols.get(target_name)
+
+        if op == 'CD':
+            self.pair_device(worker_id, protocol, target_name, data)
+            return
+
+        if protocol is None or protocol.remote:
+            if op == 'CO':
+                #controller is gone before pairing completed
+                self.forward(data, 'UP', target_name)
+            return
+
+        if op == 'SL':
+            if TEXT_DELIMITER in data and not protocol.binary_framing:
+                #communicate of remote binary client would be split into
+                #forged lines
+                logger.error(
+                    'ERROR - line with delimiter dropped for {}', target_name
+                )
+                return
+            protocol.sendLine(data)
+
+        elif op == 'UP':
+            self.unpair(protocol, data)
+
+        elif op == 'CO':
+            if data in connections.protocols:
+                #name of the device was taken by local client meanwhile
+                self.forward(data, 'UP', target_name)
+                protocol.sendLine('CD:E_21')
+                return
+
+            device_protocol = RemoteProtocol(self, data, worker_id)
+            connections.protocols[data] = device_protocol
+            connections.make_connection(device_protocol, protocol)
+            protocol.sendLine('CD:OK')
+
+        elif op == 'CE':
+            protocol.sendLine('CD:E_21')
+
+    def pair_device(self, worker_id, device_protocol, device_name,
+                    controller_name):
+        #local client is never replaced by remote one of the same name
+        connections = self.connections
+        if device_protocol is None or device_name not in connections.devices \
+                or controller_name in connections.protocols:
+            self.forward(controller_name, 'CE', device_name)
+            return
+
+        controller_protocol = RemoteProtocol(self, controller_name, worker_id)
+        connections.protocols[controller_name] = controller_protocol
+        connections.make_connection(device_protocol, controller_protocol)
+        self.forward(controller_name, 'CO', device_name)
+
+    def unpair(self, protocol, remote_name):
+        connections = self.connections
+        remote_protocol = protocol.get_endpoint()
+        if remote_protocol is None or remote_protocol.name != remote_name:
+            return
+
+        protocol.disconnect_endpoint()
+        if remote_protocol.remote:
+            remote_protocol.reset()
+            self.drop_remote_protocol(remote_protocol)
+
+        if protocol.name in connections.devices:
+            connections.set_device_available(protocol.name)
+            connections.notify_all_about_available_devices()
+
+    def worker_lost(self, worker_id):
+        connections = self.connections
+
+        for name, device_worker in list(self.remote_devices.items()):
+            if device_worker == worker_id:
+                del self.remote_devices[name]
+                connections.set_device_unavailable(name)
+
+        for name, protocol in list(connections.protocols.items()):
+            if not protocol.remote or protocol.worker_id != worker_id:
+                continue
+
+            local_protocol = protocol.get_endpoint()
+            protocol.reset()
+            self.drop_remote_protocol(protocol)
+
+            if local_protocol is None or local_protocol.remote:
+                continue
+
+            local_protocol.disconnect_endpoint()
+            if local_protocol.name in connections.devices:
+                connections.set_device_available(local_protocol.name)
+            else:
+                local_protocol.sendLine('DD:')
+
+        connections.notify_all_about_available_devices()
+
+
+class WorkerFactory(ClientFactory):
+
+    def __init__(self, connections, worker_id, on_connected):
+        self.connections = connections
+        self.worker_id = worker_id
+        self.on_connected = on_connected
+
+    def buildProtocol(self, addr):
+        protocol = WorkerProtocol(self.connections, self.worker_id)
+        protocol.factory = self
+        return protocol
+
+    def connected(self, protocol):
+        self.connections.cluster = protocol
+        self.on_connected()
+
+    def disconnected(self, protocol):
+        self.connections.cluster = None
+        if reactor.running:
+            reactor.stop()
+
+    def clientConnectionFailed(self, connector, reason):
+        logger.error('ERROR - cannot connect to coordinator: {}', reason)
+        if reactor.running:
+            reactor.stop()
+
+
+def listen_reuse_port(port, factory):
+    """
+    listens on port shared with other processes by SO_REUSEPORT so the
+    kernel balances incoming connections between workers
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.setblocking(False)
+    sock.bind(('', port))
+    sock.listen(socket.SOMAXCONN)
+
+    listening_port = reactor.adoptStreamPort(
+        sock.fileno(), socket.AF_INET, factory
+    )
+    sock.close()
+    return listening_port
+
+
+def start_worker(connections, coordinator_path, worker_id, port, factory):
+    reactor.connectUNIX(
+        coordinator_path,
+        WorkerFactory(
+            connections,
+            worker_id,
+            lambda: listen_reuse_port(port, factory),
+        )
+    )
+
+
+class WorkerProcessProtocol(ProcessProtocol):
+    """
+    spawns worker process again once it ends (e.g. after losing its link
+    to the coordinator), unless the coordinator is shutting down
+
+    respawns back off exponentially while the worker keeps failing (ends
+    before STABLE_WORKER_TIME), once it failed MAX_RESPAWNS times in a
+    row the coordinator is stopped
+
+    clock - reactor spawning the process (reactor by default)
+    """
+
+    def __init__(self, worker_id, args, failures=0, clock=None):
+        self.worker_id = worker_id
+        self.args = args
+        self.failures = failures
+        self.clock = clock or reactor
+        self.started = None
+
+    def processEnded(self, reason):
+        logger.error('ERROR - worker {} ended: {}', self.worker_id, reason)
+        clock = self.clock
+        if not clock.running:
+            return
+
+        failures = self.failures
+        if clock.seconds() - self.started >= STABLE_WORKER_TIME:
+            failures = 0
+
+        if failures >= MAX_RESPAWNS:
+            logger.error(
+                'ERROR - worker {} failed {} times, stopping',
+                self.worker_id, failures
+            )
+            clock.stop()
+            return
+
+        delay = min(RESPAWN_DELAY * 2 ** failures, MAX_RESPAWN_DELAY)
+        clock.callLater(delay, self.respawn, failures + 1)
+
+    def respawn(self, failures):
+        if self.clock.running:
+            WorkerProcessProtocol(
+                self.worker_id, self.args, failures, self.clock
+            ).spawn()
+
+    def spawn(self):
+        self.started = self.clock.seconds()
+        self.clock.spawnProcess(
+            self,
+            sys.executable,
+            self.args,
+            env=os.environ,
+            childFDs={0: 'w', 1: 1, 2: 2},
+        )
+
+
+def start_coordinator(workers, worker_args):
+    """
+    listens for workers on unix socket and spawns worker processes,
+    each of them runs rover server with given worker_args
+    """
+    socket_dir = tempfile.mkdtemp(prefix='rover_server_')
+    coordinator_path = os.path.join(socket_dir, 'coordinator.sock')
+    reactor.listenUNIX(coordinator_path, CoordinatorFactory())
+    reactor.addSystemEventTrigger(
+        'after', 'shutdown', shutil.rmtree, socket_dir, True
+    )
+
+    for worker_id in range(workers):
+        args = [sys.executable, '-m', 'rover_server.server'] + worker_args
+        args += [
+            '--workers', '0',
+            '--coordinator', coordinator_path,
+            '--worker-id', str(worker_id),
+        ]
+        WorkerProcessProtocol(worker_id, args).spawn()
@@ -0,0 +1,69 @@
+"""
+compression of RE communicates
+
+codecs negotiated by clients with ZC, compressed communicates are sent
+as RZ binary frames with compressed body of RE communicate
+
+ZLIB - zlib stream per connection and direction, every communicate is
+    compressed in context of previous ones (Z_SYNC_FLUSH after each of
+    them), best ratio for small similar communicates, costs about 300 KB
+    of memory per connection
+ZLIB_MSG - every communicate is a separate zlib stream, compressed body
+    does not depend on the connection, so it is forwarded untouched
+    between endpoints which both negotiated ZLIB_MSG
+"""
+
+import zlib
+
+from rover_server.framing import MAX_FRAME_LENGTH
+
+
+COMPRESSION_LEVEL = 6
+
+
+class ZlibStream(object):
+
+    __slots__ = ('compressor', 'decompressor')
+
+    name = 'ZLIB'
+    passthrough = False
+
+    def __init__(self):
+        self.compressor = zlib.compressobj(COMPRESSION_LEVEL)
+        self.decompressor = zlib.decompressobj()
+
+    def compress(self, data):
+        compressor = self.compressor
+        return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def decompress(self, data):
+        return decompress_limited(self.decompressor, data)
+
+
+class ZlibMessage(object):
+
+    __slots__ = ()
+
+    name = 'ZLIB_MSG'
+    passthrough = True
+
+    def compress(self, data):
+        return zlib.compress(data, COMPRESSION_LEVEL)
+
+    def decompress(self, data):
+        return decompress_limited(zlib.decompressobj(), data)
+
+
+CODECS = {
+    ZlibStream.name: ZlibStream,
+    ZlibMessage.name: ZlibMessage,
+}
+
+
+def decompress_limited(decompressor, data):
+    #communicate inflating beyond the largest frame is rejected
+    plain = decompressor.decompress(data, MAX_FRAME_LENGTH)
+    if decompressor.unconsumed_tail:
+        raise zlib.error('decompressed communicate too long')
+
+    return plain
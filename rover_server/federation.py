@@ -0,0 +1,190 @@
+from twisted.internet import reactor
+from twisted.internet.protocol import Factory
+from twisted.internet.protocol import ReconnectingClientFactory
+
+from rover_server.cluster import WorkerProtocol
+from rover_server.logger import logger
+
+
+class Federation(object):
+    """
+    registry of links to other nodes of federation
+
+    installed as cluster of node's connections registry in place of the
+    coordinator of worker processes, nodes form a full mesh of persistent
+    links, every node announces availability of its own devices to all
+    the others and RE communicates of clients paired across nodes are
+    tunnelled through the link of the two nodes, so every link is shared
+    by all such pairings
+
+    there is no global name registry, name of a remote available device
+    cannot be claimed by local client, names of clients which are not
+    available devices have to be unique across nodes by convention,
+    pairing with remote client whose name is used by local client fails
+    and such remote device is not announced to local controllers
+    """
+
+    def __init__(self, connections, node_id):
+        self.connections = connections
+        self.node_id = node_id
+        self.links = {}
+
+        connections.cluster = self
+
+    def add_link(self, link):
+        if link.node_id == self.node_id or link.node_id in self.links:
+            logger.error('ERROR - duplicate link to node {}', link.node_id)
+            return False
+
+        self.links[link.node_id] = link
+        logger.info('node {} joined', link.node_id)
+
+        #announce local devices to the new node
+        connections = self.connections
+        for name in connections.available_devices:
+            if name in connections.devices:
+                link.device_available(name)
+        return True
+
+    def remove_link(self, link):
+        if self.links.get(link.node_id) is not link:
+            return
+
+        del self.links[link.node_id]
+        logger.info('node {} lost', link.node_id)
+        link.worker_lost(link.node_id)
+
+    def get_device_link(self, name):
+        for link in self.links.values():
+            if name in link.remote_devices:
+                return link
+
+        return None
+
+    def claim_name(self, name, callback):
+        if self.get_device_link(name) is not None:
+            callback('E_11')
+        else:
+            callback(0)
+
+    def release_name(self, name):
+        pass
+
+    def device_available(self, name):
+        for link in self.links.values():
+            link.device_available(name)
+
+    def device_unavailable(self, name):
+        for link in self.links.values():
+            link.device_unavailable(name)
+
+    def is_remote_device(self, name):
+        return self.get_device_link(name) is not None
+
+    def connect_remote_device(self, controller_protocol, device_name):
+        self.get_device_link(device_name).connect_remote_device(
+            controller_protocol, device_name
+        )
+
+
+class FederationLink(WorkerProtocol):
+    """
+    link to other node of federation, the same on both ends
+
+    link request structure:
+    <command>:<request-body>
+
+    link commands:
+    HI:<node-id> - node introduces itself, sent first by both nodes
+    DA:<name> - device of the node became available
+    DR:<name> - device of the node is no longer available
+    FW:<target-name>:<op>:<data> - forwarded op (see WorkerProtocol) for
+        client connected to the other node
+    """
+
+    node_id = None
+
+    def __init__(self, federation):
+        WorkerProtocol.__init__(
+            self, federation.connections, federation.node_id
+        )
+        self.federation = federation
+
+    def connectionMade(self):
+        self.sendLine('HI:' + self.worker_id)
+
+    def connectionLost(self, reason):
+        if self.node_id is not None:
+            self.federation.remove_link(self)
+
+    def lineReceived(self, line):
+        command = line[:2]
+        body = line[3:]
+
+        if self.node_id is None:
+            if command != 'HI':
+                logger.error('ERROR - node did not introduce itself')
+                self.transport.loseConnection()
+                return
+
+            self.node_id = body
+            if not self.federation.add_link(self):
+                self.node_id = None
+                self.transport.loseConnection()
+
+        elif command == 'DA':
+            self.remote_device_available(self.node_id, body)
+
+        elif command == 'DR':
+            self.remote_device_unavailable(body)
+
+        elif command == 'FW':
+            target_name, op, data = body.split(':', 2)
+            self.forwarded(self.node_id, target_name, op, data)
+
+        else:
+            logger.error('ERROR - invalid link command {}', line)
+
+
+class FederationFactory(Factory):
+    """
+    accepts links from other nodes
+    """
+
+    def __init__(self, federation):
+        self.federation = federation
+
+    def buildProtocol(self, addr):
+        return FederationLink(self.federation)
+
+
+class PeerFactory(ReconnectingClientFactory):
+    """
+    keeps link to other node, reconnecting once it is lost
+    """
+
+    maxDelay = 10
+
+    def __init__(self, federation):
+        self.federation = federation
+
+    def buildProtocol(self, addr):
+        self.resetDelay()
+        return FederationLink(self.federation)
+
+
+def start_federation(connections, node_id, node_port, peers):
+    """
+    listens for links of other nodes on node_port and links to peers
+    given as (host, port), every pair of nodes should be linked once,
+    i.e. only one node of the pair lists the other one as its peer
+    """
+    federation = Federation(connections, node_id)
+
+    if node_port > 0:
+        reactor.listenTCP(node_port, FederationFactory(federation))
+
+    for host, port in peers:
+        reactor.connectTCP(host, port, PeerFactory(federation))
+
+    return federation
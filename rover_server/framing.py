@@ -0,0 +1,174 @@
+"""
+binary framing
+
+frame structure:
+<length><opcode><body>
+
+length - 4 bytes, big endian, size of opcode and body
+opcode - 1 byte, command of the frame
+body - request body, may contain any bytes including line delimiters
+
+frames with TEXT_OPCODE carry whole text line (<command>:<request-body>)
+as their body, used for commands without dedicated opcode
+
+body containing TEXT_DELIMITER cannot be passed to text client, it
+would split the line into forged ones
+
+the same frames carry lines of links between worker processes and
+federation nodes, whose lines wrap client lines of any content
+"""
+
+import struct
+
+from twisted.internet.protocol import Protocol
+
+
+FRAME_HEADER = struct.Struct('!IB')
+FRAME_HEADER_SIZE = FRAME_HEADER.size
+MAX_FRAME_LENGTH = 1048576
+#forwarded client frame with prefix of link line (op and names)
+MAX_LINK_FRAME_LENGTH = MAX_FRAME_LENGTH + 4096
+
+TEXT_OPCODE = 0x00
+
+#delimiter of lines of text clients
+TEXT_DELIMITER = '\r\n'
+
+COMMAND_OPCODES = {
+    'DC': 0x01,
+    'CC': 0x02,
+    'CD': 0x03,
+    'RE': 0x04,
+    'NM': 0x05,
+    'HB': 0x06,
+    'RZ': 0x07,
+    'DL': 0x10,
+    'DA': 0x11,
+    'DR': 0x12,
+    'DD': 0x13,
+    'SE': 0x14,
+}
+
+OPCODE_COMMANDS = dict(
+    (opcode, command) for command, opcode in COMMAND_OPCODES.items()
+)
+
+
+def encode_frame(line):
+    opcode = COMMAND_OPCODES.get(line[:2])
+    if opcode is None:
+        opcode = TEXT_OPCODE
+        body = line
+    else:
+        body = line[3:]
+
+    return FRAME_HEADER.pack(len(body) + 1, opcode) + body
+
+
+def decode_frame(opcode, body):
+    if opcode == TEXT_OPCODE:
+        return body
+
+    command = OPCODE_COMMANDS.get(opcode)
+    if command is None:
+        return ''
+
+    return command + ':' + body
+
+
+def decode_frames(buffer, frame_received, max_length=MAX_FRAME_LENGTH):
+    """
+    calls frame_received with every complete frame from buffer,
+    returns unprocessed rest of buffer or None on invalid frame length
+    """
+    offset = 0
+    buffer_size = len(buffer)
+
+    while buffer_size - offset >= FRAME_HEADER_SIZE:
+        length, opcode = FRAME_HEADER.unpack_from(buffer, offset)
+        if length < 1 or length > max_length:
+            return None
+
+        frame_end = offset + FRAME_HEADER_SIZE - 1 + length
+        if frame_end > buffer_size:
+            break
+
+        frame_received(opcode, buffer[offset + FRAME_HEADER_SIZE:frame_end])
+        offset = frame_end
+
+    return buffer[offset:]
+
+
+class FrameBuffer(object):
+    """
+    data received from single connection, chunks are joined only once
+    they hold the whole next frame, so large frame received in many
+    chunks is not copied again with every chunk
+    """
+
+    __slots__ = ('chunks', 'size', 'needed', 'max_length')
+
+    def __init__(self, max_length=MAX_FRAME_LENGTH):
+        self.chunks = []
+        self.size = 0
+        self.needed = FRAME_HEADER_SIZE
+        self.max_length = max_length
+
+    def feed(self, data, frame_received):
+        """
+        calls frame_received with every completed frame, returns False on
+        invalid frame length
+        """
+        self.chunks.append(data)
+        self.size += len(data)
+        if self.size < self.needed:
+            return True
+
+        rest = decode_frames(
+            ''.join(self.chunks), frame_received, self.max_length
+        )
+        if rest is None:
+            self.chunks = []
+            self.size = 0
+            self.needed = FRAME_HEADER_SIZE
+            return False
+
+        self.chunks = [rest] if rest else []
+        self.size = len(rest)
+
+        #header of incomplete frame was already checked by decode_frames
+        if self.size >= FRAME_HEADER_SIZE:
+            self.needed = FRAME_HEADER_SIZE - 1 + \
+                FRAME_HEADER.unpack_from(rest)[0]
+        else:
+            self.needed = FRAME_HEADER_SIZE
+        return True
+
+
+class FrameReceiver(Protocol):
+    """
+    protocol exchanging lines in frames, so lines may contain any bytes
+    including line delimiters
+
+    every received frame is decoded to line and passed to lineReceived,
+    which is not defined here, subclasses (links of workers and nodes)
+    have to define it
+    """
+
+    frame_buffer = None
+
+    def dataReceived(self, data):
+        if self.frame_buffer is None:
+            self.frame_buffer = FrameBuffer(MAX_LINK_FRAME_LENGTH)
+
+        if not self.frame_buffer.feed(data, self.frameReceived):
+            self.invalidFrameReceived()
+
+    def frameReceived(self, opcode, body):
+        self.lineReceived(decode_frame(opcode, body))
+
+    def invalidFrameReceived(self):
+        self.transport.loseConnection()
+
+    def sendLine(self, line):
+        self.transport.write(encode_frame(line))
@@ -0,0 +1,115 @@
+from twisted.python import log
+from twisted.internet import reactor
+from twisted.internet import task
+
+
+DEBUG = 10
+INFO = 20
+ERROR = 40
+
+LEVELS = {
+    'debug': DEBUG,
+    'info': INFO,
+    'error': ERROR,
+}
+
+
+class Logger(object):
+    """
+    thin wrapper over twisted log with levels and lazy formatting
+
+    messages are formatted only when their level is enabled, so disabled
+    calls on the relay path cost a single comparison
+
+    sampling:
+    sample_rates maps a key (e.g. client command) to n, only every n-th
+    message logged with that key through is_sampled passes
+    """
+
+    def __init__(self, level=DEBUG):
+        self.level = level
+        self.sample_rates = {}
+        self.sample_counters = {}
+
+    def is_enabled(self, level):
+        return level >= self.level
+
+    def is_sampled(self, level, key):
+        if level < self.level:
+            return False
+
+        rate = self.sample_rates.get(key)
+        if rate is None:
+            return True
+
+        counter = self.sample_counters.get(key, 0)
+        self.sample_counters[key] = counter + 1
+        return counter % rate == 0
+
+    def set_sample_rate(self, key, rate):
+        self.sample_rates[key] = rate
+        self.sample_counters[key] = 0
+
+    def debug(self, message, *args):
+        if DEBUG >= self.level:
+            log.msg(message.format(*args))
+
+    def info(self, message, *args):
+        if INFO >= self.level:
+            log.msg(message.format(*args))
+
+    def error(self, message, *args):
+        if ERROR >= self.level:
+            log.err(message.format(*args))
+
+
+class BufferedLogFile(object):
+    """
+    file-like log sink which keeps log lines in memory and writes them
+    to the wrapped file every flush_interval seconds or once buffer
+    exceeds max_size bytes, so logging does not block the relay on
+    terminal I/O for every message
+    """
+
+    def __init__(self, log_file, flush_interval, max_size=65536, clock=None):
+        self.log_file = log_file
+        self.flush_interval = flush_interval
+        self.max_size = max_size
+        self.buffer = []
+        self.size = 0
+
+        self.flush_loop = task.LoopingCall(self.flush_buffer)
+        self.flush_loop.clock = clock or reactor
+
+    def start(self):
+        self.flush_loop.start(self.flush_interval, now=False)
+
+    def stop(self):
+        if self.flush_loop.running:
+            self.flush_loop.stop()
+        self.flush_buffer()
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.size += len(data)
+        if self.size >= self.max_size:
+            self.flush_buffer()
+
+    def flush(self):
+        #log observer flushes after every message, buffer is flushed
+        #by the timer or size threshold instead
+        pass
+
+    def flush_buffer(self):
+        if not self.buffer:
+            return
+
+        data = ''.join(self.buffer)
+        self.buffer = []
+        self.size = 0
+
+        self.log_file.write(data)
+        self.log_file.flush()
+
+
+logger = Logger()
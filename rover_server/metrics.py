@@ -0,0 +1,330 @@
+from bisect import bisect_left
+
+from twisted.internet import reactor
+from twisted.web.resource import Resource
+from twisted.web.server import Site
+
+
+CLIENT_COMMANDS = (
+    'DC', 'CC', 'CD', 'RE', 'NM', 'BF', 'LW', 'RS', 'HB', 'SB', 'US',
+    'ZC', 'RZ', 'TQ',
+)
+
+LATENCY_BUCKETS = (
+    0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0,
+)
+FANOUT_BUCKETS = (0, 1, 5, 10, 50, 100, 500, 1000, 5000, 10000)
+
+
+class Histogram(object):
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, help_text, lines):
+        lines.append('# HELP {} {}'.format(name, help_text))
+        lines.append('# TYPE {} histogram'.format(name))
+
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append('{}_bucket{{le="{}"}} {}'.format(
+                name, bound, cumulative
+            ))
+        lines.append('{}_bucket{{le="+Inf"}} {}'.format(name, self.count))
+        lines.append('{}_sum {}'.format(name, self.sum))
+        lines.append('{}_count {}'.format(name, self.count))
+
+
+class Metrics(object):
+    """
+    counters of connections registries in Prometheus text format
+
+    hot path methods only update dicts and ints, gauges like registry
+    sizes and transport buffers are computed when metrics are rendered
+
+    client names are unique only within a registry, so per-client
+    counters are kept per registry and rendered with index of the
+    registry in order of add_registry (order of server ports)
+    """
+
+    def __init__(self):
+        self.lines = dict((command, 0) for command in CLIENT_COMMANDS)
+        self.invalid_lines = 0
+        self.errors = {}
+
+        #registry -> sender name -> receiver name -> bytes, senders_of
+        #maps registry and receiver to its senders, so pairings of a
+        #client are dropped directly
+        self.relayed_bytes = {}
+        self.senders_of = {}
+        self.spliced_chunks = 0
+        self.spliced_bytes = 0
+        self.forward_latency = Histogram(LATENCY_BUCKETS)
+
+        self.broadcast_fanout = Histogram(FANOUT_BUCKETS)
+        self.broadcast_duration = Histogram(LATENCY_BUCKETS)
+
+        #keyed by direction, in - from clients, out - to clients
+        self.plain_bytes = {'in': 0, 'out': 0}
+        self.compressed_bytes = {'in': 0, 'out': 0}
+        self.compression_seconds = {'in': 0, 'out': 0}
+        self.passthrough_bytes = 0
+
+        self.registries = []
+
+    def add_registry(self, connections):
+        self.registries.append(connections)
+        connections.metrics = self
+        for command in connections.handlers:
+            self.add_command(command)
+
+    def add_command(self, command):
+        self.lines.setdefault(command, 0)
+
+    def line_received(self, command):
+        lines = self.lines
+        if command in lines:
+            lines[command] += 1
+        else:
+            self.invalid_lines += 1
+
+    def error(self, code):
+        self.errors[code] = self.errors.get(code, 0) + 1
+
+    def relayed(self, connections, sender_name, receiver_name, size,
+                latency):
+        relayed_bytes = self.relayed_bytes.get(connections)
+        if relayed_bytes is None:
+            relayed_bytes = self.relayed_bytes[connections] = {}
+            self.senders_of[connections] = {}
+
+        receivers = relayed_bytes.get(sender_name)
+        if receivers is None:
+            receivers = relayed_bytes[sender_name] = {}
+
+        if receiver_name in receivers:
+            receivers[receiver_name] += size
+        else:
+            receivers[receiver_name] = size
+            self.senders_of[connections].setdefault(
+                receiver_name, set()
+            ).add(sender_name)
+        self.forward_latency.observe(latency)
+
+    def spliced(self, size):
+        self.spliced_chunks += 1
+        self.spliced_bytes += size
+
+    def broadcasted(self, fanout, duration):
+        self.broadcast_fanout.observe(fanout)
+        self.broadcast_duration.observe(duration)
+
+    def compressed(self, plain_size, size, duration):
+        self.plain_bytes['out'] += plain_size
+        self.compressed_bytes['out'] += size
+        self.compression_seconds['out'] += duration
+
+    def decompressed(self, plain_size, size, duration):
+        self.plain_bytes['in'] += plain_size
+        self.compressed_bytes['in'] += size
+        self.compression_seconds['in'] += duration
+
+    def passed_through(self, size):
+        self.passthrough_bytes += size
+
+    def protocol_disconnected(self, connections, name):
+        #pairings of disconnected client are not reported anymore
+        relayed_bytes = self.relayed_bytes.get(connections)
+        if relayed_bytes is None:
+            return
+        senders_of = self.senders_of[connections]
+
+        for receiver_name in relayed_bytes.pop(name, ()):
+            senders = senders_of[receiver_name]
+            senders.discard(name)
+            if not senders:
+                del senders_of[receiver_name]
+
+        for sender_name in senders_of.pop(name, ()):
+            receivers = relayed_bytes[sender_name]
+            del receivers[name]
+            if not receivers:
+                del relayed_bytes[sender_name]
+
+    def render(self):
+        lines = []
+
+        self.render_metric(
+            lines, 'rover_lines_received_total', 'counter',
+            'lines received from clients by command',
+            [('command="{}"'.format(command), count)
+             for command, count in sorted(self.lines.items())] +
+            [('command="invalid"', self.invalid_lines)]
+        )
+        self.render_metric(
+            lines, 'rover_errors_total', 'counter',
+            'error responses sent to clients by code',
+            [('code="{}"'.format(code), count)
+             for code, count in sorted(self.errors.items())]
+        )
+        self.render_metric(
+            lines, 'rover_relayed_bytes_total', 'counter',
+            'RE bytes relayed between paired clients',
+            [('registry="{}",sender="{}",receiver="{}"'.format(
+                  index, sender, receiver), size)
+             for index, connections in enumerate(self.registries)
+             for sender, receivers in sorted(
+                 self.relayed_bytes.get(connections, {}).items())
+             for receiver, size in sorted(receivers.items())]
+        )
+        self.render_metric(
+            lines, 'rover_spliced_chunks_total', 'counter',
+            'chunks forwarded by splice relay', [('', self.spliced_chunks)]
+        )
+        self.render_metric(
+            lines, 'rover_spliced_bytes_total', 'counter',
+            'bytes forwarded by splice relay', [('', self.spliced_bytes)]
+        )
+        self.forward_latency.render(
+            'rover_forward_latency_seconds',
+            'time from receiving RE line to handing it to endpoint',
+            lines
+        )
+        self.broadcast_fanout.render(
+            'rover_broadcast_fanout',
+            'controllers notified by single devices list broadcast',
+            lines
+        )
+        self.broadcast_duration.render(
+            'rover_broadcast_duration_seconds',
+            'time spent on single devices list broadcast',
+            lines
+        )
+
+        for name, help_text, values in (
+                ('rover_compression_plain_bytes_total',
+                 'RE bodies before compression or after decompression',
+                 self.plain_bytes),
+                ('rover_compression_compressed_bytes_total',
+                 'compressed RZ bodies', self.compressed_bytes),
+                ('rover_compression_seconds_total',
+                 'time spent compressing and decompressing',
+                 self.compression_seconds)):
+            self.render_metric(
+                lines, name, 'counter', help_text,
+                [('direction="{}"'.format(direction), value)
+                 for direction, value in sorted(values.items())]
+            )
+        self.render_metric(
+            lines, 'rover_compression_passthrough_bytes_total', 'counter',
+            'RZ bodies forwarded without recompression',
+            [('', self.passthrough_bytes)]
+        )
+
+        self.render_registries(lines)
+
+        return '\n'.join(lines) + '\n'
+
+    def render_registries(self, lines):
+        devices = controllers = available = suppressed = 0
+        throttled = {}
+        queued = buffered = max_buffered = 0
+
+        for connections in self.registries:
+            devices += len(connections.devices)
+            controllers += len(connections.controllers)
+            available += len(connections.available_devices)
+            suppressed += connections.suppressed_broadcasts
+            if connections.rate_limiter is not None:
+                for command, count in \
+                        connections.rate_limiter.throttled_lines.items():
+                    throttled[command] = throttled.get(command, 0) + count
+
+            for protocol in connections.protocols.values():
+                if protocol.remote:
+                    continue
+
+                queued += protocol.outbox_size
+                size = get_write_buffer_size(protocol.transport)
+                buffered += size
+                max_buffered = max(max_buffered, size)
+
+        self.render_metric(
+            lines, 'rover_throttled_lines_total', 'counter',
+            'client lines shed or delayed by rate limits by command',
+            [('command="{}"'.format(command), count)
+             for command, count in sorted(throttled.items())]
+        )
+        self.render_metric(
+            lines, 'rover_broadcasts_suppressed_total', 'counter',
+            'devices list notifications skipped as nothing changed',
+            [('', suppressed)]
+        )
+
+        for name, help_text, value in (
+                ('rover_devices', 'connected devices', devices),
+                ('rover_controllers', 'connected controllers', controllers),
+                ('rover_available_devices', 'unpaired devices', available),
+                ('rover_queued_bytes',
+                 'bytes queued by flow control', queued),
+                ('rover_transport_buffer_bytes',
+                 'bytes in transport write buffers', buffered),
+                ('rover_transport_buffer_max_bytes',
+                 'largest transport write buffer', max_buffered)):
+            self.render_metric(lines, name, 'gauge', help_text, [('', value)])
+
+    def render_metric(self, lines, name, metric_type, help_text, samples):
+        lines.append('# HELP {} {}'.format(name, help_text))
+        lines.append('# TYPE {} {}'.format(name, metric_type))
+        for labels, value in samples:
+            if labels:
+                lines.append('{}{{{}}} {}'.format(name, labels, value))
+            else:
+                lines.append('{} {}'.format(name, value))
+
+
+def get_write_buffer_size(transport):
+    """
+    bytes written to transport and not sent yet, twisted transports have
+    no public interface for it, so their buffers are measured
+    """
+    get_size = getattr(transport, 'get_write_buffer_size', None)
+    if get_size is not None:
+        return get_size()
+
+    data_buffer = getattr(transport, 'dataBuffer', None)
+    if data_buffer is None:
+        return 0
+
+    return len(data_buffer) - transport.offset + transport._tempDataLen
+
+
+class MetricsResource(Resource):
+
+    isLeaf = True
+
+    def __init__(self, metrics):
+        Resource.__init__(self)
+        self.metrics = metrics
+
+    def render_GET(self, request):
+        request.setHeader(
+            'Content-Type', 'text/plain; version=0.0.4; charset=utf-8'
+        )
+        return self.metrics.render()
+
+
+def listen_metrics(port, metrics):
+    return reactor.listenTCP(
+        port, Site(MetricsResource(metrics)), interface='127.0.0.1'
+    )
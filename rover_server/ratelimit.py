@@ -0,0 +1,131 @@
+from twisted.internet import reactor
+
+
+ALL_COMMANDS = '*'
+
+
+class TokenBucket(object):
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, count, now):
+        #refilled lazily from time elapsed since the last line
+        tokens = self.tokens + (now - self.updated) * self.rate
+        self.tokens = min(tokens, self.burst) - count
+        self.updated = now
+        return self.tokens >= 0
+
+    def refund(self, count):
+        self.tokens += count
+
+    def is_refilled(self, now):
+        return self.tokens + (now - self.updated) * self.rate >= 0
+
+
+class RateLimiter(object):
+    """
+    token-bucket limits of lines sent by every client
+
+    rates maps client command (or ALL_COMMANDS for every line) to
+    (rate, burst), rate in lines per second, buckets of a connection are
+    created with its first limited line and there is no timer per
+    connection
+
+    excess lines are shed (dropped) or, with delay, the line is handled
+    and reading from the client is paused until its bucket refills, all
+    paused clients are checked by a single timer every resume_interval
+    and resumed once their buckets are refilled, throttled_lines counts
+    shed or delayed lines per command
+    """
+
+    def __init__(self, rates, delay=False, clock=None, resume_interval=0.01):
+        self.rates = rates
+        self.delay = delay
+        self.clock = clock or reactor
+        self.resume_interval = resume_interval
+
+        self.throttled = set()
+        self.resume_call = None
+        self.throttled_lines = {}
+
+    def take(self, protocol, command, count=1, in_debt=False):
+        """
+        takes count tokens from buckets of command and of all lines,
+        when any of them runs out the tokens are returned unless in_debt
+        """
+        buckets = protocol.rate_buckets
+        if buckets is None:
+            buckets = protocol.rate_buckets = {}
+
+        now = self.clock.seconds()
+        allowed = True
+        taken = []
+        for key in (command, ALL_COMMANDS):
+            limit = self.rates.get(key)
+            if limit is None:
+                continue
+
+            bucket = buckets.get(key)
+            if bucket is None:
+                bucket = buckets[key] = TokenBucket(limit[0], limit[1], now)
+
+            taken.append(bucket)
+            if not bucket.take(count, now):
+                allowed = False
+
+        if not allowed and not in_debt:
+            for bucket in taken:
+                bucket.refund(count)
+
+        return allowed
+
+    def allow(self, protocol, command):
+        if self.take(protocol, command, in_debt=self.delay):
+            return True
+
+        throttled_lines = self.throttled_lines
+        throttled_lines[command] = throttled_lines.get(command, 0) + 1
+
+        if self.delay:
+            self.throttle(protocol)
+            return True
+
+        return False
+
+    def throttle(self, protocol):
+        protocol.pause_reading('rate')
+        self.throttled.add(protocol)
+
+        if self.resume_call is None:
+            self.resume_call = self.clock.callLater(
+                self.resume_interval, self.resume_throttled
+            )
+
+    def resume_throttled(self):
+        self.resume_call = None
+        throttled = self.throttled
+        self.throttled = set()
+
+        now = self.clock.seconds()
+        for protocol in throttled:
+            if not protocol.connected:
+                continue
+
+            for bucket in protocol.rate_buckets.values():
+                if not bucket.is_refilled(now):
+                    self.throttle(protocol)
+                    break
+            else:
+                protocol.resume_reading('rate')
+
+    def stop(self):
+        if self.resume_call is not None:
+            self.resume_call.cancel()
+            self.resume_call = None
+        self.throttled = set()
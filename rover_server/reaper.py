@@ -0,0 +1,71 @@
+from twisted.internet import reactor
+from twisted.internet import task
+
+
+class IdleReaper(object):
+    """
+    timer wheel which disconnects connections silent for idle_timeout
+
+    wheel has slots_count slots, every tick one slot is checked,
+    protocols active since they were put there (their idle_tick is newer)
+    are moved to the slot due after their last activity, the rest is reaped
+
+    marking activity is a single attribute assignment on the protocol:
+    protocol.idle_tick = reaper.tick
+    so there is no timer per connection, only one per registry,
+    silent connection is reaped after idle_timeout to
+    idle_timeout * (1 + 1 / slots_count) seconds
+    """
+
+    def __init__(self, idle_timeout, reap, slots_count=10, clock=None):
+        self.reap = reap
+        self.slots_count = slots_count
+        self.slots = [set() for _ in range(slots_count)]
+        self.tick = 0
+
+        self.tick_loop = task.LoopingCall.withCount(self.advance)
+        self.tick_loop.clock = clock or reactor
+        self.tick_interval = float(idle_timeout) / slots_count
+
+    def add(self, protocol):
+        if not self.tick_loop.running:
+            self.tick_loop.start(self.tick_interval, now=False)
+
+        protocol.idle_tick = self.tick
+        protocol.idle_slot = (self.tick + 1) % self.slots_count
+        self.slots[protocol.idle_slot].add(protocol)
+
+    def remove(self, protocol):
+        self.slots[protocol.idle_slot].discard(protocol)
+
+    def advance(self, count=1):
+        #ticks missed while reactor was busy are checked too, once whole
+        #wheel is due the rest of them can be skipped
+        if count > self.slots_count:
+            self.tick += count - self.slots_count
+            count = self.slots_count
+
+        for _ in range(count):
+            self.tick += 1
+            self.check_slot(self.tick)
+
+    def check_slot(self, tick):
+        slots_count = self.slots_count
+
+        #protocol last seen at idle_tick is due at idle_tick + slots_count
+        #+ 1 and lives in the slot checked at that tick
+        slot_index = tick % slots_count
+        due = self.slots[slot_index]
+        self.slots[slot_index] = set()
+
+        for protocol in due:
+            if protocol.idle_tick + slots_count + 1 > tick:
+                protocol.idle_slot = (protocol.idle_tick + 1) % slots_count
+                self.slots[protocol.idle_slot].add(protocol)
+            else:
+                self.reap(protocol)
+
+    def stop(self):
+        if self.tick_loop.running:
+            self.tick_loop.stop()
+        self.slots = [set() for _ in range(self.slots_count)]
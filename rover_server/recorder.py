@@ -0,0 +1,116 @@
+"""
+recording of client traffic
+
+record structure:
+<timestamp><connection-id><event><length><data>
+
+timestamp - 8 bytes, big endian double, clock seconds of the event
+connection-id - 4 bytes, big endian, unique within the recording
+event - 1 byte, CONNECT_EVENT, LINE_EVENT or DISCONNECT_EVENT
+length - 4 bytes, big endian, size of data
+data - line received from the client (without delimiter), empty for
+    other events
+"""
+
+import struct
+
+from twisted.internet import reactor
+from twisted.internet import task
+
+
+RECORD_HEADER = struct.Struct('!dIBI')
+RECORD_HEADER_SIZE = RECORD_HEADER.size
+
+CONNECT_EVENT = 1
+LINE_EVENT = 2
+DISCONNECT_EVENT = 3
+
+
+class Recorder(object):
+    """
+    appends traffic of clients of connections registries to binary log
+
+    records are only packed and appended to memory buffer on the relay
+    path, the buffer is written to log file every flush_interval seconds
+    or once it exceeds max_size bytes
+    """
+
+    def __init__(self, log_file, flush_interval=1.0, max_size=1048576,
+                 clock=None):
+        self.log_file = log_file
+        self.flush_interval = flush_interval
+        self.max_size = max_size
+        self.clock = clock or reactor
+        self.buffer = []
+        self.size = 0
+        self.last_id = 0
+
+        self.flush_loop = task.LoopingCall(self.flush_buffer)
+        self.flush_loop.clock = self.clock
+
+    def add_registry(self, connections):
+        connections.recorder = self
+
+    def start(self):
+        self.flush_loop.start(self.flush_interval, now=False)
+
+    def stop(self):
+        if self.flush_loop.running:
+            self.flush_loop.stop()
+        self.flush_buffer()
+
+    def connection_made(self, protocol):
+        self.last_id += 1
+        protocol.record_id = self.last_id
+        self.record(protocol, CONNECT_EVENT, '')
+
+    def line_received(self, protocol, line):
+        self.record(protocol, LINE_EVENT, line)
+
+    def lines_received(self, protocol, data):
+        #chunk of complete lines forwarded by splice relay
+        for line in data.split(protocol.delimiter)[:-1]:
+            self.record(protocol, LINE_EVENT, line)
+
+    def connection_lost(self, protocol):
+        self.record(protocol, DISCONNECT_EVENT, '')
+
+    def record(self, protocol, event, data):
+        self.buffer.append(RECORD_HEADER.pack(
+            self.clock.seconds(), protocol.record_id, event, len(data)
+        ))
+        self.buffer.append(data)
+        self.size += RECORD_HEADER_SIZE + len(data)
+
+        if self.size >= self.max_size:
+            self.flush_buffer()
+
+    def flush_buffer(self):
+        if not self.buffer:
+            return
+
+        data = ''.join(self.buffer)
+        self.buffer = []
+        self.size = 0
+
+        self.log_file.write(data)
+        self.log_file.flush()
+
+
+def read_records(log_file):
+    """
+    yields (timestamp, connection_id, event, data) of every record,
+    incomplete record at the end of log is ignored
+    """
+    while True:
+        header = log_file.read(RECORD_HEADER_SIZE)
+        if len(header) < RECORD_HEADER_SIZE:
+            return
+
+        timestamp, connection_id, event, length = \
+            RECORD_HEADER.unpack(header)
+        data = log_file.read(length)
+        if len(data) < length:
+            return
+
+        yield timestamp, connection_id, event, data
@@ -0,0 +1,282 @@
+import sys
+import json
+import time
+import argparse
+
+from twisted.internet import defer
+from twisted.internet import reactor
+from twisted.internet.error import ConnectionDone
+from twisted.python.failure import Failure
+
+from rover_server.server import ProtocolConnections
+from rover_server.server import ServerFactory
+from rover_server.framing import encode_frame
+from rover_server.recorder import CONNECT_EVENT
+from rover_server.recorder import LINE_EVENT
+from rover_server.recorder import DISCONNECT_EVENT
+from rover_server.recorder import read_records
+from rover_server.logger import logger
+from rover_server.logger import ERROR
+
+
+#records handled before giving timers of the server a chance to run
+FAST_CHUNK_SIZE = 1000
+
+
+class ReplayTransport(object):
+    """
+    in-memory transport of replayed client, only counts written bytes
+    """
+
+    disconnecting = False
+
+    def __init__(self):
+        self.written = 0
+
+    def write(self, data):
+        self.written += len(data)
+
+    def writeSequence(self, data):
+        for chunk in data:
+            self.written += len(chunk)
+
+    def loseConnection(self):
+        self.disconnecting = True
+
+    abortConnection = loseConnection
+
+    def registerProducer(self, producer, streaming):
+        pass
+
+    def unregisterProducer(self):
+        pass
+
+    def pauseProducing(self):
+        pass
+
+    def resumeProducing(self):
+        pass
+
+    def setTcpNoDelay(self, enabled):
+        pass
+
+    def getPeer(self):
+        return None
+
+    def getHost(self):
+        return None
+
+
+class Replay(object):
+    """
+    plays recorded client traffic back against server factory in this
+    process, clients use in-memory transports so only the server is
+    measured
+
+    speed scales recorded timeline (1.0 replays it in real time, 2.0
+    twice as fast), speed 0 replays records as fast as possible
+
+    measured:
+    replay_time - time needed to replay all records
+    throughput - replayed lines per second
+    processing latency percentiles - time spent by the server on single
+        line
+    lag percentiles (speed > 0 only) - divergence of replayed records
+        from scaled recorded timeline
+    """
+
+    def __init__(self, records, factory, speed=1.0, clock=None):
+        self.records = iter(records)
+        self.factory = factory
+        self.speed = speed
+        self.clock = clock or reactor
+
+        self.protocols = {}
+        self.transports = []
+        self.lines = 0
+        self.processing_times = []
+        self.lags = []
+
+        self.first_timestamp = None
+        self.last_timestamp = None
+        self.start = None
+        self.next_record = None
+        self.done = defer.Deferred()
+
+    def run(self):
+        self.start = time.time()
+        self.next_record = next(self.records, None)
+        if self.next_record is not None:
+            self.first_timestamp = self.next_record[0]
+        self.step()
+        return self.done
+
+    def step(self):
+        processed = 0
+        now = time.time()
+
+        while self.next_record is not None:
+            timestamp = self.next_record[0]
+
+            if self.speed > 0:
+                due = self.start + \
+                    (timestamp - self.first_timestamp) / self.speed
+                if due > now:
+                    self.clock.callLater(due - now, self.step)
+                    return
+                self.lags.append(now - due)
+            elif processed >= FAST_CHUNK_SIZE:
+                self.clock.callLater(0, self.step)
+                return
+
+            self.replay_record(*self.next_record)
+            self.last_timestamp = timestamp
+            processed += 1
+
+            self.next_record = next(self.records, None)
+            if self.speed > 0:
+                now = time.time()
+
+        self.done.callback(self.get_results())
+
+    def replay_record(self, timestamp, connection_id, event, data):
+        if event == CONNECT_EVENT:
+            protocol = self.factory.buildProtocol(None)
+            transport = ReplayTransport()
+            self.transports.append(transport)
+            self.protocols[connection_id] = protocol
+            protocol.makeConnection(transport)
+            return
+
+        #connection made before the recording started is not replayed
+        protocol = self.protocols.get(connection_id)
+        if protocol is None:
+            return
+
+        if event == LINE_EVENT:
+            if protocol.binary_framing:
+                data = encode_frame(data)
+            else:
+                data += protocol.delimiter
+
+            start = time.time()
+            protocol.dataReceived(data)
+            self.processing_times.append(time.time() - start)
+            self.lines += 1
+        elif event == DISCONNECT_EVENT:
+            del self.protocols[connection_id]
+            protocol.connectionLost(Failure(ConnectionDone()))
+
+    def get_results(self):
+        replay_time = time.time() - self.start
+        recorded_time = 0
+        if self.first_timestamp is not None:
+            recorded_time = self.last_timestamp - self.first_timestamp
+
+        results = {
+            'speed': self.speed,
+            'lines': self.lines,
+            'connections': len(self.transports),
+            'written_bytes': sum(
+                transport.written for transport in self.transports
+            ),
+            'recorded_time': recorded_time,
+            'replay_time': replay_time,
+            'throughput': self.lines / replay_time if replay_time else 0,
+        }
+        results.update(get_percentiles('processing', self.processing_times))
+        results.update(get_percentiles('lag', self.lags))
+        return results
+
+
+def get_percentiles(name, values):
+    if not values:
+        return {}
+
+    values = sorted(values)
+    last = len(values) - 1
+
+    return {
+        name + '_p50': values[int(last * 0.50)],
+        name + '_p99': values[int(last * 0.99)],
+        name + '_max': values[last],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="replays traffic recorded by rover_server --record "
+                    "against the server, prints JSON results"
+    )
+    parser.add_argument(
+        "log",
+        help="binary log written by rover_server --record",
+    )
+    parser.add_argument(
+        "--speed",
+        help="replay speed relative to the recording, "
+             "0 replays as fast as possible",
+        type=float,
+        default=1.0,
+    )
+    parser.add_argument(
+        "--splice",
+        help="enable splice relay on the replayed server",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--batch-writes",
+        help="enable write batching on the replayed server",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-o", "--output",
+        help="file to write JSON results to, stdout by default",
+        required=False,
+    )
+
+    args = parser.parse_args()
+
+    if args.speed < 0:
+        parser.error("speed cannot be negative")
+
+    logger.level = ERROR
+
+    log_file = open(args.log, 'rb')
+    connections = ProtocolConnections(
+        splice_relay=args.splice,
+        batch_writes=args.batch_writes,
+    )
+    replay = Replay(
+        read_records(log_file), ServerFactory(connections), args.speed
+    )
+
+    results = {}
+
+    def finished(replay_results):
+        results.update(replay_results)
+        reactor.stop()
+
+    def failed(failure):
+        failure.printTraceback()
+        reactor.stop()
+
+    reactor.callWhenRunning(
+        lambda: replay.run().addCallbacks(finished, failed)
+    )
+    reactor.run()
+    log_file.close()
+
+    if not results:
+        sys.exit(1)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
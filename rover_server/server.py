@@ -1,12 +1,46 @@
+import os
 import sys
 import re
+import time
+import zlib
 import argparse
+import binascii
+from collections import deque
 
+from zope.interface import implementer
 from twisted.python import log
+from twisted.internet.interfaces import IPullProducer
 from twisted.internet.protocol import Factory
 from twisted.protocols.basic import LineReceiver
 from twisted.internet import reactor
 
+from rover_server.logger import logger
+from rover_server.logger import BufferedLogFile
+from rover_server.logger import DEBUG
+from rover_server.logger import LEVELS
+from rover_server.cluster import start_coordinator
+from rover_server.cluster import start_worker
+from rover_server.federation import start_federation
+from rover_server.framing import encode_frame
+from rover_server.framing import decode_frame
+from rover_server.framing import FrameBuffer
+from rover_server.framing import TEXT_DELIMITER
+from rover_server.compression import CODECS
+from rover_server.tracing import Tracer
+from rover_server.tracing import is_local_client
+from rover_server.metrics import Metrics
+from rover_server.metrics import listen_metrics
+from rover_server.metrics import get_write_buffer_size
+from rover_server.reaper import IdleReaper
+from rover_server.ratelimit import RateLimiter
+from rover_server.recorder import Recorder
+from rover_server import aio
+
+
+NAME_PATTERN = re.compile(r'^\w+\Z')
+MAX_NAME_LENGTH = 255
+NAME_CACHE_SIZE = 65536
+
 
 class ProtocolConnections(object):
     """
@@ -22,226 +56,1564 @@ class ProtocolConnections(object):
     RE - controller sends communicate to connected device
         request format:
         RE:<REQUEST>
+    NM - controller selects devices notification mode
+        request format:
+        NM:FULL - whole DL list on every change (default)
+        NM:DELTA - DA/DR lines with added/removed devices only
+        on success server in response sends NM:OK
+    BF - client switches to binary framing (see rover_server.framing),
+        allowed only before DC/CC, on success server in response sends
+        BF:OK and all following requests and responses are binary frames
+    LW - client selects latest-value-wins mode for its RE communicates
+        request format:
+        LW:ON - queued RE communicate waiting to be sent to the endpoint
+            is replaced by a newer one with the same key (part of the
+            request body before first ':', communicates without ':' are
+            never replaced), allowed only with flow control (high_water)
+        LW:OFF - every RE communicate is delivered (default)
+        on success server in response sends LW:OK
+    RS - client resumes session of lost connection, allowed only before
+        DC/CC, client takes over name and pairing of the session
+        request format:
+        RS:<resume-token>
+        on success server in response sends RS:OK followed by lines
+        buffered while client was disconnected
+    HB - heartbeat of otherwise idle client, keeps connection from being
+        reaped, allowed at any time
+        request format:
+        HB:
+        server in response sends HB:OK
+    SB - unpaired controller subscribes to RE communicates sent by device
+        (read-only observer), device may be paired with other controller,
+        CD ends the subscription
+        request format:
+        SB:<device-name>
+        on success server in response sends SB:OK
+    US - controller ends its subscription, server in response sends US:OK
+    ZC - client selects compression of RE communicates, allowed only with
+        binary framing (see rover_server.compression)
+        request format:
+        ZC:<codec> - RE communicates for the client are sent as RZ
+            frames compressed with codec
+        ZC:OFF - no compression (default)
+        on success server in response sends ZC:OK
+    RZ - client sends compressed communicate to connected device, body
+        is RE request body compressed with negotiated codec
+    TQ - admin queries traces of relayed communicates, allowed only for
+        clients connected from localhost when tracing is enabled
+        request format:
+        TQ:<count>[:<min-latency>] - latest count traces with latency
+            of at least min-latency microseconds
+        on success server in response sends TR line of every trace
+        followed by TQ:OK
 
     server request structure:
     <command>:<request-body>
     available server commands to clients:
-    RE - server sends communicate sent from connected endpoint
+    RE - server sends communicate sent from connected endpoint or
+        observed device
+    RT - resume token of the session, sent after successful DC/CC when
+        session resumption is enabled
+    RZ - server sends compressed communicate to client which selected
+        compression
+    TR - trace of relayed communicate
+        response format:
+        TR:<trace-id>:<sender>:<receiver>:<size>:<received>:<dispatched>:
+            <written>:<flushed>
+        received is unix time in seconds, the rest are microseconds since
+        received or - (see rover_server.tracing.Trace)
 
     DL - devices list available for connetion
+    DA - devices which became available since last notification
+    DR - devices which are no longer available since last notification
     SE - client request error
 
     errors:
     E_10 - invalid client command
     E_11 - name given by the connecting client is already being used
-    E_12 - name is invalid (usuported characters)
+    E_12 - name is invalid (usuported characters or longer than
+        MAX_NAME_LENGTH)
+    E_13 - unknown notification mode
+    E_14 - framing can be selected only before connecting
+    E_15 - unknown latest-value-wins mode
+    E_16 - invalid or expired resume token
+    E_17 - session can be resumed only before connecting
+    E_18 - only unpaired controller can subscribe to device
     E_20 - no endpoint connected
-    E_21 - cannot connect to selected device
+    E_21 - cannot connect to selected device or subscribe to it
+    E_22 - compression requires binary framing
+    E_23 - unknown compression codec
+    E_24 - invalid compressed communicate or compression not selected
+    E_25 - tracing is disabled or client is not connected from localhost
+    E_26 - invalid trace query
+    E_27 - communicate with line delimiter cannot be sent to text client
+    E_28 - latest-value-wins mode requires flow control
+
+    splice relay:
+    when splice_relay is enabled, paired protocols forward chunks made of
+    complete RE lines directly to the peer transport without parsing them,
+    any other data falls back to regular line handling
+
+    available devices:
+    unpaired devices are tracked incrementally in available_devices and
+    the DL line sent to controllers is cached until that set changes
+
+    notifications:
+    with broadcast_delay (in seconds) greater than 0 all changes of
+    available devices within that window are coalesced into a single
+    notification per controller, notification is sent only when the set
+    of available devices really changed, skipped notifications are counted
+    in suppressed_broadcasts
+
+    cluster:
+    when running as one of worker processes, cluster is the connection
+    to the coordinator (see rover_server.cluster), names are claimed
+    globally and clients connected to other workers are represented in
+    protocols by remote protocols forwarding lines between workers,
+    as a node of federation cluster is the registry of links to other
+    nodes (see rover_server.federation) and remote protocols forward
+    lines through them
+
+    every ServerFactory owns separate instance of connections registry,
+    so independent fleets can be served by one process
+
+    flow control:
+    with high_water (in bytes) greater than 0, once client's transport
+    write buffer exceeds high_water, lines for the client are queued and
+    reading from its paired endpoint is paused until the queue drops
+    below low_water, with drop_oldest the endpoint is never paused and
+    the oldest queued RE lines are dropped instead, queued RE lines of
+    clients in latest-value-wins mode are replaced by newer ones
+
+    session resumption:
+    with resume_grace (in seconds) greater than 0, lost connection of a
+    named client keeps its name and pairing for resume_grace, lines sent
+    to the client meanwhile are buffered (up to resume_buffer lines) and
+    delivered once the client resumes session with its resume token
+
+    observers:
+    RE communicate of device with observers is encoded once per framing
+    and the same buffer is written to all observer transports, with flow
+    control observers never pause the device, their oldest queued RE lines
+    are dropped instead, when observed device disconnects observers get DD,
+    subscription is not a part of resumed session
+
+    compression:
+    client's codec is independent of the codec of its endpoint, RZ body
+    is decompressed and compressed again for the endpoint, unless both
+    selected the same codec which compresses every communicate separately
+    (ZLIB_MSG), then it is forwarded untouched
+
+    tracing:
+    with trace_sample greater than 0 every trace_sample-th relayed RE
+    communicate (spliced and passed through ones are not parsed, so they
+    are not traced) gets a trace id and its timestamps are kept in ring
+    buffer of the last trace_size traces queried with TQ
+
+    store and forward:
+    with forward_hold (in seconds) greater than 0, controller paired with
+    device which disconnects stays paired with the device's outbox for
+    forward_hold instead of getting DD, its RE communicates are stored
+    there (oldest ones are evicted once they exceed forward_size bytes or
+    are older than forward_ttl) and forwarded in a single write once the
+    device connects again with the same name, controller gets DD only if
+    the device does not come back within forward_hold
+
+    write batching:
+    with batch_writes enabled, data written to a client is collected and
+    handed to its transport once per reactor iteration (callLater(0)
+    shared by the whole registry) or once batch_size bytes are collected,
+    tcp_nodelay disables Nagle's algorithm on client sockets
+
+    rate limits:
+    rate_limits maps client command (or '*' for all lines) to (rate,
+    burst) of token bucket of every client, excess lines are dropped or,
+    with rate_limit_delay, reading from the client is paused until its
+    bucket refills (see rover_server.ratelimit)
+
+    commands:
+    client commands are dispatched through handlers table keyed by
+    command, extensions add their own commands with register_handler
+
+    idle connections:
+    with idle_timeout (in seconds) greater than 0, connections which send
+    nothing (not even HB) for idle_timeout are aborted by IdleReaper,
+    clients should send HB at least every idle_timeout / 2
+
+    recording:
+    with recorder (see rover_server.recorder) connections, lines received
+    from clients (spliced ones too) and disconnections are appended to
+    binary log which rover_server_replay plays back against the server
 
     """
 
-    devices = set()
-    controllers = set()
-    protocols = {}
+    def __init__(self, splice_relay=False, broadcast_delay=0, clock=None,
+                 high_water=0, low_water=0, drop_oldest=False,
+                 resume_grace=0, resume_buffer=1000, idle_timeout=0,
+                 batch_writes=False, batch_size=65536, tcp_nodelay=False,
+                 rate_limits=None, rate_limit_delay=False, forward_hold=0,
+                 forward_ttl=0, forward_size=65536, trace_sample=0,
+                 trace_size=1000):
+        self.devices = set()
+        self.controllers = set()
+        self.protocols = {}
+
+        self.available_devices = set()
+        self.devices_list_line = None
+
+        self.clock = clock or reactor
+        self.broadcast_delay = broadcast_delay
+        self.broadcast_call = None
+        self.added_devices = set()
+        self.removed_devices = set()
+        self.suppressed_broadcasts = 0
+
+        self.splice_relay = splice_relay
+
+        self.high_water = high_water
+        self.low_water = low_water
+        self.drop_oldest = drop_oldest
+
+        self.resume_grace = resume_grace
+        self.resume_buffer = resume_buffer
+        self.detached_sessions = {}
+
+        self.reaper = None
+        if idle_timeout > 0:
+            self.reaper = IdleReaper(
+                idle_timeout, self.reap_protocol, clock=self.clock
+            )
 
-    @classmethod
-    def line_received(clk, protocol, line):
+        self.batch_writes = batch_writes
+        self.batch_size = batch_size
+        self.flush_pending = []
+        self.flush_call = None
+        self.tcp_nodelay = tcp_nodelay
 
-        command = clk.get_command(line)
-        body = clk.get_body(line)
+        self.rate_limiter = None
+        if rate_limits:
+            self.rate_limiter = RateLimiter(
+                rate_limits, rate_limit_delay, clock=self.clock
+            )
 
-        # the device is connecting
-        if command == 'DC':
-            clk.connect_device(protocol, body)
+        self.forward_hold = forward_hold
+        self.forward_ttl = forward_ttl or forward_hold
+        self.forward_size = forward_size
+        self.offline_devices = {}
+
+        self.tracer = None
+        if trace_sample > 0:
+            self.tracer = Tracer(trace_sample, trace_size)
+
+        self.valid_names = set()
+        self.handlers = {
+            'DC': self.connect_device,
+            'CC': self.connect_controller,
+            'CD': self.select_device,
+            'RE': self.relay,
+            'NM': self.set_notification_mode,
+            'BF': self.set_binary_framing,
+            'LW': self.set_latest_wins,
+            'RS': self.resume_session,
+            'HB': self.heartbeat,
+            'SB': self.subscribe,
+            'US': self.end_subscription,
+            'ZC': self.set_compression,
+            'RZ': self.relay_compressed,
+            'TQ': self.query_traces,
+        }
+
+        self.cluster = None
+        self.metrics = None
+        self.recorder = None
+
+    def line_received(self, protocol, line):
+        command = line[:2]
+
+        if self.recorder is not None:
+            self.recorder.line_received(protocol, line)
+
+        if self.metrics is not None:
+            self.metrics.line_received(command)
+
+        rate_limiter = self.rate_limiter
+        if rate_limiter is not None \
+                and not rate_limiter.allow(protocol, command):
+            return
 
-        # the contorller is connecting
-        elif command == 'CC':
-            clk.connect_controller(protocol, body)
+        handler = self.handlers.get(command)
+        if handler is None:
+            #invalid client request
+            self.send_error(protocol, 'SE', 'E_10')
+            return
+
+        handler(protocol, line[3:])
+
+    def register_handler(self, command, handler):
+        """
+        adds client command handled by handler(protocol, body), handler
+        of existing command is replaced
+        """
+        self.handlers[command] = handler
+        if self.metrics is not None:
+            self.metrics.add_command(command)
+
+    def select_device(self, protocol, device_name):
+        device_protocol = self.protocols.get(device_name)
+        if device_protocol is None:
+            if self.is_remote_device(device_name) and protocol.name:
+                self.cluster.connect_remote_device(protocol, device_name)
+            else:
+                self.send_error(protocol, 'CD', 'E_21')
+            return
+
+        if protocol.observed is not None:
+            self.unsubscribe(protocol)
+        self.make_connection(device_protocol, protocol)
+        protocol.sendLine('CD:OK')
 
-        # controller is connecting to selected device
-        elif command == 'CD':
-            device_name = body
-            device_protocol = clk.protocols.get(device_name)
+    def relay(self, protocol, body):
+        if protocol.binary_framing and TEXT_DELIMITER in body \
+                and self.has_text_receivers(protocol):
+            self.send_error(protocol, 'SE', 'E_27')
+            return
+
+        device_protocol = protocol.endpoint
+        if protocol.observers:
+            self.fan_out(protocol.observers, 'RE:' + body)
             if device_protocol is None:
-                protocol.sendLine('CD:E_21')
                 return
-            clk.make_connection(device_protocol, protocol)
-            protocol.sendLine('CD:OK')
 
-        elif command == 'RE':
-            device_protocol = clk.protocols.get(protocol.get_endpoint(), None)
-            if device_protocol:
-                device_protocol.sendLine('RE:' + body)
-            else:
-                protocol.sendLine('SE:E_20')
+        if device_protocol is not None and self.tracer is not None:
+            self.trace_relay(protocol, device_protocol, body)
 
-        #invalid client request
+        if device_protocol and protocol.latest_wins and ':' in body:
+            device_protocol.send_coalesced(
+                'RE:' + body, body.split(':', 1)[0]
+            )
+        elif device_protocol:
+            device_protocol.sendLine('RE:' + body)
         else:
-            protocol.sendLine('SE:E_10')
+            self.send_error(protocol, 'SE', 'E_20')
+            return
+
+        if self.metrics is not None:
+            self.metrics.relayed(
+                self,
+                protocol.name,
+                device_protocol.name,
+                len(body),
+                time.time() - protocol.received_time
+            )
+
+    def has_text_receivers(self, protocol):
+        #remote endpoint checks communicate once it is delivered, lines
+        #of detached endpoint may be resumed by text client
+        end_protocol = protocol.endpoint
+        if end_protocol is not None and not end_protocol.remote \
+                and not end_protocol.binary_framing:
+            return True
+
+        for observer in protocol.observers or ():
+            if not observer.binary_framing:
+                return True
+
+        return False
+
+    def trace_relay(self, protocol, end_protocol, body):
+        trace = self.tracer.sample(protocol, end_protocol, len(body))
+
+        #endpoint stamps the trace when it writes the communicate, only
+        #connected local endpoint writes it
+        if trace is not None and not end_protocol.remote \
+                and end_protocol.connected:
+            end_protocol.trace = trace
+
+    def query_traces(self, protocol, body):
+        if self.tracer is None or not is_local_client(protocol):
+            self.send_error(protocol, 'TQ', 'E_25')
+            return
+
+        try:
+            count, _, min_latency = body.partition(':')
+            traces = self.tracer.query(
+                int(count), int(min_latency or 0) / 1000000.0
+            )
+        except ValueError:
+            self.send_error(protocol, 'TQ', 'E_26')
+            return
+
+        for trace in traces:
+            protocol.sendLine(trace.get_line())
+        protocol.sendLine('TQ:OK')
+
+    def relay_compressed(self, protocol, body):
+        codec = protocol.codec
+        if codec is None:
+            self.send_error(protocol, 'SE', 'E_24')
+            return
+
+        end_protocol = protocol.endpoint
+        if codec.passthrough and end_protocol is not None \
+                and not end_protocol.remote and end_protocol.connected \
+                and end_protocol.codec is not None \
+                and end_protocol.codec.name == codec.name \
+                and not protocol.observers and not protocol.latest_wins:
+            end_protocol.sendLine('RZ:' + body)
+            if self.metrics is not None:
+                self.metrics.passed_through(len(body))
+            return
+
+        plain_body = protocol.decompress(body)
+        if plain_body is None:
+            self.send_error(protocol, 'SE', 'E_24')
+            return
+
+        self.relay(protocol, plain_body)
 
-    @classmethod
-    def get_command(clk, line):
-        return line[:2]
+    def heartbeat(self, protocol, body):
+        protocol.sendLine('HB:OK')
 
-    @classmethod
-    def get_body(clk, line):
-        return line[3:]
+    def send_error(self, protocol, command, code):
+        if self.metrics is not None:
+            self.metrics.error(code)
 
-    @classmethod
-    def is_name_valid(clk, name):
+        protocol.sendLine(command + ':' + code)
+
+    def is_name_valid(self, name):
         #is name available
-        if name in clk.protocols:
+        if name in self.protocols:
             return 'E_11'
 
-        #no invalid characters
-        if re.match(r'^[\w_]+$', name) is None:
-            return 'E_12'
+        #no invalid characters, names which passed are cached so clients
+        #reconnecting after an outage skip the pattern
+        if name not in self.valid_names:
+            if len(name) > MAX_NAME_LENGTH or NAME_PATTERN.match(name) is None:
+                return 'E_12'
+
+            if len(self.valid_names) >= NAME_CACHE_SIZE:
+                self.valid_names.clear()
+            self.valid_names.add(name)
 
         return 0
 
-    @classmethod
-    def connect_device(clk, device_protocol, device_name):
-        validation_result = clk.is_name_valid(device_name)
+    def is_remote_device(self, device_name):
+        if self.cluster is None:
+            return False
+
+        return self.cluster.is_remote_device(device_name)
+
+    def claim_name(self, protocol, name, command, register):
+        validation_result = self.is_name_valid(name)
         if validation_result != 0:
-            device_protocol.sendLine('DC:' + validation_result)
+            self.send_error(protocol, command, validation_result)
             return
 
+        #registry sets, protocols and endpoints share single name object
+        name = intern(name)
+
+        if self.cluster is None:
+            register(protocol, name)
+            return
+
+        #name has to be unique among all workers
+        def name_claimed(claim_result):
+            if claim_result != 0:
+                self.send_error(protocol, command, claim_result)
+            elif not protocol.connected or name in self.protocols:
+                self.cluster.release_name(name)
+                if protocol.connected:
+                    self.send_error(protocol, command, 'E_11')
+            else:
+                register(protocol, name)
+
+        self.cluster.claim_name(name, name_claimed)
+
+    def connect_device(self, device_protocol, device_name):
+        self.claim_name(
+            device_protocol,
+            device_name,
+            'DC',
+            self.register_device
+        )
+
+    def register_device(self, device_protocol, device_name):
         device_protocol.name = device_name
-        clk.devices.add(device_name)
-        clk.protocols[device_name] = device_protocol
-        log.msg("device {} is connected", device_name)
+        self.devices.add(device_name)
+        self.protocols[device_name] = device_protocol
+        logger.info("device {} is connected", device_name)
+        self.issue_resume_token(device_protocol)
+
+        offline_device = self.offline_devices.pop(device_name, None)
+        if offline_device is not None \
+                and self.reattach_device(offline_device, device_protocol):
+            return
 
-        #notify all controllers about new device
-        clk.notify_all_about_available_devices()
+        self.set_device_available(device_name)
 
-    @classmethod
-    def notify_all_about_available_devices(clk):
         #notify all controllers about new device
-        if clk.controllers:
-            devices_available = clk.get_available_devices()
-            for controller_name in clk.controllers:
-                clk.notify_about_available_devices(
-                    clk.protocols[controller_name],
-                    devices_available
+        self.notify_all_about_available_devices()
+
+    def set_notification_mode(self, protocol, mode):
+        if mode == 'DELTA':
+            protocol.delta_updates = True
+        elif mode == 'FULL':
+            protocol.delta_updates = False
+        else:
+            protocol.sendLine('NM:E_13')
+            return
+
+        protocol.sendLine('NM:OK')
+
+    def set_binary_framing(self, protocol, body):
+        if protocol.name is not None:
+            protocol.sendLine('BF:E_14')
+            return
+
+        protocol.sendLine('BF:OK')
+        protocol.start_binary_framing()
+
+    def set_compression(self, protocol, codec_name):
+        if not protocol.binary_framing:
+            protocol.sendLine('ZC:E_22')
+            return
+
+        if codec_name == 'OFF':
+            codec = None
+        elif codec_name in CODECS:
+            codec = CODECS[codec_name]()
+        else:
+            protocol.sendLine('ZC:E_23')
+            return
+
+        #response is sent uncompressed, following RE communicates with
+        #the new codec
+        protocol.sendLine('ZC:OK')
+        protocol.codec = codec
+
+    def set_latest_wins(self, protocol, mode):
+        if mode == 'ON':
+            #only lines queued by flow control are ever replaced
+            if self.high_water <= 0:
+                protocol.sendLine('LW:E_28')
+                return
+            protocol.latest_wins = True
+        elif mode == 'OFF':
+            protocol.latest_wins = False
+        else:
+            protocol.sendLine('LW:E_15')
+            return
+
+        protocol.sendLine('LW:OK')
+
+    def subscribe(self, protocol, device_name):
+        if protocol.name not in self.controllers \
+                or protocol.endpoint is not None:
+            self.send_error(protocol, 'SB', 'E_18')
+            return
+
+        device_protocol = self.protocols.get(device_name)
+        if device_protocol is None or device_protocol.remote \
+                or device_name not in self.devices:
+            self.send_error(protocol, 'SB', 'E_21')
+            return
+
+        if protocol.observed is not None:
+            self.unsubscribe(protocol)
+
+        if device_protocol.observers is None:
+            device_protocol.observers = set()
+        device_protocol.observers.add(protocol)
+        protocol.observed = device_protocol
+
+        #RE lines of observed device have to be parsed to be fanned out
+        device_protocol.start_splice(None)
+
+        logger.info(
+            "controller {} subscribed to device {}",
+            protocol.name,
+            device_name
+        )
+        protocol.sendLine('SB:OK')
+
+    def end_subscription(self, protocol, body):
+        if protocol.observed is not None:
+            self.unsubscribe(protocol)
+        protocol.sendLine('US:OK')
+
+    def unsubscribe(self, protocol):
+        device_protocol = protocol.observed
+        protocol.observed = None
+        device_protocol.observers.discard(protocol)
+
+        if not device_protocol.observers \
+                and device_protocol.endpoint is not None:
+            self.splice_pair(device_protocol, device_protocol.endpoint)
+
+    def fan_out(self, observers, line):
+        #line is encoded at most once per framing, the same buffer is
+        #written to every observer which is not blocked
+        line_data = frame_data = None
+
+        for observer in observers:
+            if observer.write_blocked or observer.outbox:
+                observer.queue_line(line)
+            elif observer.codec is not None:
+                observer.write_line(line)
+            elif observer.binary_framing:
+                if frame_data is None:
+                    frame_data = encode_frame(line)
+                observer.write_data(frame_data)
+            else:
+                if line_data is None:
+                    line_data = line + observer.delimiter
+                observer.write_data(line_data)
+
+    def notify_all_about_available_devices(self):
+        #pairing changes of already unavailable devices (e.g. churn of
+        #paired controllers) do not change what controllers see
+        if not self.added_devices and not self.removed_devices:
+            self.suppressed_broadcasts += 1
+            return
+
+        if self.broadcast_delay <= 0:
+            self.broadcast_available_devices()
+
+        elif self.broadcast_call is None:
+            self.broadcast_call = self.clock.callLater(
+                self.broadcast_delay, self.broadcast_available_devices
+            )
+
+    def broadcast_available_devices(self):
+        self.broadcast_call = None
+
+        added_devices = self.added_devices
+        removed_devices = self.removed_devices
+        self.added_devices = set()
+        self.removed_devices = set()
+
+        #changes within broadcast_delay cancelled each other out
+        if not added_devices and not removed_devices:
+            self.suppressed_broadcasts += 1
+            return
+
+        #notify all controllers about changed devices
+        if self.controllers:
+            start = time.time()
+            response_line = self.get_devices_list_line()
+            delta_lines = self.get_devices_delta_lines(
+                added_devices, removed_devices
+            )
+            for controller_name in self.controllers:
+                controller_protocol = self.protocols[controller_name]
+                if controller_protocol.delta_updates:
+                    for delta_line in delta_lines:
+                        controller_protocol.sendLine(delta_line)
+                else:
+                    self.notify_about_available_devices(
+                        controller_protocol,
+                        response_line
+                    )
+
+            if self.metrics is not None:
+                self.metrics.broadcasted(
+                    len(self.controllers), time.time() - start
                 )
 
-    @classmethod
-    def notify_about_available_devices(clk, protocol, devices_available):
-        response_line = 'DL:' + ':'.join(devices_available)
+    def get_devices_delta_lines(self, added_devices, removed_devices):
+        delta_lines = []
+        if added_devices:
+            delta_lines.append('DA:' + ':'.join(added_devices))
+        if removed_devices:
+            delta_lines.append('DR:' + ':'.join(removed_devices))
+
+        return delta_lines
+
+    def notify_about_available_devices(self, protocol, response_line):
         protocol.sendLine(response_line)
 
-        log.msg(
-            'notifying {} about available devices: {}'.format(
-                response_line,
-                protocol.name,
-            )
+        logger.debug(
+            'notifying {} about available devices: {}',
+            protocol.name,
+            response_line,
         )
 
-    @classmethod
-    def get_available_devices(clk):
-        available_devices = []
-        for device_name in clk.devices:
-            dev_protocol = clk.protocols[device_name]
-            if dev_protocol.get_endpoint() is None:
-                available_devices.append(device_name)
+    def get_available_devices(self):
+        return list(self.available_devices)
 
-        return available_devices
+    def get_devices_list_line(self):
+        if self.devices_list_line is None:
+            self.devices_list_line = 'DL:' + ':'.join(self.available_devices)
 
-    @classmethod
-    def connect_controller(clk, controller_protocol, controller_name):
-        validation_result = clk.is_name_valid(controller_name)
-        if validation_result != 0:
-            controller_protocol.sendLine('CC:' + validation_result)
-            return
+        return self.devices_list_line
+
+    def set_device_available(self, device_name):
+        if device_name in self.available_devices:
+            return False
+
+        self.available_devices.add(device_name)
+        self.devices_list_line = None
 
+        if self.cluster is not None and device_name in self.devices:
+            self.cluster.device_available(device_name)
+
+        if device_name in self.removed_devices:
+            self.removed_devices.remove(device_name)
+        else:
+            self.added_devices.add(device_name)
+
+        return True
+
+    def set_device_unavailable(self, device_name):
+        if device_name not in self.available_devices:
+            return False
+
+        self.available_devices.remove(device_name)
+        self.devices_list_line = None
+
+        if self.cluster is not None and device_name in self.devices:
+            self.cluster.device_unavailable(device_name)
+
+        if device_name in self.added_devices:
+            self.added_devices.remove(device_name)
+        else:
+            self.removed_devices.add(device_name)
+
+        return True
+
+    def connect_controller(self, controller_protocol, controller_name):
+        self.claim_name(
+            controller_protocol,
+            controller_name,
+            'CC',
+            self.register_controller
+        )
+
+    def register_controller(self, controller_protocol, controller_name):
         controller_protocol.name = controller_name
-        clk.controllers.add(controller_name)
-        clk.protocols[controller_name] = controller_protocol
-        log.msg("controller {} is connected", controller_name)
+        self.controllers.add(controller_name)
+        self.protocols[controller_name] = controller_protocol
+        logger.info("controller {} is connected", controller_name)
+        self.issue_resume_token(controller_protocol)
 
         #notify connected controller about connected devices
-        devices_available = clk.get_available_devices()
-        clk.notify_about_available_devices(
-            controller_protocol, devices_available
+        self.notify_about_available_devices(
+            controller_protocol, self.get_devices_list_line()
         )
 
-    @classmethod
-    def make_connection(clk, device_protocol, controller_protocol):
-        device_protocol.connect_endpoint(controller_protocol.name)
-        controller_protocol.connect_endpoint(device_protocol.name)
-        log.msg("controller {} is connected to device {}".\
-            format(
-                controller_protocol.name,
-                device_protocol.name
-            )
+    def make_connection(self, device_protocol, controller_protocol):
+        device_protocol.connect_endpoint(controller_protocol)
+        controller_protocol.connect_endpoint(device_protocol)
+        self.set_device_unavailable(device_protocol.name)
+        self.splice_pair(device_protocol, controller_protocol)
+
+        logger.info(
+            "controller {} is connected to device {}",
+            controller_protocol.name,
+            device_protocol.name
         )
 
-        clk.notify_all_about_available_devices()
+        self.notify_all_about_available_devices()
+
+    def splice_pair(self, device_protocol, controller_protocol):
+        if self.splice_relay and not device_protocol.remote \
+                and not controller_protocol.remote \
+                and device_protocol.connected \
+                and controller_protocol.connected \
+                and not device_protocol.binary_framing \
+                and not controller_protocol.binary_framing \
+                and not device_protocol.observers \
+                and not controller_protocol.observers:
+            device_protocol.start_splice(controller_protocol)
+            controller_protocol.start_splice(device_protocol)
+
+    def issue_resume_token(self, protocol):
+        if self.resume_grace <= 0:
+            return
 
-    @classmethod
-    def disconnect_protocol(clk, protocol):
-        log.msg('disconnecting protocol {}'.format(protocol.name))
+        protocol.resume_token = binascii.hexlify(os.urandom(16))
+        protocol.sendLine('RT:' + protocol.resume_token)
 
-        if protocol.name in clk.devices:
-            end_protocol = clk.protocols.get(protocol.get_endpoint(), None)
-            if end_protocol is not None:
-                end_protocol.disconnect_endpoint()
-                end_protocol.sendLine('DD:')
+    def protocol_lost(self, protocol):
+        if protocol.observed is not None:
+            self.unsubscribe(protocol)
+
+        if self.resume_grace <= 0 or protocol.resume_token is None \
+                or self.protocols.get(protocol.name) is not protocol:
+            self.disconnect_protocol(protocol)
+            return
+
+        #keep name and pairing of the client for the grace period
+        detached_protocol = DetachedProtocol(protocol, self.resume_buffer)
+        self.protocols[protocol.name] = detached_protocol
+
+        end_protocol = protocol.endpoint
+        if end_protocol is not None:
+            end_protocol.connect_endpoint(detached_protocol)
+            if end_protocol.splice_peer is protocol:
+                end_protocol.start_splice(None)
+
+        for observer in protocol.observers or ():
+            observer.observed = detached_protocol
 
-            clk.devices.remove(protocol.name)
-            clk.notify_all_about_available_devices()
+        detached_protocol.expire_call = self.clock.callLater(
+            self.resume_grace, self.session_expired, detached_protocol
+        )
+        self.detached_sessions[protocol.resume_token] = detached_protocol
+        logger.info('session of {} is detached', protocol.name)
+
+    def session_expired(self, detached_protocol):
+        del self.detached_sessions[detached_protocol.resume_token]
+        logger.info('session of {} expired', detached_protocol.name)
+        self.disconnect_protocol(detached_protocol)
+
+    def resume_session(self, protocol, token):
+        if protocol.name is not None:
+            self.send_error(protocol, 'RS', 'E_17')
+            return
+
+        detached_protocol = self.detached_sessions.pop(token, None)
+        if detached_protocol is None:
+            self.send_error(protocol, 'RS', 'E_16')
+            return
 
-        elif protocol.name in clk.controllers:
-            clk.controllers.remove(protocol.name)
-            end_protocol = clk.protocols.get(protocol.get_endpoint(), None)
+        detached_protocol.expire_call.cancel()
+        detached_protocol.attach(protocol)
+        self.protocols[protocol.name] = protocol
+
+        for observer in protocol.observers or ():
+            observer.observed = protocol
+
+        end_protocol = protocol.endpoint
+        if end_protocol is not None:
+            end_protocol.connect_endpoint(protocol)
+            self.splice_pair(end_protocol, protocol)
+
+        logger.info('session of {} is resumed', protocol.name)
+        protocol.sendLine('RS:OK')
+        if detached_protocol.lines:
+            protocol.send_lines(detached_protocol.lines)
+
+    def hold_endpoint(self, device_protocol, controller_protocol):
+        offline_device = OfflineDevice(
+            device_protocol.name, self.forward_size, self.forward_ttl,
+            self.clock
+        )
+        controller_protocol.disconnect_endpoint()
+        controller_protocol.connect_endpoint(offline_device)
+        offline_device.connect_endpoint(controller_protocol)
+
+        offline_device.expire_call = self.clock.callLater(
+            self.forward_hold, self.outbox_expired, offline_device
+        )
+        self.offline_devices[offline_device.name] = offline_device
+        logger.info('storing communicates for {}', offline_device.name)
+
+    def outbox_expired(self, offline_device):
+        del self.offline_devices[offline_device.name]
+        logger.info('outbox of {} expired', offline_device.name)
+
+        controller_protocol = offline_device.endpoint
+        offline_device.disconnect_endpoint()
+        if controller_protocol is not None \
+                and controller_protocol.endpoint is offline_device:
+            controller_protocol.disconnect_endpoint()
+            controller_protocol.sendLine('DD:')
+
+    def reattach_device(self, offline_device, device_protocol):
+        offline_device.expire_call.cancel()
+
+        controller_protocol = offline_device.endpoint
+        lines = offline_device.get_lines()
+        offline_device.disconnect_endpoint()
+
+        #controller went away or selected other device meanwhile
+        if controller_protocol is None \
+                or controller_protocol.endpoint is not offline_device:
+            return False
+
+        self.make_connection(device_protocol, controller_protocol)
+        logger.info(
+            'forwarding {} stored communicates to {}',
+            len(lines),
+            device_protocol.name
+        )
+        if lines:
+            device_protocol.send_lines(lines)
+        return True
+
+    def flush_later(self, protocol):
+        self.flush_pending.append(protocol)
+        if self.flush_call is None:
+            self.flush_call = self.clock.callLater(0, self.flush_writes)
+
+    def flush_writes(self):
+        self.flush_call = None
+        flush_pending = self.flush_pending
+        self.flush_pending = []
+
+        for protocol in flush_pending:
+            protocol.flush_writes()
+
+    def reap_protocol(self, protocol):
+        logger.info('reaping idle connection of {}', protocol.name)
+        protocol.transport.abortConnection()
+
+    def disconnect_protocol(self, protocol):
+        logger.info('disconnecting protocol {}', protocol.name)
+
+        if protocol.name in self.devices:
+            end_protocol = protocol.endpoint
+            if end_protocol is not None:
+                if self.forward_hold > 0 and end_protocol.connected \
+                        and not end_protocol.remote:
+                    self.hold_endpoint(protocol, end_protocol)
+                else:
+                    end_protocol.disconnect_endpoint()
+                    end_protocol.sendLine('DD:')
+
+            for observer in protocol.observers or ():
+                observer.observed = None
+                observer.sendLine('DD:')
+            protocol.observers = None
+
+            self.set_device_unavailable(protocol.name)
+            self.devices.remove(protocol.name)
+            self.notify_all_about_available_devices()
+
+        elif protocol.name in self.controllers:
+            self.controllers.remove(protocol.name)
+            end_protocol = protocol.endpoint
             if end_protocol is not None:
                 end_protocol.disconnect_endpoint()
-                clk.notify_all_about_available_devices()
+                if end_protocol.name in self.devices:
+                    self.set_device_available(end_protocol.name)
+                self.notify_all_about_available_devices()
 
         else:
-            log.err('ERROR - protocol {} neither in controllers nor devices'.\
-                    format(protocol.name)
+            logger.error(
+                'ERROR - protocol {} neither in controllers nor devices',
+                protocol.name
             )
 
-        if clk.protocols.pop(protocol.name, None) is None:
-            log.err('ERROR - protocol {} not in protocols'.\
-                    format(protocol.name)
+        if self.protocols.pop(protocol.name, None) is None:
+            logger.error(
+                'ERROR - protocol {} not in protocols',
+                protocol.name
             )
+        elif self.cluster is not None:
+            self.cluster.release_name(protocol.name)
+
+        if self.metrics is not None:
+            self.metrics.protocol_disconnected(self, protocol.name)
 
         protocol.disconnect_endpoint()
 
-    @classmethod
-    def reset(clk):
+    def reset(self):
+
+        if self.broadcast_call is not None:
+            self.broadcast_call.cancel()
+            self.broadcast_call = None
+
+        for detached_protocol in self.detached_sessions.values():
+            detached_protocol.expire_call.cancel()
+        self.detached_sessions = {}
+
+        for offline_device in self.offline_devices.values():
+            offline_device.expire_call.cancel()
+        self.offline_devices = {}
+
+        if self.reaper is not None:
+            self.reaper.stop()
+
+        if self.flush_call is not None:
+            self.flush_call.cancel()
+            self.flush_call = None
+        self.flush_pending = []
+
+        if self.rate_limiter is not None:
+            self.rate_limiter.stop()
+
+        for p in self.protocols:
+            self.protocols[p].reset()
+
+        self.devices = set()
+        self.controllers = set()
+        self.protocols = {}
+        self.available_devices = set()
+        self.devices_list_line = None
+        self.added_devices = set()
+        self.removed_devices = set()
+
+
+@implementer(IPullProducer)
+class WriteBufferMonitor(object):
+    """
+    pull producer registered on client's transport, the transport resumes
+    it whenever its write buffer is drained, the protocol itself pauses
+    writes once the buffer exceeds high_water (bufferSize of twisted
+    transport is also its read size, so it is left alone)
+    """
+
+    __slots__ = ('protocol',)
+
+    def __init__(self, protocol):
+        self.protocol = protocol
+
+    def pauseProducing(self):
+        self.protocol.write_paused()
+
+    def resumeProducing(self):
+        self.protocol.write_resumed()
+
+    def stopProducing(self):
+        pass
+
 
-        for p in clk.protocols:
-            clk.protocols[p].reset()
+class DetachedProtocol(object):
+    """
+    stands in connections registry for a client which lost connection
+    and may resume its session, lines sent to it are buffered
+    """
+
+    __slots__ = (
+        'name', 'endpoint', 'resume_token', 'delta_updates', 'latest_wins',
+        'observers', 'lines', 'expire_call',
+    )
+
+    remote = False
+    connected = 0
+    transport = None
+    splice_peer = None
+    binary_framing = False
+    write_blocked = False
+    outbox = None
+    outbox_size = 0
+    observed = None
+
+    def __init__(self, protocol, buffer_size):
+        self.name = protocol.name
+        self.endpoint = protocol.endpoint
+        self.resume_token = protocol.resume_token
+        self.delta_updates = protocol.delta_updates
+        self.latest_wins = protocol.latest_wins
+        self.observers = protocol.observers
+
+        self.lines = deque(protocol.outbox or (), buffer_size)
+        self.expire_call = None
+
+    def attach(self, protocol):
+        protocol.name = self.name
+        protocol.endpoint = self.endpoint
+        protocol.resume_token = self.resume_token
+        protocol.delta_updates = self.delta_updates
+        protocol.latest_wins = self.latest_wins
+        protocol.observers = self.observers
+
+    def sendLine(self, line):
+        self.lines.append(line)
+
+    def send_coalesced(self, line, key):
+        self.lines.append(line)
+
+    def pause_reading(self, reason):
+        pass
+
+    def resume_reading(self, reason):
+        pass
+
+    def reset(self):
+        self.endpoint = None
+
+    def connect_endpoint(self, protocol):
+        self.endpoint = protocol
+
+    def disconnect_endpoint(self):
+        self.endpoint = None
+
+    def start_splice(self, peer_protocol):
+        pass
+
+    def get_endpoint(self):
+        return self.endpoint
+
+
+class OfflineDevice(object):
+    """
+    stands in as endpoint of controller whose device disconnected, RE
+    communicates for the device are stored until it connects again,
+    oldest ones are evicted by size and age
+    """
+
+    __slots__ = (
+        'name', 'endpoint', 'lines', 'size', 'max_size', 'ttl', 'clock',
+        'expire_call',
+    )
+
+    remote = False
+    connected = 0
+    splice_peer = None
+    binary_framing = False
+    write_blocked = False
+    outbox = None
+
+    def __init__(self, name, max_size, ttl, clock):
+        self.name = name
+        self.endpoint = None
+        self.lines = deque()
+        self.size = 0
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.expire_call = None
+
+    def sendLine(self, line):
+        lines = self.lines
+        lines.append((self.clock.seconds(), line))
+        self.size += len(line)
+
+        while self.size > self.max_size:
+            self.size -= len(lines.popleft()[1])
+        self.evict_expired()
+
+    def send_coalesced(self, line, key):
+        self.sendLine(line)
+
+    def evict_expired(self):
+        lines = self.lines
+        oldest = self.clock.seconds() - self.ttl
+        while lines and lines[0][0] < oldest:
+            self.size -= len(lines.popleft()[1])
+
+    def get_lines(self):
+        self.evict_expired()
+        return [line for _, line in self.lines]
 
-        clk.devices = set()
-        clk.controllers = set()
-        clk.protocols = {}
+    def pause_reading(self, reason):
+        pass
+
+    def resume_reading(self, reason):
+        pass
+
+    def reset(self):
+        self.disconnect_endpoint()
+
+    def connect_endpoint(self, protocol):
+        self.endpoint = protocol
+
+    def disconnect_endpoint(self):
+        self.endpoint = None
+        self.lines = deque()
+        self.size = 0
+
+    def start_splice(self, peer_protocol):
+        pass
+
+    def get_endpoint(self):
+        return self.endpoint
 
 
 class ServerProtocol(LineReceiver):
+    """
+    connection of a single client
+
+    per-connection state defaults live in class attributes, so an idle
+    client keeps only a few instance attributes, endpoint is a direct
+    reference to the paired protocol and names are interned
+
+    memory per connection measured with rover_server_bench (1000 idle
+    devices, CPython 2.7, Twisted 20.3, epoll reactor) is about 4.2 KB
+    including the transport, i.e. about 420 MB for 100k idle rovers plus
+    kernel socket buffers
+    """
 
     name = None
     endpoint = None
+    splice_peer = None
+    delta_updates = False
+    remote = False
+    binary_framing = False
+    frame_buffer = None
+
+    write_blocked = False
+    outbox = None
+    outbox_size = 0
+    outbox_popped = 0
+    outbox_keys = None
+    outbox_key_positions = None
+    paused_senders = None
+    dropped_lines = 0
+    coalesced_lines = 0
+    latest_wins = False
+    received_time = 0
+    resume_token = None
+    reaper = None
+    idle_tick = 0
+    observers = None
+    observed = None
+    write_batch = None
+    batch_size = 0
+    pause_reasons = None
+    rate_buckets = None
+    record_id = 0
+    codec = None
+    trace = None
+    queued_traces = None
+    batch_traces = None
+
+    def __init__(self, connections):
+        self.connections = connections
 
     def connectionMade(self):
-        log.msg("connection from a client made")
+        logger.info("connection from a client made")
+
+        if self.connections.tcp_nodelay:
+            self.transport.setTcpNoDelay(True)
+
+        if self.connections.batch_writes:
+            self.write_batch = []
+
+        if self.connections.high_water > 0:
+            self.outbox = deque()
+            self.outbox_keys = {}
+            self.outbox_key_positions = deque()
+            self.paused_senders = set()
+            self.transport.registerProducer(WriteBufferMonitor(self), False)
+
+        if self.connections.reaper is not None:
+            self.reaper = self.connections.reaper
+            self.reaper.add(self)
+
+        if self.connections.recorder is not None:
+            self.connections.recorder.connection_made(self)
 
     def connectionLost(self, reason):
-        log.msg("connection lost: {}".format(reason))
+        logger.info("connection lost: {}", reason)
+        self.connected = 0
+
+        if self.reaper is not None:
+            self.reaper.remove(self)
+
+        if self.paused_senders:
+            self.resume_senders()
+
+        if self.connections.recorder is not None:
+            self.connections.recorder.connection_lost(self)
+
+        #disconect from endpoint or keep session for resumption
+        self.connections.protocol_lost(self)
+
+    def dataReceived(self, data):
+        if self.reaper is not None:
+            self.idle_tick = self.reaper.tick
+
+        metrics = self.connections.metrics
+        if metrics is not None or self.connections.tracer is not None:
+            self.received_time = time.time()
+
+        splice_peer = self.splice_peer
+        if splice_peer is not None and not splice_peer.write_blocked \
+                and not splice_peer.outbox and self.can_splice(data) \
+                and self.can_relay(data):
+            splice_peer.write_data(data)
+            if metrics is not None:
+                metrics.spliced(len(data))
+            if self.connections.recorder is not None:
+                self.connections.recorder.lines_received(self, data)
+            return
+
+        LineReceiver.dataReceived(self, data)
+
+    def can_relay(self, data):
+        rate_limiter = self.connections.rate_limiter
+        if rate_limiter is None:
+            return True
 
-        #disconect from endpoint
-        ProtocolConnections.disconnect_protocol(self)
+        #chunk over the limit falls back to line handling which sheds or
+        #delays single lines
+        return rate_limiter.take(self, 'RE', data.count(self.delimiter))
+
+    def can_splice(self, data):
+        #only whole chunks of complete RE lines are forwarded untouched
+        if self._buffer or self._busyReceiving or self.paused \
+                or not self.line_mode:
+            return False
+
+        if len(data) > self.MAX_LENGTH:
+            return False
+
+        if not data.startswith('RE:') or not data.endswith(self.delimiter):
+            return False
+
+        lines_count = data.count(self.delimiter)
+        return lines_count == data.count(self.delimiter + 'RE:') + 1
 
     def lineReceived(self, line):
-        log.msg("line received: {}".format(line))
+        if logger.is_sampled(DEBUG, line[:2]):
+            logger.debug("line received: {}", line)
+
+        self.connections.line_received(self, line)
+
+    def start_binary_framing(self):
+        self.binary_framing = True
+        self.frame_buffer = FrameBuffer()
+        self.setRawMode()
+
+    def rawDataReceived(self, data):
+        if not self.frame_buffer.feed(data, self.frameReceived):
+            logger.error('ERROR - invalid frame from {}', self.name)
+            self.transport.loseConnection()
+
+    def frameReceived(self, opcode, body):
+        self.lineReceived(decode_frame(opcode, body))
+
+    def sendLine(self, line):
+        if self.write_blocked or self.outbox:
+            self.queue_line(line)
+            return
+
+        self.write_line(line)
+
+    def send_lines(self, lines):
+        #lines delivered at once are handed to the transport in one write
+        if self.write_blocked or self.outbox:
+            for line in lines:
+                self.queue_line(line)
+            return
+
+        if self.binary_framing:
+            data = ''.join([self.encode_line(line) for line in lines])
+        else:
+            data = self.delimiter.join(lines) + self.delimiter
+        self.write_data(data)
+
+    def write_line(self, line):
+        if self.binary_framing:
+            return self.write_data(self.encode_line(line))
+
+        return self.write_data(line + self.delimiter)
+
+    def encode_line(self, line):
+        #RE communicates are compressed when they are written, so queued
+        #ones may still be dropped or replaced
+        if self.codec is not None and line[:3] == 'RE:':
+            line = 'RZ:' + self.compress(line[3:])
+
+        return encode_frame(line)
+
+    def compress(self, body):
+        metrics = self.connections.metrics
+        if metrics is None:
+            return self.codec.compress(body)
+
+        start = time.time()
+        data = self.codec.compress(body)
+        metrics.compressed(len(body), len(data), time.time() - start)
+        return data
+
+    def decompress(self, data):
+        start = time.time()
+        try:
+            body = self.codec.decompress(data)
+        except zlib.error:
+            logger.error('ERROR - invalid compressed data from {}', self.name)
+            return None
+
+        metrics = self.connections.metrics
+        if metrics is not None:
+            metrics.decompressed(len(body), len(data), time.time() - start)
+        return body
+
+    def write_data(self, data):
+        if self.trace is not None:
+            self.trace_written()
+
+        write_batch = self.write_batch
+        if write_batch is None:
+            self.transport.write(data)
+            if self.outbox is not None:
+                self.check_write_buffer()
+            return
+
+        if not write_batch:
+            self.connections.flush_later(self)
+        write_batch.append(data)
+        self.batch_size += len(data)
+
+        if self.batch_size >= self.connections.batch_size:
+            self.flush_writes()
+
+    def flush_writes(self):
+        write_batch = self.write_batch
+        if not write_batch:
+            return
+
+        if self.connected:
+            self.transport.writeSequence(write_batch)
+            if self.outbox is not None:
+                self.check_write_buffer()
+        del write_batch[:]
+        self.batch_size = 0
+
+        batch_traces = self.batch_traces
+        if batch_traces:
+            if self.connected:
+                flushed = time.time()
+                for trace in batch_traces:
+                    trace.flushed = flushed
+            del batch_traces[:]
+
+    def trace_written(self):
+        trace = self.trace
+        self.trace = None
+        trace.written = time.time()
+
+        if self.write_batch is None:
+            trace.flushed = trace.written
+        else:
+            if self.batch_traces is None:
+                self.batch_traces = []
+            self.batch_traces.append(trace)
+
+    def pop_queued_trace(self):
+        #trace of the line at the head of the outbox
+        queued_traces = self.queued_traces
+        if queued_traces and queued_traces[0][0] == self.outbox_popped:
+            return queued_traces.popleft()[1]
+        return None
+
+    def send_coalesced(self, line, key):
+        if self.write_blocked or self.outbox:
+            self.queue_line(line, key)
+            return
+
+        self.write_line(line)
+
+    def queue_line(self, line, key=None):
+        outbox = self.outbox
+
+        if key is not None:
+            #outbox_keys holds positions counted from the first line ever
+            #queued, positions before outbox_popped were already sent
+            index = self.outbox_keys.get(key)
+            if index is not None and index >= self.outbox_popped:
+                position = index - self.outbox_popped
+                self.outbox_size += len(line) - len(outbox[position])
+                outbox[position] = line
+                self.coalesced_lines += 1
+                self.trace = None
+                return
 
-        ProtocolConnections.line_received(self, line)
+            index = self.outbox_popped + len(outbox)
+            self.outbox_keys[key] = index
+            self.outbox_key_positions.append((index, key))
+
+        if self.trace is not None:
+            if self.queued_traces is None:
+                self.queued_traces = deque()
+            self.queued_traces.append(
+                (self.outbox_popped + len(outbox), self.trace)
+            )
+            self.trace = None
+
+        outbox.append(line)
+        self.outbox_size += len(line)
+
+        if self.connections.drop_oldest or self.observed is not None:
+            self.drop_oldest_lines()
+
+    def drop_oldest_lines(self):
+        outbox = self.outbox
+        high_water = self.connections.high_water
+
+        #only relayed communicates may be dropped, never control lines
+        while self.outbox_size > high_water and outbox \
+                and outbox[0][:3] in ('RE:', 'RZ:'):
+            if self.queued_traces:
+                self.pop_queued_trace()
+            self.outbox_size -= len(outbox.popleft())
+            self.outbox_popped += 1
+            self.dropped_lines += 1
+
+        if self.outbox_key_positions:
+            self.forget_sent_keys()
+
+    def forget_sent_keys(self):
+        #keys of lines which were sent or dropped are removed with them,
+        #so outbox_keys holds only keys of queued lines
+        key_positions = self.outbox_key_positions
+        outbox_keys = self.outbox_keys
+        while key_positions and key_positions[0][0] < self.outbox_popped:
+            index, key = key_positions.popleft()
+            if outbox_keys.get(key) == index:
+                del outbox_keys[key]
+
+    def check_write_buffer(self):
+        if not self.write_blocked and get_write_buffer_size(
+                self.transport) > self.connections.high_water:
+            self.write_paused()
+
+    def write_paused(self):
+        self.write_blocked = True
+        if not self.connections.drop_oldest:
+            self.pause_sender()
+
+    def write_resumed(self):
+        self.write_blocked = False
+
+        outbox = self.outbox
+        while outbox and not self.write_blocked:
+            line = outbox.popleft()
+            if self.queued_traces:
+                self.trace = self.pop_queued_trace()
+            self.outbox_size -= len(line)
+            self.outbox_popped += 1
+            self.write_line(line)
+
+        if self.outbox_key_positions:
+            self.forget_sent_keys()
+
+        if not self.write_blocked \
+                and self.outbox_size <= self.connections.low_water:
+            self.resume_senders()
+
+    def pause_sender(self):
+        sender = self.endpoint
+        if sender is None or sender.remote or sender in self.paused_senders:
+            return
+
+        self.paused_senders.add(sender)
+        sender.pause_reading('flow')
+
+    def resume_senders(self):
+        paused_senders = self.paused_senders
+        self.paused_senders = set()
+
+        for sender in paused_senders:
+            sender.resume_reading('flow')
+
+    def pause_reading(self, reason):
+        #reading is paused by flow control or rate limiter, it is resumed
+        #once all of them resume it
+        if not self.pause_reasons:
+            self.pause_reasons = set()
+            self.pauseProducing()
+        self.pause_reasons.add(reason)
+
+    def resume_reading(self, reason):
+        pause_reasons = self.pause_reasons
+        if not pause_reasons or reason not in pause_reasons:
+            return
+
+        pause_reasons.remove(reason)
+        if not pause_reasons and self.connected:
+            self.resumeProducing()
 
     def reset(self):
         self.name = None
+        self.delta_updates = False
+        self.latest_wins = False
+        self.resume_token = None
         self.disconnect_endpoint()
 
     def connect_endpoint(self, protocol):
@@ -249,37 +1621,392 @@ class ServerProtocol(LineReceiver):
 
     def disconnect_endpoint(self):
         self.endpoint = None
+        self.splice_peer = None
+
+    def start_splice(self, peer_protocol):
+        self.splice_peer = peer_protocol
 
     def get_endpoint(self):
         return self.endpoint
 
 
 class ServerFactory(Factory):
+    """
+    every factory owns its connections registry, clients of different
+    factories (e.g. listening on different ports) cannot see each other
+    """
+
+    def __init__(self, connections=None):
+        if connections is None:
+            connections = ProtocolConnections()
+        self.connections = connections
 
     def buildProtocol(self, addr):
-        return ServerProtocol()
+        return ServerProtocol(self.connections)
 
 
 def main():
     DEFAULT_PORT = 8123
 
-    log.startLogging(sys.stdout)
-
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "-p", "--port",
-        help="port on which server will listen for connections",
+        help="port on which server will listen for connections, "
+             "may be given multiple times, each port gets separate "
+             "namespace of devices and controllers",
+        type=int,
+        action="append",
+    )
+    parser.add_argument(
+        "--splice",
+        help="forward RE traffic of paired clients without parsing it",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--broadcast-delay",
+        help="coalesce device list notifications sent to controllers "
+             "within given number of milliseconds",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--log-level",
+        help="minimal level of logged messages",
+        choices=sorted(LEVELS),
+        default="debug",
+    )
+    parser.add_argument(
+        "--log-sample",
+        help="log only every N-th received line of given command, "
+             "e.g. RE=100, may be given multiple times",
+        action="append",
+        default=[],
+    )
+    parser.add_argument(
+        "--log-flush-interval",
+        help="buffer log output and write it every given number of "
+             "milliseconds instead of on every message",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--high-water",
+        help="pause reading from client's endpoint once more than given "
+             "number of bytes waits to be sent to the client, "
+             "0 disables flow control",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--low-water",
+        help="resume reading from paused endpoint once less than given "
+             "number of bytes waits to be sent",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--drop-oldest",
+        help="drop oldest waiting RE communicates instead of pausing "
+             "the endpoint, requires --high-water",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--resume-grace",
+        help="keep name and pairing of disconnected client for given "
+             "number of milliseconds so it can resume its session, "
+             "0 disables session resumption",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--idle-timeout",
+        help="abort connections silent for given number of milliseconds, "
+             "clients keep idle connections alive with HB, 0 disables it",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--batch-writes",
+        help="collect data written to every client and write it once per "
+             "event loop iteration",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--batch-size",
+        help="write collected data once it exceeds given number of bytes",
+        type=int,
+        default=65536,
+    )
+    parser.add_argument(
+        "--tcp-nodelay",
+        help="disable Nagle's algorithm on client connections",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--rate-limit",
+        help="limit lines of given command sent by every client to RATE "
+             "per second with bursts of BURST lines (RATE but at least 1 "
+             "by default), * limits all lines, may be given multiple times",
+        metavar="CMD=RATE[:BURST]",
+        action="append",
+        default=[],
+    )
+    parser.add_argument(
+        "--rate-limit-delay",
+        help="pause reading from clients over their rate limit instead "
+             "of dropping their excess lines",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--forward-hold",
+        help="keep controller paired with disconnected device for given "
+             "number of milliseconds storing its RE communicates until "
+             "the device connects again, 0 disables store and forward",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--forward-ttl",
+        help="evict stored RE communicates older than given number of "
+             "milliseconds, --forward-hold by default",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--forward-size",
+        help="evict oldest stored RE communicates once they exceed given "
+             "number of bytes per device",
+        type=int,
+        default=65536,
+    )
+    parser.add_argument(
+        "--trace-sample",
+        help="trace every N-th relayed RE communicate, traces are queried "
+             "with TQ command from localhost, 0 disables tracing",
+        metavar="N",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--trace-size",
+        help="number of the latest traces kept",
+        type=int,
+        default=1000,
+    )
+    parser.add_argument(
+        "--record",
+        help="append lines received from clients to given binary log "
+             "for rover_server_replay, worker processes append their id "
+             "to the file name",
+        metavar="FILE",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        help="serve metrics in Prometheus text format on given "
+             "localhost port, worker processes use consecutive ports "
+             "starting from it, 0 disables metrics",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--backend",
+        help="event loop running the server, asyncio runs on trollius "
+             "on Python 2, uvloop requires uvloop package",
+        choices=['twisted', 'asyncio', 'uvloop'],
+        default='twisted',
+    )
+    parser.add_argument(
+        "--workers",
+        help="number of worker processes sharing the port, "
+             "0 runs the server in this process",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--node-id",
+        help="run as node of federation with given unique id, devices of "
+             "all nodes are available to controllers of every node",
+    )
+    parser.add_argument(
+        "--node-port",
+        help="port on which federation node accepts links of other nodes",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--peer",
+        help="federation node to link to, every pair of nodes has to be "
+             "linked once, may be given multiple times",
+        metavar="HOST:PORT",
+        action="append",
+        default=[],
+    )
+    parser.add_argument(
+        "--coordinator",
+        help=argparse.SUPPRESS,
         required=False,
     )
+    parser.add_argument(
+        "--worker-id",
+        help=argparse.SUPPRESS,
+        default="0",
+    )
 
     args = parser.parse_args()
 
-    port = DEFAULT_PORT
-    if args.port:
-        port = int(args.port)
+    logger.level = LEVELS[args.log_level]
+    for sample in args.log_sample:
+        try:
+            command, rate = sample.split('=', 1)
+            rate = int(rate)
+        except ValueError:
+            parser.error("invalid log sample: {}".format(sample))
+
+        if rate < 1:
+            parser.error("log sample {} has to be positive".format(sample))
+        logger.set_sample_rate(command, rate)
+
+    rate_limits = {}
+    for rate_limit in args.rate_limit:
+        try:
+            command, limit = rate_limit.split('=', 1)
+            rate, _, burst = limit.partition(':')
+            rate = float(rate)
+            #bucket with less than one token never lets a line through
+            burst = float(burst) if burst else max(rate, 1.0)
+        except ValueError:
+            parser.error("invalid rate limit: {}".format(rate_limit))
+
+        if rate <= 0 or burst < 1:
+            parser.error(
+                "rate limit {} needs positive rate and burst of at least "
+                "1".format(rate_limit)
+            )
+        rate_limits[command] = (rate, burst)
+
+    peers = []
+    for peer in args.peer:
+        try:
+            host, port = peer.rsplit(':', 1)
+            peers.append((host, int(port)))
+        except ValueError:
+            parser.error("invalid peer: {}".format(peer))
+
+    if args.node_id is None and (peers or args.node_port > 0):
+        parser.error("--peer and --node-port require --node-id")
+
+    loop = None
+    clock = reactor
+    if args.backend != 'twisted':
+        if aio.asyncio is None:
+            parser.error("asyncio backend requires asyncio or trollius")
+        if args.backend == 'uvloop' and aio.uvloop is None:
+            parser.error("uvloop backend requires uvloop")
+        if args.workers > 0 or args.coordinator or args.metrics_port > 0 \
+                or args.node_id is not None:
+            parser.error(
+                "{} backend supports neither workers, metrics nor "
+                "federation".format(args.backend)
+            )
+        loop = aio.get_event_loop(args.backend == 'uvloop')
+        clock = aio.AsyncioClock(loop)
+
+    if args.log_flush_interval > 0:
+        log_file = BufferedLogFile(
+            sys.stdout, args.log_flush_interval / 1000.0, clock=clock
+        )
+        log_file.start()
+    else:
+        log_file = sys.stdout
+
+    log.startLogging(log_file)
+
+    if args.drop_oldest and args.high_water <= 0:
+        parser.error("--drop-oldest requires --high-water")
+
+    ports = args.port or [DEFAULT_PORT]
+    if len(ports) > 1 and (args.workers > 0 or args.coordinator):
+        parser.error("worker processes support single port only")
+    if args.node_id is not None:
+        if len(ports) > 1:
+            parser.error("federation node supports single port only")
+        if args.workers > 0 or args.coordinator:
+            parser.error("federation node cannot run worker processes")
+
+    metrics = None
+    if args.metrics_port > 0 and args.workers <= 0:
+        metrics = Metrics()
+        metrics_port = args.metrics_port
+        if args.coordinator:
+            metrics_port += int(args.worker_id)
+        listen_metrics(metrics_port, metrics)
+
+    recorder = None
+    if args.record and args.workers <= 0:
+        record_path = args.record
+        if args.coordinator:
+            record_path = '{}.{}'.format(record_path, args.worker_id)
+        recorder = Recorder(open(record_path, 'ab'), clock=clock)
+        recorder.start()
+
+    factories = []
+    for port in ports:
+        connections = ProtocolConnections(
+            splice_relay=args.splice,
+            broadcast_delay=args.broadcast_delay / 1000.0,
+            high_water=args.high_water,
+            low_water=args.low_water,
+            drop_oldest=args.drop_oldest,
+            resume_grace=args.resume_grace / 1000.0,
+            idle_timeout=args.idle_timeout / 1000.0,
+            batch_writes=args.batch_writes,
+            batch_size=args.batch_size,
+            tcp_nodelay=args.tcp_nodelay,
+            rate_limits=rate_limits,
+            rate_limit_delay=args.rate_limit_delay,
+            forward_hold=args.forward_hold / 1000.0,
+            forward_ttl=args.forward_ttl / 1000.0,
+            forward_size=args.forward_size,
+            trace_sample=args.trace_sample,
+            trace_size=args.trace_size,
+            clock=clock,
+        )
+        if metrics is not None:
+            metrics.add_registry(connections)
+        if recorder is not None:
+            recorder.add_registry(connections)
+        factories.append((port, ServerFactory(connections)))
+
+    if loop is not None:
+        aio.run_asyncio(loop, factories)
+    elif args.workers > 0:
+        start_coordinator(args.workers, sys.argv[1:])
+    elif args.coordinator:
+        port, factory = factories[0]
+        start_worker(
+            factory.connections,
+            args.coordinator,
+            args.worker_id,
+            port,
+            factory,
+        )
+    else:
+        if args.node_id is not None:
+            port, factory = factories[0]
+            start_federation(
+                factory.connections, args.node_id, args.node_port, peers
+            )
+        for port, factory in factories:
+            reactor.listenTCP(port, factory)
+
+    if loop is None:
+        reactor.run()
+
+    if recorder is not None:
+        recorder.stop()
 
-    reactor.listenTCP(port, ServerFactory())
-    reactor.run()
+    if args.log_flush_interval > 0:
+        log_file.stop()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,109 @@
+import time
+from collections import deque
+
+
+LOCAL_HOSTS = ('127.0.0.1', '::1')
+
+
+class Trace(object):
+    """
+    timestamps of single relayed RE communicate
+
+    received - chunk with the communicate was read from the sender
+    dispatched - relay handler got the parsed communicate
+    written - communicate was handed to receiver's transport (or its
+        write batch, after waiting in the queue of flow control)
+    flushed - write batch with the communicate was handed to receiver's
+        transport, the same as written without write batching
+
+    timestamps which did not happen (yet) are None, e.g. written of
+    communicate dropped by flow control
+    """
+
+    __slots__ = (
+        'trace_id', 'sender', 'receiver', 'size', 'received', 'dispatched',
+        'written', 'flushed',
+    )
+
+    def __init__(self, trace_id, sender, receiver, size, received,
+                 dispatched):
+        self.trace_id = trace_id
+        self.sender = sender
+        self.receiver = receiver
+        self.size = size
+        self.received = received
+        self.dispatched = dispatched
+        self.written = None
+        self.flushed = None
+
+    def get_latency(self):
+        last = self.flushed or self.written or self.dispatched
+        return last - self.received
+
+    def get_line(self):
+        return 'TR:{}:{}:{}:{}:{:.6f}:{}:{}:{}'.format(
+            self.trace_id, self.sender, self.receiver, self.size,
+            self.received, self.get_delay(self.dispatched),
+            self.get_delay(self.written), self.get_delay(self.flushed)
+        )
+
+    def get_delay(self, timestamp):
+        #microseconds since the communicate was received
+        if timestamp is None:
+            return '-'
+
+        return int((timestamp - self.received) * 1000000)
+
+
+class Tracer(object):
+    """
+    samples every sample_rate-th RE communicate relayed by connections
+    registry, traces of the last size sampled communicates are kept in
+    ring buffer, so memory does not grow with traffic
+    """
+
+    def __init__(self, sample_rate, size=1000):
+        self.sample_rate = sample_rate
+        self.traces = deque(maxlen=size)
+        self.skipped = 0
+        self.last_id = 0
+
+    def sample(self, sender, receiver, size):
+        self.skipped += 1
+        if self.skipped < self.sample_rate:
+            return None
+
+        self.skipped = 0
+        self.last_id += 1
+        trace = Trace(
+            self.last_id, sender.name, receiver.name, size,
+            sender.received_time, time.time()
+        )
+        self.traces.append(trace)
+        return trace
+
+    def query(self, count, min_latency=0):
+        """
+        returns up to count latest traces with latency (in seconds, from
+        receiving to the last timestamp) of at least min_latency
+        """
+        traces = []
+        for trace in reversed(self.traces):
+            if len(traces) >= count:
+                break
+            if trace.get_latency() >= min_latency:
+                traces.append(trace)
+
+        traces.reverse()
+        return traces
+
+
+def is_local_client(protocol):
+    #twisted transports return address objects, asyncio ones tuples
+    peer = protocol.transport.getPeer()
+    if isinstance(peer, tuple):
+        host = peer[0]
+    else:
+        host = getattr(peer, 'host', None)
+
+    return host in LOCAL_HOSTS
@@ -64,6 +64,8 @@ setup(
     entry_points={
         'console_scripts': [
             'rover_server = rover_server.server:main',
+            'rover_server_bench = rover_server.bench:main',
+            'rover_server_replay = rover_server.replay:main',
         ]
     },
     tests_require=['tox'],
@@ -1,30 +1,64 @@
+import io
+import time
+import zlib
+
 from twisted.trial import unittest
 from twisted.test import proto_helpers
+from twisted.internet import task
+from twisted.internet.protocol import Protocol
+from twisted.test import iosim
+from twisted.internet.address import IPv4Address
 
 from rover_server.server import ServerFactory
 from rover_server.server import ServerProtocol
 from rover_server.server import ProtocolConnections
+from rover_server.logger import Logger
+from rover_server.logger import BufferedLogFile
+from rover_server.logger import DEBUG
+from rover_server.logger import INFO
+from rover_server.bench import Benchmark
+from rover_server.cluster import CoordinatorFactory
+from rover_server.cluster import WorkerProtocol
+from rover_server.cluster import WorkerProcessProtocol
+from rover_server.federation import Federation
+from rover_server.federation import FederationLink
+from rover_server.framing import encode_frame
+from rover_server.framing import FrameBuffer
+from rover_server.framing import FRAME_HEADER
+from rover_server.framing import COMMAND_OPCODES
+from rover_server.metrics import Metrics
+from rover_server.recorder import Recorder
+from rover_server.recorder import read_records
+from rover_server.recorder import CONNECT_EVENT
+from rover_server.recorder import LINE_EVENT
+from rover_server.recorder import DISCONNECT_EVENT
+from rover_server.replay import Replay
+from rover_server import aio
 
 
 END_LINE = '\r\n'
-DEVICE_NAME = 'mock-client'
-CONTROLLER_NAME = 'mock-controller'
+DEVICE_NAME = 'mock_client'
+CONTROLLER_NAME = 'mock_controller'
 
 
 class ProtocolConnectionsLineRecievedTest(unittest.TestCase):
 
     def setUp(self):
 
-        self.tr_device = proto_helpers.StringTransport()
-        self.proto_device = ServerProtocol()
-        self.proto_device.makeConnection(self.tr_device)
+        self.connections = ProtocolConnections()
 
-        self.proto_controller = ServerProtocol()
-        self.tr_controller = proto_helpers.StringTransport()
-        self.proto_controller.makeConnection(self.tr_controller)
+        self.proto_device, self.tr_device = self.connect_client()
+        self.proto_controller, self.tr_controller = self.connect_client()
 
     def tearDown(self):
-        ProtocolConnections.reset()
+        self.connections.reset()
+
+    def connect_client(self):
+        #scenarios run on other backends too, see BackendClient
+        return proto_factory(self.connections)
+
+    def get_protocol(self, proto):
+        return proto
 
     def test_new_device_connecting(self):
 
@@ -40,13 +74,13 @@ class ProtocolConnectionsLineRecievedTest(unittest.TestCase):
         self.assertEqual(r_for_controller, EXPECTED_R_FOR_C)
         self.assertEqual(r_for_device, EXPECTED_R_FOR_D)
 
-        self.assertEqual(len(ProtocolConnections.devices), 1)
-        self.assertEqual(len(ProtocolConnections.controllers), 0)
-        assert DEVICE_NAME in ProtocolConnections.devices
+        self.assertEqual(len(self.connections.devices), 1)
+        self.assertEqual(len(self.connections.controllers), 0)
+        assert DEVICE_NAME in self.connections.devices
 
-        self.assertEqual(len(ProtocolConnections.protocols), 1)
-        self.assertEqual(ProtocolConnections.protocols[DEVICE_NAME],
-                         self.proto_device)
+        self.assertEqual(len(self.connections.protocols), 1)
+        self.assertEqual(self.connections.protocols[DEVICE_NAME],
+                         self.get_protocol(self.proto_device))
 
     def test_new_controller_connecting(self):
 
@@ -62,13 +96,13 @@ class ProtocolConnectionsLineRecievedTest(unittest.TestCase):
         self.assertEqual(r_for_controller, EXPECTED_R_FOR_C)
         self.assertEqual(r_for_device, EXPECTED_R_FOR_D)
 
-        self.assertEqual(len(ProtocolConnections.controllers), 1)
-        self.assertEqual(len(ProtocolConnections.devices), 0)
-        assert CONTROLLER_NAME in ProtocolConnections.controllers
+        self.assertEqual(len(self.connections.controllers), 1)
+        self.assertEqual(len(self.connections.devices), 0)
+        assert CONTROLLER_NAME in self.connections.controllers
 
-        self.assertEqual(len(ProtocolConnections.protocols), 1)
-        self.assertEqual(ProtocolConnections.protocols[CONTROLLER_NAME],
-                         self.proto_controller)
+        self.assertEqual(len(self.connections.protocols), 1)
+        self.assertEqual(self.connections.protocols[CONTROLLER_NAME],
+                         self.get_protocol(self.proto_controller))
 
     def test_controller_connects_after_device(self):
 
@@ -89,15 +123,15 @@ class ProtocolConnectionsLineRecievedTest(unittest.TestCase):
         self.assertEqual(r_for_controller, EXPECTED_R_FOR_C)
         self.assertEqual(r_for_device, EXPECTED_R_FOR_D)
 
-        self.assertEqual(len(ProtocolConnections.controllers), 1)
-        self.assertEqual(len(ProtocolConnections.devices), 1)
-        assert CONTROLLER_NAME in ProtocolConnections.controllers
+        self.assertEqual(len(self.connections.controllers), 1)
+        self.assertEqual(len(self.connections.devices), 1)
+        assert CONTROLLER_NAME in self.connections.controllers
 
-        self.assertEqual(len(ProtocolConnections.protocols), 2)
-        self.assertEqual(ProtocolConnections.protocols[DEVICE_NAME],
-                         self.proto_device)
-        self.assertEqual(ProtocolConnections.protocols[CONTROLLER_NAME],
-                         self.proto_controller)
+        self.assertEqual(len(self.connections.protocols), 2)
+        self.assertEqual(self.connections.protocols[DEVICE_NAME],
+                         self.get_protocol(self.proto_device))
+        self.assertEqual(self.connections.protocols[CONTROLLER_NAME],
+                         self.get_protocol(self.proto_controller))
 
     def test_device_connects_after_controller(self):
 
@@ -119,15 +153,15 @@ class ProtocolConnectionsLineRecievedTest(unittest.TestCase):
         self.assertEqual(r_for_controller, EXPECTED_R_FOR_C)
         self.assertEqual(r_for_device, EXPECTED_R_FOR_D)
 
-        self.assertEqual(len(ProtocolConnections.controllers), 1)
-        self.assertEqual(len(ProtocolConnections.devices), 1)
-        assert CONTROLLER_NAME in ProtocolConnections.controllers
+        self.assertEqual(len(self.connections.controllers), 1)
+        self.assertEqual(len(self.connections.devices), 1)
+        assert CONTROLLER_NAME in self.connections.controllers
 
-        self.assertEqual(len(ProtocolConnections.protocols), 2)
-        self.assertEqual(ProtocolConnections.protocols[DEVICE_NAME],
-                         self.proto_device)
-        self.assertEqual(ProtocolConnections.protocols[CONTROLLER_NAME],
-                         self.proto_controller)
+        self.assertEqual(len(self.connections.protocols), 2)
+        self.assertEqual(self.connections.protocols[DEVICE_NAME],
+                         self.get_protocol(self.proto_device))
+        self.assertEqual(self.connections.protocols[CONTROLLER_NAME],
+                         self.get_protocol(self.proto_controller))
 
     def test_device_disconnects_after_controller_connects(self):
 
@@ -152,13 +186,13 @@ class ProtocolConnectionsLineRecievedTest(unittest.TestCase):
         self.assertEqual(r_for_controller, EXPECTED_R_FOR_C)
         self.assertEqual(r_for_device, EXPECTED_R_FOR_D)
 
-        self.assertEqual(len(ProtocolConnections.controllers), 1)
-        self.assertEqual(len(ProtocolConnections.devices), 0)
-        assert CONTROLLER_NAME in ProtocolConnections.controllers
+        self.assertEqual(len(self.connections.controllers), 1)
+        self.assertEqual(len(self.connections.devices), 0)
+        assert CONTROLLER_NAME in self.connections.controllers
 
-        self.assertEqual(len(ProtocolConnections.protocols), 1)
-        self.assertEqual(ProtocolConnections.protocols[CONTROLLER_NAME],
-                         self.proto_controller)
+        self.assertEqual(len(self.connections.protocols), 1)
+        self.assertEqual(self.connections.protocols[CONTROLLER_NAME],
+                         self.get_protocol(self.proto_controller))
 
     def test_controller_connects_to_device(self):
         EXPECTED_R_FOR_C = 'DL:' + DEVICE_NAME + END_LINE
@@ -184,15 +218,15 @@ class ProtocolConnectionsLineRecievedTest(unittest.TestCase):
         self.assertEqual(r_for_controller, EXPECTED_R_FOR_C)
         self.assertEqual(r_for_device, EXPECTED_R_FOR_D)
 
-        self.assertEqual(len(ProtocolConnections.controllers), 1)
-        self.assertEqual(len(ProtocolConnections.devices), 1)
-        assert CONTROLLER_NAME in ProtocolConnections.controllers
+        self.assertEqual(len(self.connections.controllers), 1)
+        self.assertEqual(len(self.connections.devices), 1)
+        assert CONTROLLER_NAME in self.connections.controllers
 
-        self.assertEqual(len(ProtocolConnections.protocols), 2)
-        self.assertEqual(ProtocolConnections.protocols[DEVICE_NAME],
-                         self.proto_device)
-        self.assertEqual(ProtocolConnections.protocols[CONTROLLER_NAME],
-                         self.proto_controller)
+        self.assertEqual(len(self.connections.protocols), 2)
+        self.assertEqual(self.connections.protocols[DEVICE_NAME],
+                         self.get_protocol(self.proto_device))
+        self.assertEqual(self.connections.protocols[CONTROLLER_NAME],
+                         self.get_protocol(self.proto_controller))
 
     def test_device_connected_to_controller_disconetcts(self):
 
@@ -200,7 +234,7 @@ class ProtocolConnectionsLineRecievedTest(unittest.TestCase):
         EXPECTED_R_FOR_C += 'DL:' + END_LINE
         EXPECTED_R_FOR_C += 'CD:OK' + END_LINE
         EXPECTED_R_FOR_C += 'DD:' + END_LINE
-        EXPECTED_R_FOR_C += 'DL:' + END_LINE
+        #paired device was not on the list, no DL is sent
 
         EXPECTED_R_FOR_D = ''
 
@@ -225,25 +259,22 @@ class ProtocolConnectionsLineRecievedTest(unittest.TestCase):
         self.assertEqual(r_for_controller, EXPECTED_R_FOR_C)
         self.assertEqual(r_for_device, EXPECTED_R_FOR_D)
 
-        self.assertEqual(len(ProtocolConnections.controllers), 1)
-        self.assertEqual(len(ProtocolConnections.devices), 0)
-        assert CONTROLLER_NAME in ProtocolConnections.controllers
+        self.assertEqual(len(self.connections.controllers), 1)
+        self.assertEqual(len(self.connections.devices), 0)
+        assert CONTROLLER_NAME in self.connections.controllers
 
-        self.assertEqual(len(ProtocolConnections.protocols), 1)
-        self.assertEqual(ProtocolConnections.protocols[CONTROLLER_NAME],
-                         self.proto_controller)
+        self.assertEqual(len(self.connections.protocols), 1)
+        self.assertEqual(self.connections.protocols[CONTROLLER_NAME],
+                         self.get_protocol(self.proto_controller))
 
 class ProtocolConnectionsRequestsTest(unittest.TestCase):
 
     def setUp(self):
 
-        self.tr_device = proto_helpers.StringTransport()
-        self.proto_device = ServerProtocol()
-        self.proto_device.makeConnection(self.tr_device)
+        self.connections = ProtocolConnections()
 
-        self.proto_controller = ServerProtocol()
-        self.tr_controller = proto_helpers.StringTransport()
-        self.proto_controller.makeConnection(self.tr_controller)
+        self.proto_device, self.tr_device = self.connect_client()
+        self.proto_controller, self.tr_controller = self.connect_client()
 
         #device is connecting
         DC_REQUEST = 'DC:' + DEVICE_NAME + END_LINE
@@ -264,7 +295,14 @@ class ProtocolConnectionsRequestsTest(unittest.TestCase):
         self.expected_r_for_d = ''
 
     def tearDown(self):
-        ProtocolConnections.reset()
+        self.connections.reset()
+
+    def connect_client(self):
+        #scenarios run on other backends too, see BackendClient
+        return proto_factory(self.connections)
+
+    def get_protocol(self, proto):
+        return proto
 
     def test_controller_sends_request_to_device(self):
 
@@ -320,8 +358,8 @@ class ProtocolConnectionsRequestsTest(unittest.TestCase):
         self.assertEqual(r_for_device, self.expected_r_for_d)
 
 
-def proto_factory():
-    proto = ServerProtocol()
+def proto_factory(connections):
+    proto = ServerProtocol(connections)
     tr = proto_helpers.StringTransport()
     proto.makeConnection(tr)
 
@@ -330,50 +368,53 @@ def proto_factory():
 
 class ProtocolConnectionsUnitsTest(unittest.TestCase):
 
+    def setUp(self):
+        self.connections = ProtocolConnections()
+
     def tearDown(self):
-        ProtocolConnections.reset()
+        self.connections.reset()
 
     def test_get_available_devices(self):
 
-        avail_devs = ProtocolConnections.get_available_devices()
+        avail_devs = self.connections.get_available_devices()
         assert avail_devs == []
 
-        DEV1_NAME = 'mock-dev1'
-        proto_d_1, _ = proto_factory()
-        DEV2_NAME = 'mock-dev2'
-        proto_d_2, _ = proto_factory()
-        DEV3_NAME = 'mock-dev3'
-        proto_d_3, _ = proto_factory()
-        CON1_NAME = 'mock-con1'
-        proto_c_1, _ = proto_factory()
-
-        ProtocolConnections.connect_device(proto_d_1, DEV1_NAME)
-        avail_devs = ProtocolConnections.get_available_devices()
+        DEV1_NAME = 'mock_dev1'
+        proto_d_1, _ = proto_factory(self.connections)
+        DEV2_NAME = 'mock_dev2'
+        proto_d_2, _ = proto_factory(self.connections)
+        DEV3_NAME = 'mock_dev3'
+        proto_d_3, _ = proto_factory(self.connections)
+        CON1_NAME = 'mock_con1'
+        proto_c_1, _ = proto_factory(self.connections)
+
+        self.connections.connect_device(proto_d_1, DEV1_NAME)
+        avail_devs = self.connections.get_available_devices()
         assert DEV1_NAME in avail_devs
         assert len(avail_devs) == 1
 
-        ProtocolConnections.connect_device(proto_d_2, DEV2_NAME)
-        avail_devs = ProtocolConnections.get_available_devices()
+        self.connections.connect_device(proto_d_2, DEV2_NAME)
+        avail_devs = self.connections.get_available_devices()
         assert DEV1_NAME in avail_devs
         assert DEV2_NAME in avail_devs
         assert len(avail_devs) == 2
 
-        ProtocolConnections.connect_device(proto_d_3, DEV3_NAME)
-        avail_devs = ProtocolConnections.get_available_devices()
+        self.connections.connect_device(proto_d_3, DEV3_NAME)
+        avail_devs = self.connections.get_available_devices()
         assert DEV1_NAME in avail_devs
         assert DEV2_NAME in avail_devs
         assert DEV3_NAME in avail_devs
         assert len(avail_devs) == 3
 
-        ProtocolConnections.connect_controller(proto_c_1, CON1_NAME)
-        ProtocolConnections.make_connection(proto_d_1, proto_c_1)
-        avail_devs = ProtocolConnections.get_available_devices()
+        self.connections.connect_controller(proto_c_1, CON1_NAME)
+        self.connections.make_connection(proto_d_1, proto_c_1)
+        avail_devs = self.connections.get_available_devices()
         assert DEV2_NAME in avail_devs
         assert DEV3_NAME in avail_devs
         assert len(avail_devs) == 2
 
-        ProtocolConnections.disconnect_protocol(proto_c_1)
-        avail_devs = ProtocolConnections.get_available_devices()
+        self.connections.disconnect_protocol(proto_c_1)
+        avail_devs = self.connections.get_available_devices()
         assert DEV1_NAME in avail_devs
         assert DEV2_NAME in avail_devs
         assert DEV3_NAME in avail_devs
@@ -381,26 +422,1733 @@ class ProtocolConnectionsUnitsTest(unittest.TestCase):
 
     def test_connect_device(self):
 
-        DEVICE_NAME = 'mock-dev'
-        proto_dev, _ = proto_factory()
+        DEVICE_NAME = 'mock_dev'
+        proto_dev, _ = proto_factory(self.connections)
 
-        CONTROLLER_NAME = 'mock-con'
-        proto_con, tr_con = proto_factory()
+        CONTROLLER_NAME = 'mock_con'
+        proto_con, tr_con = proto_factory(self.connections)
 
         EXPECTED_R_FOR_C = 'DL:' + END_LINE
         EXPECTED_R_FOR_C += 'DL:' + DEVICE_NAME + END_LINE
 
-        assert len(ProtocolConnections.devices) == 0
-        assert len(ProtocolConnections.protocols) == 0
+        assert len(self.connections.devices) == 0
+        assert len(self.connections.protocols) == 0
 
-        ProtocolConnections.connect_controller(proto_con, CONTROLLER_NAME)
-        ProtocolConnections.connect_device(proto_dev, DEVICE_NAME)
+        self.connections.connect_controller(proto_con, CONTROLLER_NAME)
+        self.connections.connect_device(proto_dev, DEVICE_NAME)
 
-        assert len(ProtocolConnections.devices) == 1
-        assert len(ProtocolConnections.protocols) == 2
-        assert DEVICE_NAME in ProtocolConnections.devices
-        assert proto_dev == ProtocolConnections.protocols[DEVICE_NAME]
+        assert len(self.connections.devices) == 1
+        assert len(self.connections.protocols) == 2
+        assert DEVICE_NAME in self.connections.devices
+        assert proto_dev == self.connections.protocols[DEVICE_NAME]
 
         #make sure connected controllers get notified about new device
         resp_for_controller = tr_con.value()
         assert resp_for_controller == EXPECTED_R_FOR_C
+
+    def test_devices_list_line_is_cached(self):
+        proto_dev, _ = proto_factory(self.connections)
+        proto_con, _ = proto_factory(self.connections)
+
+        self.connections.connect_device(proto_dev, 'cache_dev')
+        line = self.connections.get_devices_list_line()
+        assert line == 'DL:cache_dev'
+        assert self.connections.get_devices_list_line() is line
+
+        self.connections.connect_controller(proto_con, 'cache_con')
+        self.connections.make_connection(proto_dev, proto_con)
+        assert self.connections.get_devices_list_line() == 'DL:'
+
+        self.connections.disconnect_protocol(proto_con)
+        assert self.connections.get_devices_list_line() == 'DL:cache_dev'
+
+
+    def test_factories_have_independent_registries(self):
+        factory_1 = ServerFactory()
+        factory_2 = ServerFactory()
+
+        proto_1 = factory_1.buildProtocol(None)
+        proto_1.makeConnection(proto_helpers.StringTransport())
+        proto_2 = factory_2.buildProtocol(None)
+        tr_2 = proto_helpers.StringTransport()
+        proto_2.makeConnection(tr_2)
+
+        proto_1.dataReceived('DC:fleet_dev' + END_LINE)
+        proto_2.dataReceived('DC:fleet_dev' + END_LINE)
+
+        assert tr_2.value() == ''
+        assert factory_1.connections.protocols['fleet_dev'] == proto_1
+        assert factory_2.connections.protocols['fleet_dev'] == proto_2
+
+class ProtocolConnectionsSpliceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.connections = ProtocolConnections(splice_relay=True)
+
+        self.proto_dev, self.tr_dev = proto_factory(self.connections)
+        self.proto_con, self.tr_con = proto_factory(self.connections)
+
+        self.proto_dev.dataReceived('DC:splice_dev' + END_LINE)
+        self.proto_con.dataReceived('CC:splice_con' + END_LINE)
+        self.proto_con.dataReceived('CD:splice_dev' + END_LINE)
+
+        self.tr_dev.clear()
+        self.tr_con.clear()
+
+    def tearDown(self):
+        self.connections.reset()
+
+    def test_re_chunk_is_forwarded_unparsed(self):
+        CHUNK = 'RE:1:0:0' + END_LINE + 'RE:2:0:0' + END_LINE
+
+        self.proto_con.dataReceived(CHUNK)
+
+        assert self.proto_dev.splice_peer == self.proto_con
+        assert self.tr_dev.value() == CHUNK
+        assert self.tr_con.value() == ''
+
+    def test_mixed_chunk_falls_back_to_line_handling(self):
+        CHUNK = 'RE:1:0:0' + END_LINE + 'XX:' + END_LINE
+
+        self.proto_con.dataReceived(CHUNK)
+
+        assert self.tr_dev.value() == 'RE:1:0:0' + END_LINE
+        assert self.tr_con.value() == 'SE:E_10' + END_LINE
+
+    def test_partial_line_falls_back_to_line_handling(self):
+        self.proto_con.dataReceived('RE:1:0')
+        self.proto_con.dataReceived(':0' + END_LINE)
+
+        assert self.tr_dev.value() == 'RE:1:0:0' + END_LINE
+
+    def test_splice_stops_on_disconnect(self):
+        self.proto_dev.connectionLost('network failure')
+
+        assert self.proto_con.splice_peer is None
+
+
+class ProtocolConnectionsBroadcastTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.connections = ProtocolConnections(
+            broadcast_delay=0.05, clock=self.clock
+        )
+
+        self.proto_con, self.tr_con = proto_factory(self.connections)
+        self.connections.connect_controller(self.proto_con, 'bc_con')
+        self.tr_con.clear()
+
+    def tearDown(self):
+        self.connections.reset()
+
+    def test_changes_are_coalesced(self):
+        for i in range(3):
+            proto_dev, _ = proto_factory(self.connections)
+            self.connections.connect_device(proto_dev, 'bc_dev%d' % i)
+
+        assert self.tr_con.value() == ''
+
+        self.clock.advance(0.05)
+        lines = self.tr_con.value().split(END_LINE)
+        assert len(lines) == 2
+        assert sorted(lines[0][3:].split(':')) == \
+            ['bc_dev0', 'bc_dev1', 'bc_dev2']
+
+    def test_delta_notifications(self):
+        self.proto_con.dataReceived('NM:DELTA' + END_LINE)
+        assert self.tr_con.value() == 'NM:OK' + END_LINE
+        self.tr_con.clear()
+
+        proto_dev_1, _ = proto_factory(self.connections)
+        self.connections.connect_device(proto_dev_1, 'bc_dev1')
+        self.clock.advance(0.05)
+
+        proto_dev_2, _ = proto_factory(self.connections)
+        self.connections.connect_device(proto_dev_2, 'bc_dev2')
+        self.connections.disconnect_protocol(proto_dev_1)
+        self.clock.advance(0.05)
+
+        EXPECTED_R_FOR_C = 'DA:bc_dev1' + END_LINE
+        EXPECTED_R_FOR_C += 'DA:bc_dev2' + END_LINE
+        EXPECTED_R_FOR_C += 'DR:bc_dev1' + END_LINE
+        assert self.tr_con.value() == EXPECTED_R_FOR_C
+
+    def test_unknown_notification_mode(self):
+        self.proto_con.dataReceived('NM:XX' + END_LINE)
+        assert self.tr_con.value() == 'NM:E_13' + END_LINE
+
+    def test_unchanged_devices_not_broadcasted(self):
+        #device connects and gets paired within one notification window
+        proto_dev, _ = proto_factory(self.connections)
+        self.connections.connect_device(proto_dev, 'bc_dev')
+        proto_con_2, tr_con_2 = proto_factory(self.connections)
+        self.connections.connect_controller(proto_con_2, 'bc_con2')
+        proto_con_2.dataReceived('CD:bc_dev' + END_LINE)
+        self.clock.advance(0.05)
+
+        #paired device was never on the list
+        proto_dev.connectionLost('network failure')
+        self.clock.advance(0.05)
+
+        assert self.tr_con.value() == ''
+        assert tr_con_2.value().endswith('DD:' + END_LINE)
+        assert self.connections.suppressed_broadcasts == 3
+
+
+class LoggerTest(unittest.TestCase):
+
+    def test_messages_below_level_are_not_formatted(self):
+        logger = Logger(level=INFO)
+
+        class Unformattable(object):
+            def __format__(self, spec):
+                raise AssertionError('formatted')
+
+        logger.debug('value {}', Unformattable())
+        assert not logger.is_enabled(DEBUG)
+        assert logger.is_enabled(INFO)
+
+    def test_sampling(self):
+        logger = Logger(level=DEBUG)
+        logger.set_sample_rate('RE', 3)
+
+        sampled = [logger.is_sampled(DEBUG, 'RE') for _ in range(6)]
+        assert sampled == [True, False, False, True, False, False]
+        assert logger.is_sampled(DEBUG, 'CC')
+
+        logger.level = INFO
+        assert not logger.is_sampled(DEBUG, 'CC')
+
+    def test_buffered_log_file(self):
+        clock = task.Clock()
+        out = io.BytesIO()
+        log_file = BufferedLogFile(out, 0.1, max_size=10, clock=clock)
+        log_file.start()
+
+        log_file.write('abc')
+        log_file.flush()
+        assert out.getvalue() == ''
+
+        clock.advance(0.1)
+        assert out.getvalue() == 'abc'
+
+        log_file.write('0123456789')
+        assert out.getvalue() == 'abc0123456789'
+
+        log_file.stop()
+
+
+class BenchmarkTest(unittest.TestCase):
+
+    def test_benchmark_results(self):
+        bench = Benchmark(
+            devices=3, controllers=2, messages=5, window=2, payload_size=8
+        )
+
+        def check_results(results):
+            assert results['relay_throughput'] > 0
+            assert results['latency_p50'] <= results['latency_p99']
+            assert len(bench.round_trips) == 10
+
+        return bench.run().addCallback(check_results)
+
+
+class CoordinatorTest(unittest.TestCase):
+
+    def setUp(self):
+        factory = CoordinatorFactory()
+
+        self.workers = []
+        for worker_id in ('0', '1'):
+            proto = factory.buildProtocol(None)
+            tr = proto_helpers.StringTransport()
+            proto.makeConnection(tr)
+            proto.dataReceived(encode_frame('HI:' + worker_id))
+            self.workers.append((proto, tr))
+
+    def test_names_are_unique_among_workers(self):
+        (proto_w0, tr_w0), (proto_w1, tr_w1) = self.workers
+
+        proto_w0.dataReceived(encode_frame('RN:dev'))
+        proto_w1.dataReceived(encode_frame('RN:dev'))
+
+        assert tr_w0.value() == encode_frame('RN:OK:dev')
+        assert tr_w1.value() == encode_frame('RN:E_11:dev')
+
+    def test_availability_and_forwarding(self):
+        (proto_w0, tr_w0), (proto_w1, tr_w1) = self.workers
+
+        proto_w0.dataReceived(encode_frame('RN:dev'))
+        proto_w0.dataReceived(encode_frame('DA:dev'))
+        proto_w1.dataReceived(encode_frame('FW:dev:SL:RE:0:0:0'))
+        proto_w1.dataReceived(encode_frame('FW:gone:CD:con'))
+
+        EXPECTED_R_FOR_W0 = encode_frame('RN:OK:dev')
+        EXPECTED_R_FOR_W0 += encode_frame('FW:1:dev:SL:RE:0:0:0')
+        EXPECTED_R_FOR_W1 = encode_frame('DA:0:dev')
+        EXPECTED_R_FOR_W1 += encode_frame('FW:1:con:CE:gone')
+
+        assert tr_w0.value() == EXPECTED_R_FOR_W0
+        assert tr_w1.value() == EXPECTED_R_FOR_W1
+
+        proto_w0.connectionLost('worker failure')
+        assert tr_w1.value().endswith(encode_frame('WL:0'))
+
+    def test_forwarding_long_line_with_delimiters(self):
+        (proto_w0, tr_w0), (proto_w1, tr_w1) = self.workers
+
+        proto_w0.dataReceived(encode_frame('RN:dev'))
+        tr_w0.clear()
+
+        line = 'FW:dev:SL:RE:' + 'a\r\n' * 8192
+        proto_w1.dataReceived(encode_frame(line))
+
+        assert tr_w0.value() == encode_frame('FW:1:' + line[3:])
+        assert not tr_w1.disconnecting
+
+
+class WorkerRespawnTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.clock.running = True
+        self.clock.spawnProcess = self.spawn_process
+        self.clock.stop = self.stop
+        self.spawned = []
+        self.stopped = False
+
+    def spawn_process(self, protocol, executable, args, **kwargs):
+        self.spawned.append(protocol)
+
+    def stop(self):
+        self.stopped = True
+
+    def test_respawn_backs_off_and_stops(self):
+        WorkerProcessProtocol(0, ['worker'], clock=self.clock).spawn()
+
+        delays = []
+        while not self.stopped:
+            self.spawned[-1].processEnded('worker failure')
+            if self.stopped:
+                break
+            delays.append(self.clock.getDelayedCalls()[0].getTime() -
+                          self.clock.seconds())
+            self.clock.advance(delays[-1])
+
+        assert delays == [1, 2, 4, 8, 16, 30, 30, 30, 30, 30]
+        assert len(self.spawned) == 11
+
+    def test_stable_worker_failures_reset(self):
+        protocol = WorkerProcessProtocol(
+            0, ['worker'], failures=5, clock=self.clock
+        )
+        protocol.spawn()
+        self.clock.advance(60)
+
+        protocol.processEnded('worker failure')
+        self.clock.advance(1)
+        assert self.spawned[-1].failures == 1
+
+
+class WorkerProtocolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.connections = ProtocolConnections()
+        self.proto_worker = WorkerProtocol(self.connections, '0')
+        self.tr_worker = proto_helpers.StringTransport()
+        self.proto_worker.transport = self.tr_worker
+        self.connections.cluster = self.proto_worker
+
+        self.proto_con, self.tr_con = proto_factory(self.connections)
+        self.proto_con.dataReceived('CC:cl_con' + END_LINE)
+        self.proto_worker.dataReceived(encode_frame('RN:OK:cl_con'))
+
+    def tearDown(self):
+        self.connections.cluster = None
+        self.connections.reset()
+
+    def test_controller_pairs_with_remote_device(self):
+        self.proto_worker.dataReceived(encode_frame('DA:1:cl_dev'))
+        self.proto_con.dataReceived('CD:cl_dev' + END_LINE)
+        self.proto_worker.dataReceived(encode_frame('FW:1:cl_con:CO:cl_dev'))
+        self.proto_con.dataReceived('RE:0:0:0' + END_LINE)
+
+        EXPECTED_R_FOR_C = 'DL:' + END_LINE
+        EXPECTED_R_FOR_C += 'DL:cl_dev' + END_LINE
+        EXPECTED_R_FOR_C += 'DL:' + END_LINE
+        EXPECTED_R_FOR_C += 'CD:OK' + END_LINE
+
+        EXPECTED_R_FOR_W = encode_frame('RN:cl_con')
+        EXPECTED_R_FOR_W += encode_frame('FW:cl_dev:CD:cl_con')
+        EXPECTED_R_FOR_W += encode_frame('FW:cl_dev:SL:RE:0:0:0')
+
+        assert self.tr_con.value() == EXPECTED_R_FOR_C
+        assert self.tr_worker.value() == EXPECTED_R_FOR_W
+
+        self.proto_worker.dataReceived(encode_frame('WL:1'))
+        assert self.proto_con.get_endpoint() is None
+        assert 'cl_dev' not in self.connections.protocols
+
+    def test_delimiter_not_injected_through_link(self):
+        proto_dev, tr_dev = proto_factory(self.connections)
+        proto_dev.dataReceived('BF:' + END_LINE)
+        proto_dev.dataReceived(encode_frame('DC:bin_dev'))
+        self.proto_worker.dataReceived(encode_frame('RN:OK:bin_dev'))
+        self.proto_worker.dataReceived(
+            encode_frame('FW:1:bin_dev:CD:rm_con')
+        )
+        self.tr_worker.clear()
+        self.tr_con.clear()
+
+        #communicate of binary device is forwarded as one link line
+        line = 'RE:1' + END_LINE + 'RL:bin_dev'
+        proto_dev.dataReceived(encode_frame(line))
+        assert self.tr_worker.value() == encode_frame(
+            'FW:rm_con:SL:' + line
+        )
+
+        #remote communicate with delimiter is not delivered to text client
+        self.proto_worker.dataReceived(encode_frame('DA:1:rm_dev'))
+        self.proto_con.dataReceived('CD:rm_dev' + END_LINE)
+        self.proto_worker.dataReceived(encode_frame('FW:1:cl_con:CO:rm_dev'))
+        self.tr_con.clear()
+
+        self.proto_worker.dataReceived(
+            encode_frame('FW:1:cl_con:SL:RE:1' + END_LINE + 'DD:')
+        )
+        assert self.tr_con.value() == ''
+        assert self.proto_con.get_endpoint() is not None
+
+
+class BinaryFramingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.connections = ProtocolConnections()
+
+        self.proto_dev, self.tr_dev = proto_factory(self.connections)
+        self.proto_con, self.tr_con = proto_factory(self.connections)
+
+    def tearDown(self):
+        self.connections.reset()
+
+    def test_binary_body_relayed_between_binary_clients(self):
+        BODY = '\x00\xff' + END_LINE + 'camera'
+
+        self.proto_dev.dataReceived(
+            'BF:' + END_LINE + encode_frame('DC:bin_dev')
+        )
+        self.proto_con.dataReceived('BF:' + END_LINE)
+        self.proto_con.dataReceived(
+            encode_frame('CC:bin_con') + encode_frame('CD:bin_dev')
+        )
+        self.tr_dev.clear()
+        self.tr_con.clear()
+
+        frame = encode_frame('RE:' + BODY)
+        self.proto_con.dataReceived(frame[:3])
+        self.proto_con.dataReceived(frame[3:])
+
+        assert self.tr_dev.value() == frame
+        assert self.tr_con.value() == ''
+
+    def test_binary_client_paired_with_text_client(self):
+        self.proto_dev.dataReceived('BF:' + END_LINE)
+        self.proto_dev.dataReceived(encode_frame('DC:bin_dev'))
+        self.proto_con.dataReceived('CC:txt_con' + END_LINE)
+        self.proto_con.dataReceived('CD:bin_dev' + END_LINE)
+        self.tr_dev.clear()
+
+        self.proto_con.dataReceived('RE:0:0:0' + END_LINE)
+        self.proto_dev.dataReceived(encode_frame('RE:1:1:1'))
+
+        assert self.tr_dev.value() == encode_frame('RE:0:0:0')
+        assert self.tr_con.value().endswith('RE:1:1:1' + END_LINE)
+
+    def test_delimiter_not_injected_to_text_client(self):
+        self.proto_dev.dataReceived('BF:' + END_LINE)
+        self.proto_dev.dataReceived(encode_frame('DC:bin_dev'))
+        self.proto_con.dataReceived('CC:txt_con' + END_LINE)
+        self.proto_con.dataReceived('CD:bin_dev' + END_LINE)
+        self.tr_dev.clear()
+        self.tr_con.clear()
+
+        self.proto_dev.dataReceived(encode_frame('RE:1' + END_LINE + 'DD:'))
+
+        assert self.tr_dev.value() == encode_frame('SE:E_27')
+        assert self.tr_con.value() == ''
+        assert self.proto_con.get_endpoint() is self.proto_dev
+
+    def test_framing_selected_after_connecting(self):
+        self.proto_dev.dataReceived('DC:bin_dev' + END_LINE)
+        self.proto_dev.dataReceived('BF:' + END_LINE)
+
+        assert self.tr_dev.value() == 'BF:E_14' + END_LINE
+        assert not self.proto_dev.binary_framing
+
+    def test_frames_joined_once_complete(self):
+        frames = []
+        frame_received = lambda opcode, body: frames.append((opcode, body))
+        frame_buffer = FrameBuffer()
+        data = encode_frame('RE:' + 'x' * 1000) + encode_frame('HB:')
+
+        for offset in range(0, 1000, 10):
+            assert frame_buffer.feed(
+                data[offset:offset + 10], frame_received
+            )
+            #partial frame is kept in received chunks
+            assert len(frame_buffer.chunks) == offset // 10 + 1
+        assert frame_buffer.feed(data[1000:], frame_received)
+
+        assert frames == [
+            (COMMAND_OPCODES['RE'], 'x' * 1000), (COMMAND_OPCODES['HB'], '')
+        ]
+        assert frame_buffer.chunks == []
+        assert not frame_buffer.feed('\x00\x00\x00\x00\x04', frame_received)
+
+    def test_invalid_frame_length_drops_connection(self):
+        self.proto_dev.dataReceived('BF:' + END_LINE)
+        self.proto_dev.dataReceived('\x00\x00\x00\x00\x04')
+
+        assert self.tr_dev.disconnecting
+
+
+class FlowControlTest(unittest.TestCase):
+
+    def make_pair(self, **kwargs):
+        self.connections = ProtocolConnections(
+            high_water=20, low_water=5, **kwargs
+        )
+
+        self.proto_dev, self.tr_dev = proto_factory(self.connections)
+        self.proto_con, self.tr_con = proto_factory(self.connections)
+
+        self.proto_dev.dataReceived('DC:fc_dev' + END_LINE)
+        self.proto_con.dataReceived('CC:fc_con' + END_LINE)
+        self.proto_con.dataReceived('CD:fc_dev' + END_LINE)
+        self.tr_dev.clear()
+
+    def tearDown(self):
+        self.connections.reset()
+
+    def test_sender_paused_until_receiver_drains(self):
+        self.make_pair()
+
+        #device transport reports full write buffer
+        self.tr_dev.producer.pauseProducing()
+        assert self.tr_con.producerState == 'paused'
+
+        self.proto_con.dataReceived(
+            'RE:1' + END_LINE + 'RE:2' + END_LINE + 'RE:3' + END_LINE
+        )
+        assert self.tr_dev.value() == ''
+
+        #lines sent meanwhile by other clients are queued
+        self.proto_dev.sendLine('DD:')
+        assert list(self.proto_dev.outbox) == ['DD:']
+
+        self.tr_dev.producer.resumeProducing()
+        assert self.tr_con.producerState == 'producing'
+
+        EXPECTED_R_FOR_D = 'DD:' + END_LINE
+        EXPECTED_R_FOR_D += 'RE:1' + END_LINE
+        EXPECTED_R_FOR_D += 'RE:2' + END_LINE
+        EXPECTED_R_FOR_D += 'RE:3' + END_LINE
+        assert self.tr_dev.value() == EXPECTED_R_FOR_D
+
+    def test_writes_paused_by_measured_write_buffer(self):
+        self.make_pair()
+        assert not self.tr_dev.streaming
+
+        #device transport buffers more than high_water
+        self.tr_dev.get_write_buffer_size = lambda: 25
+        self.proto_con.dataReceived('RE:1' + END_LINE + 'RE:2' + END_LINE)
+
+        #the rest of controller's data waits until it is resumed
+        assert self.tr_dev.value() == 'RE:1' + END_LINE
+        assert self.proto_dev.write_blocked
+        assert self.tr_con.producerState == 'paused'
+
+        self.tr_dev.get_write_buffer_size = lambda: 0
+        self.tr_dev.producer.resumeProducing()
+
+        assert self.tr_dev.value() == 'RE:1' + END_LINE + 'RE:2' + END_LINE
+        assert self.tr_con.producerState == 'producing'
+
+    def test_drop_oldest(self):
+        self.make_pair(drop_oldest=True)
+
+        self.tr_dev.producer.pauseProducing()
+        assert self.tr_con.producerState == 'producing'
+
+        for i in range(10):
+            self.proto_con.dataReceived('RE:{:03d}'.format(i) + END_LINE)
+
+        assert self.proto_dev.outbox_size <= 20
+        assert self.proto_dev.dropped_lines == 7
+
+        self.tr_dev.producer.resumeProducing()
+
+        EXPECTED_R_FOR_D = 'RE:007' + END_LINE
+        EXPECTED_R_FOR_D += 'RE:008' + END_LINE
+        EXPECTED_R_FOR_D += 'RE:009' + END_LINE
+        assert self.tr_dev.value() == EXPECTED_R_FOR_D
+
+
+    def test_latest_wins(self):
+        self.make_pair()
+        self.proto_con.dataReceived('LW:ON' + END_LINE)
+        assert self.tr_con.value().endswith('LW:OK' + END_LINE)
+
+        #device write buffer is full, controller keeps sending
+        self.proto_dev.write_blocked = True
+
+        self.proto_con.dataReceived('RE:steer:1' + END_LINE)
+        self.proto_con.dataReceived('RE:speed:1' + END_LINE)
+        self.proto_con.dataReceived('RE:steer:2' + END_LINE)
+        self.proto_con.dataReceived('RE:steer:3' + END_LINE)
+
+        assert list(self.proto_dev.outbox) == ['RE:steer:3', 'RE:speed:1']
+        assert self.proto_dev.coalesced_lines == 2
+
+        self.proto_dev.write_resumed()
+        self.proto_con.dataReceived('RE:steer:4' + END_LINE)
+
+        EXPECTED_R_FOR_D = 'RE:steer:3' + END_LINE
+        EXPECTED_R_FOR_D += 'RE:speed:1' + END_LINE
+        EXPECTED_R_FOR_D += 'RE:steer:4' + END_LINE
+        assert self.tr_dev.value() == EXPECTED_R_FOR_D
+
+    def test_latest_wins_requires_flow_control(self):
+        self.connections = ProtocolConnections()
+        proto, tr = proto_factory(self.connections)
+
+        proto.dataReceived('LW:ON' + END_LINE)
+        proto.dataReceived('LW:OFF' + END_LINE)
+
+        assert tr.value() == 'LW:E_28' + END_LINE + 'LW:OK' + END_LINE
+        assert not proto.latest_wins
+
+    def test_latest_wins_keys_bounded(self):
+        self.make_pair()
+        self.proto_con.dataReceived('LW:ON' + END_LINE)
+
+        for burst in range(3):
+            self.proto_dev.write_blocked = True
+            for i in range(100):
+                self.proto_con.dataReceived(
+                    'RE:k{}_{}:1'.format(burst, i) + END_LINE
+                )
+            self.proto_dev.write_resumed()
+
+        assert not self.proto_dev.outbox
+        assert self.proto_dev.outbox_keys == {}
+        assert not self.proto_dev.outbox_key_positions
+
+        #bodies without key are never coalesced
+        self.proto_dev.write_blocked = True
+        self.proto_con.dataReceived('RE:ping' + END_LINE)
+        self.proto_con.dataReceived('RE:ping' + END_LINE)
+        assert list(self.proto_dev.outbox) == ['RE:ping', 'RE:ping']
+        assert self.proto_dev.outbox_keys == {}
+
+
+class MetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.connections = ProtocolConnections()
+        self.metrics = Metrics()
+        self.metrics.add_registry(self.connections)
+
+        self.proto_dev, self.tr_dev = proto_factory(self.connections)
+        self.proto_con, self.tr_con = proto_factory(self.connections)
+
+    def tearDown(self):
+        self.connections.reset()
+
+    def test_relay_counters(self):
+        self.proto_dev.dataReceived('DC:m_dev' + END_LINE)
+        self.proto_con.dataReceived('CC:m_con' + END_LINE)
+        self.proto_con.dataReceived('RE:0:0:0' + END_LINE)
+        self.proto_con.dataReceived('CD:m_dev' + END_LINE)
+        self.proto_con.dataReceived('RE:0:0:0' + END_LINE)
+        self.proto_con.dataReceived('XX:' + END_LINE)
+
+        assert self.metrics.lines['RE'] == 2
+        assert self.metrics.invalid_lines == 1
+        assert self.metrics.errors == {'E_20': 1, 'E_10': 1}
+        assert self.metrics.relayed_bytes == {
+            self.connections: {'m_con': {'m_dev': 5}}
+        }
+        assert self.metrics.forward_latency.count == 1
+        assert self.metrics.broadcast_fanout.count == 1
+
+        rendered = self.metrics.render()
+        assert 'rover_lines_received_total{command="RE"} 2' in rendered
+        assert 'rover_relayed_bytes_total{registry="0",sender="m_con",' \
+            'receiver="m_dev"} 5' in rendered
+        assert 'rover_devices 1' in rendered
+        assert 'rover_forward_latency_seconds_count 1' in rendered
+
+        self.proto_dev.dataReceived('RE:1' + END_LINE)
+        assert self.metrics.senders_of == {self.connections: {
+            'm_dev': set(['m_con']), 'm_con': set(['m_dev'])
+        }}
+
+        self.proto_con.connectionLost('network failure')
+        assert self.metrics.relayed_bytes == {self.connections: {}}
+        assert self.metrics.senders_of == {self.connections: {}}
+
+    def test_relay_counters_per_registry(self):
+        other_connections = ProtocolConnections()
+        self.metrics.add_registry(other_connections)
+        other_dev, _ = proto_factory(other_connections)
+        other_con, _ = proto_factory(other_connections)
+
+        for proto_dev, proto_con, line in (
+            (self.proto_dev, self.proto_con, 'RE:0:0:0'),
+            (other_dev, other_con, 'RE:1')
+        ):
+            proto_dev.dataReceived('DC:m_dev' + END_LINE)
+            proto_con.dataReceived('CC:m_con' + END_LINE)
+            proto_con.dataReceived('CD:m_dev' + END_LINE)
+            proto_con.dataReceived(line + END_LINE)
+
+        rendered = self.metrics.render()
+        assert 'rover_relayed_bytes_total{registry="0",sender="m_con",' \
+            'receiver="m_dev"} 5' in rendered
+        assert 'rover_relayed_bytes_total{registry="1",sender="m_con",' \
+            'receiver="m_dev"} 1' in rendered
+
+        #disconnect in one registry keeps pairing of other one
+        other_con.connectionLost('network failure')
+        assert self.metrics.relayed_bytes == {
+            self.connections: {'m_con': {'m_dev': 5}},
+            other_connections: {}
+        }
+        other_connections.reset()
+
+
+class SessionResumptionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.connections = ProtocolConnections(
+            clock=self.clock, resume_grace=5
+        )
+
+        self.proto_dev, self.tr_dev = proto_factory(self.connections)
+        self.proto_con, self.tr_con = proto_factory(self.connections)
+
+        self.proto_dev.dataReceived('DC:sr_dev' + END_LINE)
+        self.proto_con.dataReceived('CC:sr_con' + END_LINE)
+        self.proto_con.dataReceived('CD:sr_dev' + END_LINE)
+        self.token = self.tr_con.value().split(END_LINE)[0][3:]
+        self.tr_dev.clear()
+        self.tr_con.clear()
+
+    def tearDown(self):
+        self.connections.reset()
+
+    def test_resume_within_grace(self):
+        self.proto_con.connectionLost('network failure')
+        assert self.tr_dev.value() == ''
+
+        self.proto_dev.dataReceived('RE:1' + END_LINE)
+
+        proto_con, tr_con = proto_factory(self.connections)
+        proto_con.dataReceived('RS:' + self.token + END_LINE)
+        assert tr_con.value() == 'RS:OK' + END_LINE + 'RE:1' + END_LINE
+        assert proto_con.name == 'sr_con'
+        assert self.connections.protocols['sr_con'] is proto_con
+
+        proto_con.dataReceived('RE:2' + END_LINE)
+        assert self.tr_dev.value() == 'RE:2' + END_LINE
+
+        #expired timer of resumed session does nothing
+        self.clock.advance(10)
+        assert 'sr_con' in self.connections.controllers
+
+    def test_session_expired(self):
+        self.proto_con.connectionLost('network failure')
+        self.clock.advance(5)
+
+        assert 'sr_con' not in self.connections.protocols
+        assert self.connections.available_devices == set(['sr_dev'])
+        assert self.proto_dev.get_endpoint() is None
+
+        proto_con, tr_con = proto_factory(self.connections)
+        proto_con.dataReceived('RS:' + self.token + END_LINE)
+        assert tr_con.value() == 'RS:E_16' + END_LINE
+
+    def test_resume_after_connecting(self):
+        self.proto_con.dataReceived('RS:' + self.token + END_LINE)
+        assert self.tr_con.value() == 'RS:E_17' + END_LINE
+
+
+class IdleReaperTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.connections = ProtocolConnections(
+            clock=self.clock, idle_timeout=10
+        )
+
+        self.proto_dev, self.tr_dev = proto_factory(self.connections)
+        self.proto_con, self.tr_con = proto_factory(self.connections)
+
+        self.proto_dev.dataReceived('DC:ir_dev' + END_LINE)
+        self.proto_con.dataReceived('CC:ir_con' + END_LINE)
+        self.tr_con.clear()
+
+    def tearDown(self):
+        self.connections.reset()
+
+    def test_silent_connection_reaped(self):
+        for _ in range(9):
+            self.clock.advance(1)
+            self.proto_con.dataReceived('HB:' + END_LINE)
+
+        assert self.tr_con.value() == 9 * ('HB:OK' + END_LINE)
+        assert not self.tr_dev.disconnecting
+
+        self.clock.advance(2)
+        assert self.tr_dev.disconnecting
+        assert not self.tr_con.disconnecting
+
+        self.clock.advance(10)
+        assert self.tr_con.disconnecting
+
+    def test_lost_connection_removed(self):
+        self.proto_dev.connectionLost('network failure')
+        self.clock.advance(20)
+        assert not self.tr_dev.disconnecting
+        assert self.tr_con.disconnecting
+
+
+class ObserversTest(unittest.TestCase):
+
+    def setUp(self):
+        self.connections = ProtocolConnections(
+            splice_relay=True, high_water=20, low_water=5
+        )
+
+        self.proto_dev, self.tr_dev = proto_factory(self.connections)
+        self.proto_con, self.tr_con = proto_factory(self.connections)
+        self.proto_obs, self.tr_obs = proto_factory(self.connections)
+
+        self.proto_dev.dataReceived('DC:ob_dev' + END_LINE)
+        self.proto_con.dataReceived('CC:ob_con' + END_LINE)
+        self.proto_obs.dataReceived('CC:ob_obs' + END_LINE)
+        self.proto_obs.dataReceived('SB:ob_dev' + END_LINE)
+        self.tr_con.clear()
+        self.tr_obs.clear()
+
+    def tearDown(self):
+        self.connections.reset()
+
+    def test_fan_out(self):
+        self.proto_dev.dataReceived('RE:1' + END_LINE)
+        assert self.tr_obs.value() == 'RE:1' + END_LINE
+        assert self.tr_dev.value() == ''
+
+        self.proto_con.dataReceived('CD:ob_dev' + END_LINE)
+        self.tr_con.clear()
+        self.proto_dev.dataReceived('RE:2' + END_LINE)
+        assert self.tr_con.value() == 'RE:2' + END_LINE
+        EXPECTED_R_FOR_O = 'RE:1' + END_LINE
+        EXPECTED_R_FOR_O += 'DL:' + END_LINE
+        EXPECTED_R_FOR_O += 'RE:2' + END_LINE
+        assert self.tr_obs.value() == EXPECTED_R_FOR_O
+
+        #observer is read-only
+        self.tr_obs.clear()
+        self.proto_obs.dataReceived('RE:3' + END_LINE)
+        assert self.tr_obs.value() == 'SE:E_20' + END_LINE
+        assert self.tr_dev.value() == ''
+
+        self.proto_obs.dataReceived('US:' + END_LINE)
+        self.proto_dev.dataReceived('RE:4' + END_LINE)
+        assert self.tr_obs.value() == 'SE:E_20' + END_LINE + 'US:OK' + END_LINE
+        assert self.proto_dev.splice_peer is self.proto_con
+
+    def test_slow_observer_dropped_not_paused(self):
+        self.tr_obs.producer.pauseProducing()
+
+        for i in range(10):
+            self.proto_dev.dataReceived('RE:{}'.format(i) + END_LINE)
+
+        assert self.tr_dev.producerState == 'producing'
+        assert self.proto_obs.outbox_size <= 20
+        assert list(self.proto_obs.outbox)[-1] == 'RE:9'
+
+    def test_device_disconnected(self):
+        self.proto_con.dataReceived('SB:ob_con' + END_LINE)
+        assert self.tr_con.value() == 'SB:E_21' + END_LINE
+
+        self.proto_dev.connectionLost('network failure')
+        assert self.tr_obs.value() == 'DD:' + END_LINE + 'DL:' + END_LINE
+        assert self.proto_obs.observed is None
+
+
+class BatchWritesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.connections = ProtocolConnections(
+            clock=self.clock, batch_writes=True, batch_size=20
+        )
+
+        self.proto_dev, self.tr_dev = proto_factory(self.connections)
+        self.proto_con, self.tr_con = proto_factory(self.connections)
+
+        self.proto_dev.dataReceived('DC:bw_dev' + END_LINE)
+        self.proto_con.dataReceived('CC:bw_con' + END_LINE)
+        self.proto_con.dataReceived('CD:bw_dev' + END_LINE)
+        self.clock.advance(0)
+        self.tr_con.clear()
+
+    def tearDown(self):
+        self.connections.reset()
+
+    def test_flushed_once_per_iteration(self):
+        self.proto_con.dataReceived('RE:1' + END_LINE + 'RE:2' + END_LINE)
+        assert self.tr_dev.value() == ''
+
+        self.clock.advance(0)
+        assert self.tr_dev.value() == 'RE:1' + END_LINE + 'RE:2' + END_LINE
+        assert self.proto_dev.write_batch == []
+
+    def test_flushed_at_batch_size(self):
+        self.proto_con.dataReceived(
+            'RE:123456' + END_LINE + 'RE:123456' + END_LINE
+        )
+        assert self.tr_dev.value() == 2 * ('RE:123456' + END_LINE)
+
+        self.proto_con.dataReceived('RE:1' + END_LINE)
+        self.clock.advance(0)
+        assert self.tr_dev.value().endswith('RE:1' + END_LINE)
+
+
+class DispatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.connections = ProtocolConnections()
+        self.metrics = Metrics()
+        self.metrics.add_registry(self.connections)
+        self.proto, self.tr = proto_factory(self.connections)
+
+    def tearDown(self):
+        self.connections.reset()
+
+    def test_registered_handler(self):
+        def echo(protocol, body):
+            protocol.sendLine('EC:' + body)
+
+        self.connections.register_handler('EC', echo)
+        self.proto.dataReceived('EC:hello' + END_LINE)
+        self.proto.dataReceived('XX:hello' + END_LINE)
+
+        assert self.tr.value() == 'EC:hello' + END_LINE + 'SE:E_10' + END_LINE
+        assert self.metrics.lines['EC'] == 1
+        assert self.metrics.invalid_lines == 1
+
+    def test_name_validation(self):
+        self.proto.dataReceived('DC:' + 'd' * 256 + END_LINE)
+        self.proto.dataReceived('DC:bad-name' + END_LINE)
+        assert self.tr.value() == 'DC:E_12' + END_LINE + 'DC:E_12' + END_LINE
+
+        self.proto.dataReceived('DC:' + 'd' * 255 + END_LINE)
+        assert 'd' * 255 in self.connections.devices
+        assert 'd' * 255 in self.connections.valid_names
+
+    def test_name_with_trailing_newline_rejected(self):
+        self.proto.dataReceived('BF:' + END_LINE)
+        self.tr.clear()
+        self.proto.dataReceived(encode_frame('DC:dev\n'))
+
+        assert self.tr.value() == encode_frame('DC:E_12')
+        assert 'dev\n' not in self.connections.valid_names
+
+
+class RateLimitTest(unittest.TestCase):
+
+    def make_pair(self, **kwargs):
+        self.clock = task.Clock()
+        self.connections = ProtocolConnections(
+            clock=self.clock, rate_limits={'RE': (10, 2)}, **kwargs
+        )
+
+        self.proto_dev, self.tr_dev = proto_factory(self.connections)
+        self.proto_con, self.tr_con = proto_factory(self.connections)
+
+        self.proto_dev.dataReceived('DC:rl_dev' + END_LINE)
+        self.proto_con.dataReceived('CC:rl_con' + END_LINE)
+        self.proto_con.dataReceived('CD:rl_dev' + END_LINE)
+
+    def tearDown(self):
+        self.connections.reset()
+
+    def test_excess_lines_shed(self):
+        self.make_pair(splice_relay=True)
+
+        self.proto_con.dataReceived(
+            'RE:1' + END_LINE + 'RE:2' + END_LINE + 'RE:3' + END_LINE
+        )
+        assert self.tr_dev.value() == 'RE:1' + END_LINE + 'RE:2' + END_LINE
+
+        self.clock.advance(0.1)
+        self.proto_con.dataReceived('RE:4' + END_LINE)
+        assert self.tr_dev.value().endswith(
+            'RE:2' + END_LINE + 'RE:4' + END_LINE
+        )
+
+        limiter = self.connections.rate_limiter
+        assert limiter.throttled_lines == {'RE': 1}
+
+    def test_excess_lines_delayed(self):
+        self.make_pair(rate_limit_delay=True)
+
+        self.proto_con.dataReceived(
+            'RE:1' + END_LINE + 'RE:2' + END_LINE + 'RE:3' + END_LINE +
+            'RE:4' + END_LINE
+        )
+        EXPECTED_R_FOR_D = 'RE:1' + END_LINE
+        EXPECTED_R_FOR_D += 'RE:2' + END_LINE
+        EXPECTED_R_FOR_D += 'RE:3' + END_LINE
+        assert self.tr_dev.value() == EXPECTED_R_FOR_D
+        assert self.tr_con.producerState == 'paused'
+
+        #bucket is in debt for 0.1 s
+        self.clock.advance(0.05)
+        assert self.tr_con.producerState == 'paused'
+
+        self.clock.advance(0.06)
+        assert self.tr_dev.value() == EXPECTED_R_FOR_D + 'RE:4' + END_LINE
+
+
+class RecordReplayTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.log_file = io.BytesIO()
+        self.recorder = Recorder(self.log_file, 1.0, clock=self.clock)
+        self.recorder.start()
+
+        self.connections = ProtocolConnections(
+            clock=self.clock, splice_relay=True
+        )
+        self.recorder.add_registry(self.connections)
+
+        proto_dev, self.tr_dev = proto_factory(self.connections)
+        proto_con, self.tr_con = proto_factory(self.connections)
+
+        proto_dev.dataReceived('DC:rec_dev' + END_LINE)
+        self.clock.advance(0.5)
+        proto_con.dataReceived('CC:rec_con' + END_LINE)
+        proto_con.dataReceived('CD:rec_dev' + END_LINE)
+        proto_con.dataReceived('RE:1' + END_LINE + 'RE:2' + END_LINE)
+        proto_con.connectionLost(None)
+
+    def tearDown(self):
+        self.connections.reset()
+
+    def test_records_flushed_periodically(self):
+        assert self.log_file.getvalue() == ''
+
+        self.clock.advance(1.0)
+        self.log_file.seek(0)
+        records = list(read_records(self.log_file))
+
+        assert [(event, data) for _, _, event, data in records] == [
+            (CONNECT_EVENT, ''),
+            (CONNECT_EVENT, ''),
+            (LINE_EVENT, 'DC:rec_dev'),
+            (LINE_EVENT, 'CC:rec_con'),
+            (LINE_EVENT, 'CD:rec_dev'),
+            (LINE_EVENT, 'RE:1'),
+            (LINE_EVENT, 'RE:2'),
+            (DISCONNECT_EVENT, ''),
+        ]
+        assert [record[1] for record in records] == [1, 2, 1, 2, 2, 2, 2, 2]
+        assert records[2][0] == 0
+        assert records[3][0] == 0.5
+
+    def test_replay_as_fast_as_possible(self):
+        self.recorder.stop()
+        self.log_file.seek(0)
+
+        connections = ProtocolConnections()
+        replay = Replay(
+            read_records(self.log_file), ServerFactory(connections), speed=0
+        )
+
+        def check_results(results):
+            assert results['lines'] == 5
+            assert results['connections'] == 2
+            assert results['recorded_time'] == 0.5
+            assert results['written_bytes'] == \
+                len(self.tr_dev.value()) + len(self.tr_con.value())
+            assert 'lag_p50' not in results
+            assert results['processing_p50'] <= results['processing_max']
+
+            assert connections.devices == set(['rec_dev'])
+            assert not connections.controllers
+            connections.reset()
+
+        return replay.run().addCallback(check_results)
+
+    def test_replay_follows_recorded_timeline(self):
+        self.recorder.stop()
+        self.log_file.seek(0)
+
+        connections = ProtocolConnections()
+        replay = Replay(
+            read_records(self.log_file), ServerFactory(connections),
+            speed=10.0
+        )
+
+        def check_results(results):
+            assert results['lines'] == 5
+            assert results['replay_time'] >= 0.05
+            assert results['lag_p50'] <= results['lag_max']
+            connections.reset()
+
+        return replay.run().addCallback(check_results)
+
+
+class StoreForwardTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.connections = ProtocolConnections(
+            clock=self.clock, forward_hold=5, forward_ttl=2, forward_size=12
+        )
+
+        self.proto_dev, self.tr_dev = proto_factory(self.connections)
+        self.proto_con, self.tr_con = proto_factory(self.connections)
+
+        self.proto_dev.dataReceived('DC:sf_dev' + END_LINE)
+        self.proto_con.dataReceived('CC:sf_con' + END_LINE)
+        self.proto_con.dataReceived('CD:sf_dev' + END_LINE)
+        self.tr_con.clear()
+
+    def tearDown(self):
+        self.connections.reset()
+
+    def test_stored_lines_forwarded_on_reconnect(self):
+        self.proto_dev.connectionLost('network failure')
+        self.proto_con.dataReceived('RE:1' + END_LINE + 'RE:2' + END_LINE)
+        assert self.tr_con.value() == ''
+
+        proto_dev, tr_dev = proto_factory(self.connections)
+        proto_dev.dataReceived('DC:sf_dev' + END_LINE)
+        assert tr_dev.value() == 'RE:1' + END_LINE + 'RE:2' + END_LINE
+        assert proto_dev.get_endpoint() is self.proto_con
+        assert not self.connections.available_devices
+
+        self.proto_con.dataReceived('RE:3' + END_LINE)
+        assert tr_dev.value().endswith('RE:2' + END_LINE + 'RE:3' + END_LINE)
+
+        #timer of reattached outbox does nothing
+        self.clock.advance(10)
+        assert self.tr_con.value() == ''
+
+    def test_oldest_lines_evicted(self):
+        self.proto_dev.connectionLost('network failure')
+        self.proto_con.dataReceived(
+            'RE:1' + END_LINE + 'RE:2' + END_LINE + 'RE:3' + END_LINE
+        )
+        self.clock.advance(1.5)
+
+        #RE:1 exceeds size, RE:2 and RE:3 are older than ttl
+        self.proto_con.dataReceived('RE:4' + END_LINE)
+        self.clock.advance(1)
+
+        proto_dev, tr_dev = proto_factory(self.connections)
+        proto_dev.dataReceived('DC:sf_dev' + END_LINE)
+        assert tr_dev.value() == 'RE:4' + END_LINE
+
+    def test_outbox_expired(self):
+        self.proto_dev.connectionLost('network failure')
+        self.proto_con.dataReceived('RE:1' + END_LINE)
+        self.clock.advance(5)
+        assert self.tr_con.value() == 'DD:' + END_LINE
+        assert not self.connections.offline_devices
+
+        self.proto_con.dataReceived('RE:2' + END_LINE)
+        assert self.tr_con.value().endswith('SE:E_20' + END_LINE)
+
+        proto_dev, tr_dev = proto_factory(self.connections)
+        proto_dev.dataReceived('DC:sf_dev' + END_LINE)
+        assert tr_dev.value() == ''
+        assert self.connections.available_devices == set(['sf_dev'])
+
+    def test_controller_selected_other_device(self):
+        self.proto_dev.connectionLost('network failure')
+        self.proto_con.dataReceived('RE:1' + END_LINE)
+
+        proto_other, tr_other = proto_factory(self.connections)
+        proto_other.dataReceived('DC:sf_other' + END_LINE)
+        self.proto_con.dataReceived('CD:sf_other' + END_LINE)
+
+        proto_dev, tr_dev = proto_factory(self.connections)
+        proto_dev.dataReceived('DC:sf_dev' + END_LINE)
+        assert tr_dev.value() == ''
+        assert self.proto_con.get_endpoint() is proto_other
+        assert 'sf_dev' in self.connections.available_devices
+
+
+class FederationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.connections_a = ProtocolConnections()
+        self.connections_b = ProtocolConnections()
+        self.federation_a = Federation(self.connections_a, 'a')
+        self.federation_b = Federation(self.connections_b, 'b')
+
+        self.proto_dev, self.tr_dev = proto_factory(self.connections_a)
+        self.proto_dev.dataReceived('DC:fed_dev' + END_LINE)
+        self.proto_con, self.tr_con = proto_factory(self.connections_b)
+        self.proto_con.dataReceived('CC:fed_con' + END_LINE)
+        self.tr_con.clear()
+
+        self.link_a = FederationLink(self.federation_a)
+        self.link_b = FederationLink(self.federation_b)
+        self.pump = iosim.connect(
+            self.link_a, iosim.makeFakeServer(self.link_a),
+            self.link_b, iosim.makeFakeClient(self.link_b),
+        )
+
+    def tearDown(self):
+        self.connections_a.reset()
+        self.connections_b.reset()
+
+    def test_devices_gossiped(self):
+        assert self.federation_a.links == {'b': self.link_a}
+        assert self.federation_b.links == {'a': self.link_b}
+        assert self.tr_con.value() == 'DL:fed_dev' + END_LINE
+
+        self.proto_dev.connectionLost('network failure')
+        self.pump.flush()
+        assert self.tr_con.value().endswith('DL:' + END_LINE)
+
+    def test_relay_between_nodes(self):
+        self.proto_con.dataReceived('CD:fed_dev' + END_LINE)
+        self.pump.flush()
+        assert self.tr_con.value().endswith('CD:OK' + END_LINE)
+        assert self.proto_dev.get_endpoint().name == 'fed_con'
+
+        self.proto_con.dataReceived('RE:ping' + END_LINE)
+        self.pump.flush()
+        assert self.tr_dev.value() == 'RE:ping' + END_LINE
+
+        self.proto_dev.dataReceived('RE:pong' + END_LINE)
+        self.pump.flush()
+        assert self.tr_con.value().endswith('RE:pong' + END_LINE)
+
+    def test_remote_device_name_taken(self):
+        proto, tr = proto_factory(self.connections_b)
+        proto.dataReceived('DC:fed_dev' + END_LINE)
+        assert tr.value() == 'DC:E_11' + END_LINE
+
+    def test_link_lost(self):
+        self.proto_con.dataReceived('CD:fed_dev' + END_LINE)
+        self.pump.flush()
+
+        self.link_b.connectionLost('network failure')
+        assert self.tr_con.value().endswith('DD:' + END_LINE)
+        assert not self.connections_b.available_devices
+        assert not self.federation_b.links
+
+    def test_remote_controller_does_not_replace_local_client(self):
+        proto, tr = proto_factory(self.connections_a)
+        proto.dataReceived('CC:fed_con' + END_LINE)
+
+        self.proto_con.dataReceived('CD:fed_dev' + END_LINE)
+        self.pump.flush()
+
+        assert self.tr_con.value().endswith('CD:E_21' + END_LINE)
+        assert self.connections_a.protocols['fed_con'] is proto
+        assert self.proto_dev.get_endpoint() is None
+
+    def test_remote_device_does_not_replace_local_client(self):
+        proto, tr = proto_factory(self.connections_b)
+        proto.dataReceived('DC:loc_dev' + END_LINE)
+        self.pump.flush()
+
+        self.link_b.lineReceived('FW:fed_con:CO:loc_dev')
+        self.pump.flush()
+
+        assert self.tr_con.value().endswith('CD:E_21' + END_LINE)
+        assert self.connections_b.protocols['loc_dev'] is proto
+        assert self.proto_con.get_endpoint() is None
+
+    def test_remote_device_with_local_name_ignored(self):
+        #device of node b is paired, so its name is free on node a
+        proto_dev_b, tr_dev_b = proto_factory(self.connections_b)
+        proto_dev_b.dataReceived('DC:dup_dev' + END_LINE)
+        self.proto_con.dataReceived('CD:dup_dev' + END_LINE)
+        self.pump.flush()
+
+        proto_dev_a, tr_dev_a = proto_factory(self.connections_a)
+        proto_dev_a.dataReceived('DC:dup_dev' + END_LINE)
+        self.pump.flush()
+
+        assert 'dup_dev' not in self.link_b.remote_devices
+        assert 'dup_dev' not in self.connections_b.available_devices
+        assert proto_dev_b.get_endpoint() is self.proto_con
+
+        proto_dev_a.connectionLost('network failure')
+        self.pump.flush()
+        assert proto_dev_b.get_endpoint() is self.proto_con
+
+    def test_delimiter_not_injected_through_link(self):
+        proto_dev, tr_dev = proto_factory(self.connections_a)
+        proto_dev.dataReceived('BF:' + END_LINE)
+        proto_dev.dataReceived(encode_frame('DC:bin_dev'))
+        self.pump.flush()
+        self.proto_con.dataReceived('CD:bin_dev' + END_LINE)
+        self.pump.flush()
+        self.tr_con.clear()
+
+        proto_dev.dataReceived(encode_frame('RE:1' + END_LINE + 'DD:'))
+        self.pump.flush()
+
+        assert self.tr_con.value() == ''
+        assert self.proto_con.get_endpoint() is not None
+        assert self.federation_b.links == {'a': self.link_b}
+
+    def test_duplicate_link_rejected(self):
+        link = FederationLink(self.federation_b)
+        link.makeConnection(proto_helpers.StringTransport())
+        link.dataReceived(encode_frame('HI:a'))
+
+        assert link.transport.disconnecting
+        assert self.federation_b.links == {'a': self.link_b}
+
+
+class CompressionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.connections = ProtocolConnections()
+        self.connections.metrics = Metrics()
+
+        self.proto_dev, self.tr_dev = proto_factory(self.connections)
+        self.proto_con, self.tr_con = proto_factory(self.connections)
+
+    def tearDown(self):
+        self.connections.reset()
+
+    def make_pair(self, device_codec, controller_codec):
+        self.proto_dev.dataReceived('BF:' + END_LINE)
+        self.proto_dev.dataReceived(
+            encode_frame('ZC:' + device_codec) + encode_frame('DC:zc_dev')
+        )
+        self.proto_con.dataReceived('BF:' + END_LINE)
+        self.proto_con.dataReceived(
+            encode_frame('ZC:' + controller_codec) +
+            encode_frame('CC:zc_con') + encode_frame('CD:zc_dev')
+        )
+        self.tr_dev.clear()
+        self.tr_con.clear()
+
+    def test_stream_compressed_for_each_endpoint(self):
+        self.make_pair('ZLIB', 'ZLIB_MSG')
+        BODY = '{"temperature": 21.5, "humidity": 40}'
+
+        self.proto_con.dataReceived(
+            encode_frame('RZ:' + zlib.compress(BODY))
+        )
+        self.proto_con.dataReceived(
+            encode_frame('RZ:' + zlib.compress(BODY))
+        )
+
+        #device gets RZ frames of single zlib stream
+        frames = self.tr_dev.value()
+        stream = zlib.decompressobj()
+        bodies = []
+        offset = 0
+        while offset < len(frames):
+            length, opcode = FRAME_HEADER.unpack_from(frames, offset)
+            assert opcode == COMMAND_OPCODES['RZ']
+            bodies.append(stream.decompress(
+                frames[offset + FRAME_HEADER.size:offset + 4 + length]
+            ))
+            offset += 4 + length
+        assert bodies == [BODY, BODY]
+
+        metrics = self.connections.metrics
+        assert metrics.plain_bytes == {
+            'in': 2 * len(BODY), 'out': 2 * len(BODY)
+        }
+        assert metrics.compressed_bytes['out'] < 2 * len(BODY)
+        assert metrics.passthrough_bytes == 0
+
+    def test_same_message_codec_passed_through(self):
+        self.make_pair('ZLIB_MSG', 'ZLIB_MSG')
+        frame = encode_frame('RZ:' + zlib.compress('camera'))
+
+        self.proto_con.dataReceived(frame)
+
+        assert self.tr_dev.value() == frame
+        assert self.connections.metrics.passthrough_bytes == len(frame) - 5
+
+    def test_compressed_and_plain_clients(self):
+        self.proto_dev.dataReceived('DC:zc_dev' + END_LINE)
+        self.proto_con.dataReceived('BF:' + END_LINE)
+        self.proto_con.dataReceived(
+            encode_frame('ZC:ZLIB') + encode_frame('CC:zc_con') +
+            encode_frame('CD:zc_dev')
+        )
+        self.tr_con.clear()
+
+        self.proto_con.dataReceived(
+            encode_frame('RZ:' + zlib.compress('forward'))
+        )
+        self.proto_dev.dataReceived('RE:back' + END_LINE)
+
+        assert self.tr_dev.value().endswith('RE:forward' + END_LINE)
+        assert zlib.decompressobj().decompress(
+            self.tr_con.value()[5:]
+        ) == 'back'
+
+    def test_compression_negotiation_errors(self):
+        self.proto_dev.dataReceived('ZC:ZLIB' + END_LINE)
+        assert self.tr_dev.value() == 'ZC:E_22' + END_LINE
+
+        self.proto_dev.dataReceived('BF:' + END_LINE)
+        self.tr_dev.clear()
+        self.proto_dev.dataReceived(encode_frame('ZC:LZ4'))
+        assert self.tr_dev.value() == encode_frame('ZC:E_23')
+
+        self.tr_dev.clear()
+        self.proto_dev.dataReceived(encode_frame('RZ:data'))
+        assert self.tr_dev.value() == encode_frame('SE:E_24')
+
+        self.tr_dev.clear()
+        self.proto_dev.dataReceived(encode_frame('ZC:ZLIB'))
+        self.proto_dev.dataReceived(encode_frame('RZ:invalid'))
+        assert self.tr_dev.value() == \
+            encode_frame('ZC:OK') + encode_frame('SE:E_24')
+
+
+class TracingTest(unittest.TestCase):
+
+    def make_pair(self, **kwargs):
+        self.clock = task.Clock()
+        self.connections = ProtocolConnections(
+            clock=self.clock, trace_sample=2, **kwargs
+        )
+
+        self.proto_dev, self.tr_dev = proto_factory(self.connections)
+        self.proto_con, self.tr_con = proto_factory(self.connections)
+
+        self.proto_dev.dataReceived('DC:tr_dev' + END_LINE)
+        self.proto_con.dataReceived('CC:tr_con' + END_LINE)
+        self.proto_con.dataReceived('CD:tr_dev' + END_LINE)
+
+        self.proto_admin = ServerProtocol(self.connections)
+        self.tr_admin = proto_helpers.StringTransport(
+            peerAddress=IPv4Address('TCP', '127.0.0.1', 40000)
+        )
+        self.proto_admin.makeConnection(self.tr_admin)
+
+    def tearDown(self):
+        self.connections.reset()
+
+    def query_traces(self, query):
+        self.tr_admin.clear()
+        self.proto_admin.dataReceived('TQ:' + query + END_LINE)
+        lines = self.tr_admin.value().split(END_LINE)
+        assert lines[-2:] == ['TQ:OK', '']
+        return [line.split(':') for line in lines[:-2]]
+
+    def test_sampled_communicates_traced(self):
+        self.make_pair()
+
+        self.proto_con.dataReceived(
+            'RE:1' + END_LINE + 'RE:22' + END_LINE + 'RE:3' + END_LINE
+        )
+        self.proto_dev.dataReceived('RE:44' + END_LINE)
+
+        traces = self.query_traces('10')
+        assert [trace[1:5] for trace in traces] == [
+            ['1', 'tr_con', 'tr_dev', '2'],
+            ['2', 'tr_dev', 'tr_con', '2'],
+        ]
+        for trace in traces:
+            assert int(trace[6]) <= int(trace[7]) <= int(trace[8])
+
+        assert len(self.query_traces('1')) == 1
+        assert self.query_traces('10:1000000') == []
+
+    def test_batched_communicate_flushed(self):
+        self.make_pair(batch_writes=True)
+        self.clock.advance(0)
+
+        self.proto_con.dataReceived('RE:1' + END_LINE + 'RE:2' + END_LINE)
+        trace = self.connections.tracer.traces[0]
+        assert trace.written is not None
+        assert trace.flushed is None
+
+        self.clock.advance(0)
+        assert trace.flushed >= trace.written
+
+    def test_queued_communicate_written_once_drained(self):
+        self.make_pair(high_water=20, low_water=5, drop_oldest=True)
+        self.tr_dev.producer.pauseProducing()
+
+        self.proto_con.dataReceived('RE:1' + END_LINE + 'RE:2' + END_LINE)
+        assert self.query_traces('1')[0][7:] == ['-', '-']
+
+        self.tr_dev.producer.resumeProducing()
+        assert self.query_traces('1')[0][7] != '-'
+
+    def test_query_refused(self):
+        self.make_pair()
+
+        self.proto_con.dataReceived('TQ:10' + END_LINE)
+        assert self.tr_con.value().endswith('TQ:E_25' + END_LINE)
+
+        self.proto_admin.dataReceived('TQ:all' + END_LINE)
+        assert self.tr_admin.value() == 'TQ:E_26' + END_LINE
+
+
+class CountingProtocol(ServerProtocol):
+    """
+    server protocol counting bytes it received and wrote, so tests on
+    real backends wait until both ends handled them instead of sleeping
+    """
+
+    received_bytes = 0
+    written_bytes = 0
+    lost = False
+
+    def dataReceived(self, data):
+        self.received_bytes += len(data)
+        ServerProtocol.dataReceived(self, data)
+
+    def write_data(self, data):
+        self.written_bytes += len(data)
+        return ServerProtocol.write_data(self, data)
+
+    def connectionLost(self, reason):
+        self.lost = True
+        ServerProtocol.connectionLost(self, reason)
+
+
+class CountingFactory(ServerFactory):
+
+    def __init__(self, connections):
+        ServerFactory.__init__(self, connections)
+        self.protocols = []
+
+    def buildProtocol(self, addr):
+        protocol = CountingProtocol(self.connections)
+        self.protocols.append(protocol)
+        return protocol
+
+
+class DataCollector(Protocol):
+
+    def __init__(self):
+        self.data = ''
+
+    def dataReceived(self, data):
+        self.data += data
+
+
+class LineCollector(aio.asyncio.Protocol if aio.asyncio else object):
+
+    def __init__(self):
+        self.data = ''
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.data += data
+
+
+class BackendClient(object):
+    """
+    client connected to the server over a backend, stands in for both
+    protocol and string transport of scenarios written for them
+
+    dataReceived - client sends data, returns once the server read it
+    connectionLost - client disconnects once it read everything sent to
+        it, returns once the server noticed
+    value - everything the server sent to the client
+    """
+
+    def __init__(self, backend, client, protocol):
+        self.backend = backend
+        self.client = client
+        self.protocol = protocol
+        self.sent_bytes = 0
+
+    def dataReceived(self, data):
+        self.client.transport.write(data)
+        self.sent_bytes += len(data)
+        self.backend.run_until(
+            lambda: self.protocol.received_bytes >= self.sent_bytes
+        )
+
+    def connectionLost(self, reason):
+        self.value()
+        self.backend.close_client(self.client)
+        self.backend.run_until(lambda: self.protocol.lost)
+
+    def value(self):
+        self.backend.run_until(
+            lambda: len(self.client.data) >= self.protocol.written_bytes
+        )
+        return self.client.data
+
+
+class LoopbackBackend(object):
+    """
+    runs scenarios over twisted loopback (iosim) transports
+    """
+
+    def connect_client(self):
+        protocol = CountingProtocol(self.connections)
+        client = DataCollector()
+        pump = iosim.connect(
+            protocol, iosim.makeFakeServer(protocol),
+            client, iosim.makeFakeClient(client),
+        )
+        self.pumps = getattr(self, 'pumps', []) + [pump]
+
+        backend_client = BackendClient(self, client, protocol)
+        return backend_client, backend_client
+
+    def get_protocol(self, proto):
+        return proto.protocol
+
+    def run_until(self, condition):
+        #pumps of all clients, data of one client may be relayed to another
+        while any([pump.pump() for pump in self.pumps]):
+            pass
+        assert condition()
+
+    def close_client(self, client):
+        client.transport.loseConnection()
+
+
+class AsyncioBackend(object):
+    """
+    runs scenarios over sockets of asyncio backend
+    """
+
+    if aio.asyncio is None:
+        skip = 'asyncio or trollius is not installed'
+
+    loop = None
+    factory = None
+
+    def start_server(self):
+        if self.loop is None:
+            self.loop = aio.asyncio.new_event_loop()
+        self.factory = CountingFactory(self.connections)
+        self.server = aio.listen_asyncio(
+            self.loop, 0, self.factory, '127.0.0.1'
+        )
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    def tearDown(self):
+        if self.factory is not None:
+            for protocol in self.factory.protocols:
+                protocol.transport.loseConnection()
+            self.run_until(lambda: all(
+                protocol.lost for protocol in self.factory.protocols
+            ))
+            self.server.close()
+            self.loop.run_until_complete(self.server.wait_closed())
+        if self.loop is not None:
+            self.loop.close()
+        super(AsyncioBackend, self).tearDown()
+
+    def connect_client(self):
+        if self.factory is None:
+            self.start_server()
+
+        protocols = self.factory.protocols
+        count = len(protocols) + 1
+        transport, client = self.loop.run_until_complete(
+            self.loop.create_connection(LineCollector, '127.0.0.1', self.port)
+        )
+        self.run_until(lambda: len(protocols) >= count)
+
+        backend_client = BackendClient(self, client, protocols[-1])
+        return backend_client, backend_client
+
+    def get_protocol(self, proto):
+        return proto.protocol
+
+    def run_until(self, condition, timeout=10.0):
+        deadline = time.time() + timeout
+        while not condition():
+            assert time.time() < deadline, 'timed out waiting for backend'
+            self.loop.run_until_complete(
+                aio.asyncio.sleep(0.001, loop=self.loop)
+            )
+
+    def close_client(self, client):
+        client.transport.close()
+
+
+class ProtocolConnectionsLineRecievedLoopbackTest(
+        LoopbackBackend, ProtocolConnectionsLineRecievedTest):
+    pass
+
+
+class ProtocolConnectionsRequestsLoopbackTest(
+        LoopbackBackend, ProtocolConnectionsRequestsTest):
+    pass
+
+
+class ProtocolConnectionsLineRecievedAsyncioTest(
+        AsyncioBackend, ProtocolConnectionsLineRecievedTest):
+    pass
+
+
+class ProtocolConnectionsRequestsAsyncioTest(
+        AsyncioBackend, ProtocolConnectionsRequestsTest):
+    pass
+
+
+class AsyncioBackendTest(AsyncioBackend, unittest.TestCase):
+
+    def setUp(self):
+        self.loop = aio.asyncio.new_event_loop()
+        self.connections = ProtocolConnections(
+            clock=aio.AsyncioClock(self.loop), idle_timeout=10
+        )
+
+    def tearDown(self):
+        super(AsyncioBackendTest, self).tearDown()
+        self.connections.reset()
+
+    def test_relay(self):
+        device, _ = self.connect_client()
+        controller, _ = self.connect_client()
+
+        device.dataReceived('DC:aio_dev' + END_LINE)
+        controller.dataReceived('CC:aio_con' + END_LINE)
+        controller.dataReceived('CD:aio_dev' + END_LINE)
+        controller.dataReceived('RE:ping' + END_LINE)
+        device.dataReceived('RE:pong' + END_LINE)
+
+        assert device.value() == 'RE:ping' + END_LINE
+
+        EXPECTED_R_FOR_C = 'DL:aio_dev' + END_LINE
+        EXPECTED_R_FOR_C += 'DL:' + END_LINE
+        EXPECTED_R_FOR_C += 'CD:OK' + END_LINE
+        EXPECTED_R_FOR_C += 'RE:pong' + END_LINE
+        assert controller.value() == EXPECTED_R_FOR_C
+
+        device.connectionLost('network failure')
+        assert controller.value().endswith('DD:' + END_LINE)
+        assert 'aio_dev' not in self.connections.protocols